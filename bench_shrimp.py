@@ -0,0 +1,584 @@
+"""Headless benchmarks for the SHRIMP hot paths.
+
+shrimp.py normally talks to a Sense HAT and libVLC. Here it runs against stand-in
+display, joystick and player backends, on synthetic libraries of tagged MP3, FLAC
+and OGG files, and the timings are written to a JSON file so regressions show up
+before they reach a Pi:
+
+    python3 bench_shrimp.py --sizes 1000,10000,100000 --output bench_results.json
+
+Generated libraries are kept in --library-dir and reused on the next run.
+"""
+import argparse
+import contextlib
+import enum
+import json
+import os
+import platform
+import queue
+import random
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import types
+
+from mutagen.flac import FLAC
+from mutagen.id3 import ID3, TALB, TIT2, TPE1
+from mutagen.ogg import OggPage
+from mutagen.oggvorbis import OggVorbis
+
+
+def make_vlc_stand_in():
+    """Minimal vlc module for machines without python-vlc: shrimp.py only needs its constants there."""
+    module = types.ModuleType("vlc")
+
+    class State(enum.Enum):
+        NothingSpecial = 0
+        Opening = 1
+        Buffering = 2
+        Playing = 3
+        Paused = 4
+        Stopped = 5
+        Ended = 6
+        Error = 7
+
+    class EventType:
+        MediaPlayerEndReached = "MediaPlayerEndReached"
+        MediaPlayerEncounteredError = "MediaPlayerEncounteredError"
+        MediaPlayerPlaying = "MediaPlayerPlaying"
+        MediaListPlayerNextItemSet = "MediaListPlayerNextItemSet"
+        MediaListPlayerPlayed = "MediaListPlayerPlayed"
+
+    class MediaParseFlag:
+        local = 0
+        network = 1
+        fetch_local = 2
+
+    module.State = State
+    module.EventType = EventType
+    module.MediaParseFlag = MediaParseFlag
+    return module
+
+
+try:
+    import vlc
+except Exception: # python-vlc missing, or libvlc itself cannot be loaded
+    vlc = sys.modules["vlc"] = make_vlc_stand_in()
+
+import shrimp
+
+
+# --- Stand-in backends ---
+
+class FakeInputEvent:
+    """Same fields as sense_hat.stick.InputEvent."""
+    def __init__(self, direction, action="pressed"):
+        self.timestamp = time.time()
+        self.direction = direction
+        self.action = action
+
+
+class FakeStick:
+    """Joystick fed from a queue instead of the input device."""
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def push(self, direction, action="pressed"):
+        self.events.put(FakeInputEvent(direction, action))
+
+    def wait_for_event(self, emptybuffer=False):
+        return self.events.get()
+
+    def get_events(self):
+        events = []
+        while not self.events.empty():
+            events.append(self.events.get())
+        return events
+
+
+class FakeDisplay:
+    """Sense HAT LED matrix that only counts what it is asked to draw."""
+    def __init__(self):
+        self.stick = FakeStick()
+        self.low_light = False
+        self.rotation = 0
+        self.frames = 0
+        self.pixels = [[0, 0, 0]] * 64
+
+    def set_rotation(self, r=0, redraw=True):
+        self.rotation = r
+
+    def clear(self, *colour):
+        self.frames += 1
+
+    def set_pixel(self, x, y, *colour):
+        self.frames += 1
+
+    def set_pixels(self, pixel_list):
+        if len(pixel_list) != 64:
+            raise ValueError("Pixel lists must have 64 elements")
+        self.pixels = pixel_list
+        self.frames += 1
+
+    def get_pixels(self):
+        return list(self.pixels)
+
+    def show_letter(self, s, text_colour=(255, 255, 255), back_colour=(0, 0, 0)):
+        self.frames += 1
+
+    def show_message(self, text_string, scroll_speed=.1, text_colour=(255, 255, 255), back_colour=(0, 0, 0)):
+        self.frames += len(text_string) * 6
+
+    def _get_char_pixels(self, s):
+        # 5 columns of 8 pixels, like the real font, with a pattern derived from the character
+        return [[255, 255, 255] if (i * 7 + ord(s)) % 3 == 0 else [0, 0, 0] for i in range(40)]
+
+    def _trim_whitespace(self, char):
+        return char
+
+
+class FakeEventManager:
+    def __init__(self):
+        self.callbacks = {}
+
+    def event_attach(self, event_type, callback, *args, **kwargs):
+        self.callbacks[event_type] = (callback, args, kwargs)
+
+    def fire(self, event_type, event=None):
+        if event_type in self.callbacks:
+            callback, args, kwargs = self.callbacks[event_type]
+            callback(event, *args, **kwargs)
+
+
+class FakeMedia:
+    def __init__(self, mrl):
+        self.mrl = mrl
+
+    def parse_with_options(self, parse_flag, timeout):
+        return 0
+
+    def get_mrl(self):
+        return "file://" + self.mrl
+
+
+class FakeMediaList:
+    def __init__(self):
+        self.items = []
+
+    def lock(self):
+        pass
+
+    def unlock(self):
+        pass
+
+    def add_media(self, media):
+        self.items.append(media)
+        return 0
+
+    def count(self):
+        return len(self.items)
+
+    def remove_index(self, index):
+        del self.items[index]
+        return 0
+
+
+class FakeMediaPlayer:
+    def __init__(self):
+        self.volume = 100
+        self.state = vlc.State.NothingSpecial
+        self.media = None
+        self.events = FakeEventManager()
+        self.time = 0
+
+    def event_manager(self):
+        return self.events
+
+    def audio_set_volume(self, volume):
+        self.volume = volume
+        return 0
+
+    def audio_get_volume(self):
+        return self.volume
+
+    def set_media(self, media):
+        self.media = media
+
+    def get_media(self):
+        return self.media
+
+    def play(self):
+        self.state = vlc.State.Playing
+        return 0
+
+    def pause(self):
+        self.state = vlc.State.Paused
+
+    def stop(self):
+        self.state = vlc.State.Stopped
+
+    def is_playing(self):
+        return self.state == vlc.State.Playing
+
+    def get_state(self):
+        return self.state
+
+    def get_time(self):
+        return self.time
+
+    def set_time(self, time_ms):
+        self.time = time_ms
+
+    def get_length(self):
+        return 0
+
+
+class FakeMediaListPlayer:
+    def __init__(self):
+        self.events = FakeEventManager()
+        self.player = None
+        self.media_list = None
+
+    def event_manager(self):
+        return self.events
+
+    def set_media_player(self, player):
+        self.player = player
+
+    def set_media_list(self, media_list):
+        self.media_list = media_list
+
+    def play_item_at_index(self, index):
+        self.player.set_media(self.media_list.items[index])
+        self.player.play()
+        self.events.fire(vlc.EventType.MediaListPlayerNextItemSet)
+        return 0
+
+    def stop(self):
+        self.player.stop()
+
+
+class FakeVlcInstance:
+    """vlc.Instance stand-in: playback is instantaneous and silent."""
+    def media_new(self, mrl, *options):
+        return FakeMedia(mrl)
+
+    def media_player_new(self):
+        return FakeMediaPlayer()
+
+    def media_list_new(self, mrls=None):
+        return FakeMediaList()
+
+    def media_list_player_new(self):
+        return FakeMediaListPlayer()
+
+
+# --- Synthetic libraries ---
+
+# One MPEG-1 Layer III frame (128 kbit/s, 44.1 kHz, joint stereo) of silence
+MP3_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+FORMATS = ("mp3", "flac", "ogg", "wav")
+TITLE_WORDS = ["love", "night", "summer", "road", "fire", "dream", "heart", "river", "blue", "light",
+               "shadow", "stone", "home", "rain", "gold", "wild", "ocean", "city", "star", "time"]
+
+
+def flac_bytes(seconds):
+    """A FLAC stream with only a STREAMINFO block (mutagen adds the tags)."""
+    sample_rate, channels, bits, total_samples = 44100, 2, 16, 44100 * seconds
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | total_samples
+    streaminfo = struct.pack(">HH", 4096, 4096) + b"\x00" * 6 + struct.pack(">Q", packed) + b"\x00" * 16
+    return b"fLaC" + bytes([0x80]) + len(streaminfo).to_bytes(3, "big") + streaminfo
+
+
+def ogg_vorbis_bytes(seconds):
+    """An Ogg Vorbis stream with identification, comment and setup headers and one audio page."""
+    identification = b"\x01vorbis" + struct.pack("<IBIiiiBB", 0, 2, 44100, 0, 128000, 0, 0xB8, 1)
+    comment = b"\x03vorbis" + struct.pack("<I", 6) + b"SHRIMP" + struct.pack("<I", 0) + b"\x01"
+    setup = b"\x05vorbis" + b"\x00" * 16
+    pages = []
+    for sequence, (packets, position) in enumerate([([identification], 0), ([comment, setup], 0),
+                                                    ([b"\x00" * 32], 44100 * seconds)]):
+        page = OggPage()
+        page.serial = 0x5348524D
+        page.sequence = sequence
+        page.position = position
+        page.packets = packets
+        page.first = sequence == 0
+        page.last = sequence == 2
+        pages.append(page.write())
+    return b"".join(pages)
+
+
+def wav_bytes(title, artist, album):
+    """A WAV file (8 kHz mono, a tenth of a second of silence) with a LIST/INFO tag."""
+    info = b"INFO"
+    for item_id, value in ((b"INAM", title), (b"IART", artist), (b"IPRD", album)):
+        data = value.encode("utf-8") + b"\x00"
+        info += item_id + struct.pack("<I", len(data)) + data + b"\x00" * (len(data) & 1)
+    fmt = struct.pack("<HHIIHH", 1, 1, 8000, 8000, 1, 8)
+    chunks = (b"fmt " + struct.pack("<I", len(fmt)) + fmt + b"LIST" + struct.pack("<I", len(info)) + info
+              + b"data" + struct.pack("<I", 800) + b"\x80" * 800)
+    return b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks
+
+
+def random_title(rng):
+    """A title whose first character covers letters, digits and symbols like a real library."""
+    roll = rng.random()
+    words = " ".join(rng.choice(TITLE_WORDS) for _ in range(rng.randint(1, 4)))
+    if roll < 0.04:
+        return f"{rng.randint(1, 99)} {words}"
+    if roll < 0.06:
+        return f"({words})"
+    return words.capitalize() if rng.random() < 0.5 else rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") + words
+
+
+def write_song(path, fmt, title, artist, album, seconds):
+    """Writes a small but valid tagged audio file."""
+    if fmt == "mp3":
+        with open(path, "wb") as f:
+            f.write(MP3_FRAME * 4)
+        tags = ID3()
+        tags.add(TIT2(encoding=3, text=title))
+        tags.add(TPE1(encoding=3, text=artist))
+        tags.add(TALB(encoding=3, text=album))
+        tags.save(path)
+        return
+    if fmt == "wav":
+        with open(path, "wb") as f:
+            f.write(wav_bytes(title, artist, album))
+        return
+    with open(path, "wb") as f:
+        f.write(flac_bytes(seconds) if fmt == "flac" else ogg_vorbis_bytes(seconds))
+    audio = FLAC(path) if fmt == "flac" else OggVorbis(path)
+    audio["title"] = title
+    audio["artist"] = artist
+    audio["album"] = album
+    audio.save()
+
+
+def make_library(root, size, formats=FORMATS, seed=1):
+    """Creates (or reuses) a synthetic library of size songs below root/<size>-<formats>."""
+    library = os.path.join(root, f"{size}-{'-'.join(formats)}")
+    marker = os.path.join(library, ".complete")
+    if os.path.exists(marker):
+        return library
+    rng = random.Random(seed)
+    artists = [f"Artist {i:04d}" for i in range(max(1, size // 40))]
+    print(f"Generating {size} songs in {library} ...")
+    for i in range(size):
+        artist = rng.choice(artists)
+        album = f"Album {rng.randint(1, 4)}"
+        folder = os.path.join(library, artist, album)
+        os.makedirs(folder, exist_ok=True)
+        fmt = formats[i % len(formats)]
+        write_song(os.path.join(folder, f"{i:06d}.{fmt}"), fmt, random_title(rng), artist, album, rng.randint(90, 400))
+    with open(marker, "w") as f:
+        f.write(str(size))
+    return library
+
+
+# --- Benchmarks ---
+
+LOGICAL_TO_PHYSICAL = {"right": "up", "left": "down", "up": "left", "down": "right", "middle": "middle"}
+
+
+def press(direction):
+    """A joystick press in logical (rotated) terms."""
+    return FakeInputEvent(LOGICAL_TO_PHYSICAL[direction])
+
+
+def drain_display():
+    """Throws away the queued display jobs (the display thread is not running here)."""
+    while True:
+        try:
+            shrimp.display_queue.get_nowait()
+        except queue.Empty:
+            return
+
+
+def summarize(samples):
+    """Milliseconds statistics for a list of durations in seconds."""
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def bench_scan(library, cache_path, cold):
+    """Time of a complete scan_music_directory() run, with an empty or a filled metadata cache."""
+    shrimp.close_metadata_cache()
+    if cold and os.path.exists(cache_path):
+        os.remove(cache_path)
+    shrimp.reset_library_state()
+    shrimp.metadata_cache.clear()
+    shrimp.metadata_validated.clear()
+    shrimp.open_metadata_cache(cache_path)
+    return timed(shrimp.scan_music_directory, library)
+
+
+def bench_tag_readers(library):
+    """Reading every file's tags with the header-only reader and with mutagen (page-cached second pass of each)."""
+    paths = list(shrimp.iter_music_files(library))
+    timings, values = {}, {}
+    for name, reader in (("fast", shrimp.read_track_metadata), ("mutagen", shrimp.read_track_metadata_mutagen)):
+        for _ in range(2):
+            start = time.perf_counter()
+            values[name] = [reader(path) for path in paths]
+            timings[name] = time.perf_counter() - start
+    # The mutagen path only reads MP3 and FLAC tags, so those are the ones that can be compared
+    mismatches = sum(1 for path, fast, slow in zip(paths, values["fast"], values["mutagen"])
+                     if path.endswith((".mp3", ".flac")) and
+                     ([fast[key] for key in ("title", "artist", "album")] != [slow[key] for key in ("title", "artist", "album")]
+                      or abs(fast["duration"] - slow["duration"]) > 0.05))
+    return {"files": len(paths), "tags_fast_s": timings["fast"], "tags_mutagen_s": timings["mutagen"],
+            "speedup": timings["mutagen"] / timings["fast"] if timings["fast"] else 0.0, "mismatches": mismatches}
+
+
+def bench_snapshot_start(library):
+    """Launch to the first play_track() from the library snapshot the scan wrote."""
+    shrimp.reset_library_state()
+    start = time.perf_counter()
+    shrimp.load_library_snapshot(library)
+    shrimp.play_next_song()
+    return time.perf_counter() - start
+
+
+def bench_char_filter(rounds):
+    """Selecting each character in MODE_SONG_SELECT_CHAR."""
+    samples = []
+    for _ in range(rounds):
+        for index in range(len(shrimp.CHAR_LIST)):
+            shrimp.current_mode = shrimp.MODE_SONG_SELECT_CHAR
+            shrimp.current_char_index = index
+            samples.append(timed(shrimp.handle_song_select_char_input, press("middle")))
+            drain_display()
+    return summarize(samples)
+
+
+def bench_title_navigation(steps):
+    """Stepping through the largest character bucket in MODE_SONG_SELECT_TITLE."""
+    largest = max(shrimp.CHAR_LIST, key=shrimp.char_bucket_count)
+    shrimp.current_mode = shrimp.MODE_SONG_SELECT_CHAR
+    shrimp.current_char_index = shrimp.CHAR_LIST.index(largest)
+    shrimp.handle_song_select_char_input(press("middle"))
+    samples = []
+    for step in range(steps):
+        samples.append(timed(shrimp.handle_song_select_title_input, press("down" if step % 4 else "left")))
+        drain_display()
+    return summarize(samples)
+
+
+def bench_play_track(count, rng):
+    """Starting playback of random songs."""
+    samples = []
+    for _ in range(count):
+        samples.append(timed(shrimp.play_track, rng.choice(shrimp.all_music_files)))
+        drain_display()
+    return summarize(samples)
+
+
+def bench_shuffle(steps):
+    """Moving through the shuffle engine: next, previous and play-now, without playback."""
+    shrimp.reset_shuffle()
+    samples = []
+    for step in range(steps):
+        if step % 4 == 3:
+            samples.append(timed(shrimp.previous_song))
+        elif step % 8 == 5:
+            samples.append(timed(shrimp.play_song_now, shrimp.all_music_files[step % len(shrimp.all_music_files)]))
+        else:
+            samples.append(timed(shrimp.next_song))
+    return summarize(samples)
+
+
+def bench_main_loop(cycles):
+    """One main-loop iteration each for a joystick press and an expired display timer."""
+    shrimp.current_mode = shrimp.MODE_PLAYING_NOW
+    samples = []
+    for cycle in range(cycles):
+        if cycle % 2:
+            samples.append(timed(shrimp.handle_main_event, shrimp.EVENT_JOYSTICK, press("up" if cycle % 4 == 1 else "down")))
+        else:
+            samples.append(timed(shrimp.handle_main_event, None, None))
+        drain_display()
+    return summarize(samples)
+
+
+def run_size(library, size, work_dir, args):
+    cache_path = os.path.join(work_dir, f"metadata-{size}.db")
+    rng = random.Random(size)
+    result = {"size": size}
+    shrimp.LIBRARY_SNAPSHOT_PATH = os.path.join(work_dir, f"library-{size}.snapshot")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result["scan_cold_s"] = bench_scan(library, cache_path, cold=True)
+        result["scan_warm_s"] = bench_scan(library, cache_path, cold=False)
+        result["tag_readers"] = bench_tag_readers(library)
+        result["snapshot_start_ms"] = bench_snapshot_start(library) * 1000
+        shrimp.library_ready_announced = True
+        result["char_filter"] = bench_char_filter(args.repeat)
+        result["title_navigation"] = bench_title_navigation(args.steps)
+        result["play_track"] = bench_play_track(args.steps, rng)
+        result["shuffle_step"] = bench_shuffle(args.steps)
+        result["main_loop_cycle"] = bench_main_loop(args.steps)
+    shrimp.close_metadata_cache()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SHRIMP hot paths without a Sense HAT or VLC.")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated library sizes")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="comma separated formats to generate")
+    parser.add_argument("--library-dir", default=os.path.join(tempfile.gettempdir(), "shrimp-bench"),
+                        help="where synthetic libraries are generated and reused")
+    parser.add_argument("--repeat", type=int, default=3, help="rounds over CHAR_LIST for character filtering")
+    parser.add_argument("--steps", type=int, default=200, help="iterations of the per-event benchmarks")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    formats = tuple(fmt.strip() for fmt in args.formats.split(",") if fmt.strip())
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    shrimp.init_backends(display=FakeDisplay(), player_instance=FakeVlcInstance())
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in sizes:
+            library = make_library(args.library_dir, size, formats)
+            result = run_size(library, size, work_dir, args)
+            print(f"{size:>7} songs: scan cold {result['scan_cold_s']:.2f}s, warm {result['scan_warm_s']:.2f}s, "
+                  f"tags {result['tag_readers']['speedup']:.1f}x faster than mutagen "
+                  f"({result['tag_readers']['mismatches']} mismatches), "
+                  f"snapshot start {result['snapshot_start_ms']:.1f}ms, "
+                  f"char filter p50 {result['char_filter']['p50_ms']:.2f}ms, "
+                  f"title step p50 {result['title_navigation']['p50_ms']:.2f}ms, "
+                  f"play_track p50 {result['play_track']['p50_ms']:.2f}ms, "
+                  f"shuffle step p50 {result['shuffle_step']['p50_ms']:.3f}ms, "
+                  f"loop cycle p50 {result['main_loop_cycle']['p50_ms']:.3f}ms")
+            results.append(result)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "formats": formats,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,28 @@
-from sense_hat import SenseHat
-from time import sleep
+"""Clears the Sense HAT LEDs, or benchmarks the ways of drawing on them.
+
+    python3 cleaner.py                                    # clean the LED matrix
+    python3 cleaner.py --benchmark --backend emu          # benchmark against the Sense HAT emulator
+    python3 cleaner.py --benchmark --backend file --output led_results.json
 
-sense = SenseHat()
-sense.set_rotation(270)
+The benchmark measures frames per second and per-frame latency of set_pixel (one call per
+pixel), set_pixels, show_letter, show_message at the scroll speeds shrimp.py uses, and of
+whole frames written straight into the framebuffer through mmap, the way shrimp.py does.
+The "file" backend runs the Sense HAT drawing code against a plain file standing in for
+the LED framebuffer, so it needs no Sense HAT. Off the Pi, sense_hat cannot be imported
+(it needs the RTIMU module), so the backend then uses the emulator's copy of the same
+code: the sense-emu package must be installed, but the emulator need not be running.
+"""
+import argparse
+import json
+import mmap
+import os
+import platform
+import statistics
+import struct
+import sys
+import tempfile
+import time
+from time import sleep
 
 r = (255, 0, 6)
 b = (0, 0, 255)
@@ -55,22 +75,210 @@ four_pixels = [
     r, r, r, r, r, r, r, r,
 ]
 
-sense.set_pixels(one_pixels)
-sleep(0.05)
-sense.set_pixels(two_pixels)
-sleep(0.05)
-sense.set_pixels(three_pixels)
-sleep(0.05)
-sense.set_pixels(four_pixels)
-sleep(0.05)
-sense.show_message("All clean!")
-sleep(0.05)
-sense.set_pixels(four_pixels)
-sleep(0.05)
-sense.set_pixels(three_pixels)
-sleep(0.05)
-sense.set_pixels(two_pixels)
-sleep(0.05)
-sense.set_pixels(one_pixels)
-sleep(0.05)
-sense.clear()
\ No newline at end of file
+CLEANING_FRAMES = [one_pixels, two_pixels, three_pixels, four_pixels]
+SCROLL_SPEEDS = (0.04, 0.05, 0.08) # The scroll speeds shrimp.py uses
+LETTERS = "#1ABCDEFGHIJKLMNOPQRSTUVWXYZ" # shrimp.py's CHAR_LIST
+FRAMEBUFFER_BYTES = 128            # 8x8 pixels of RGB565
+
+
+def clean(sense):
+    """Wipes the matrix with the cleaning animation and leaves it dark."""
+    for pixels in CLEANING_FRAMES:
+        sense.set_pixels(pixels)
+        sleep(0.05)
+    sense.show_message("All clean!")
+    sleep(0.05)
+    for pixels in reversed(CLEANING_FRAMES):
+        sense.set_pixels(pixels)
+        sleep(0.05)
+    sense.clear()
+
+
+# --- Backends ---
+
+def file_sense_hat(path):
+    """The sense_hat (or sense_emu) drawing code aimed at a plain file instead of the LED framebuffer.
+
+    SenseHat.__init__ would look for the hardware (or the emulator), so this sets up the
+    private attributes the drawing methods use itself; it follows sense_hat 2.x.
+    """
+    try:
+        from sense_hat import SenseHat
+    except ImportError: # Off the Pi, without RTIMU; the emulator's SenseHat draws the same way
+        from sense_emu import SenseHat
+    import numpy as np # A sense_hat dependency
+
+    with open(path, "wb") as f:
+        f.write(bytes(FRAMEBUFFER_BYTES))
+    hat = SenseHat.__new__(SenseHat)
+    hat._fb_device = path
+    hat._pix_map = {}
+    pix_map = np.arange(64).reshape(8, 8)
+    for rotation in (0, 90, 180, 270):
+        hat._pix_map[rotation] = pix_map
+        pix_map = np.rot90(pix_map)
+    hat._rotation = 0
+    assets = os.path.join(os.path.dirname(sys.modules[SenseHat.__module__].__file__), "sense_hat_text")
+    hat._load_text_assets(assets + ".png", assets + ".txt")
+    return hat
+
+
+def open_backend(name, framebuffer):
+    """A SenseHat for the hat, emu or file backend, and the framebuffer (file) it draws into."""
+    if name == "hat":
+        from sense_hat import SenseHat
+        sense = SenseHat()
+    elif name == "emu":
+        from sense_emu import SenseHat
+        sense = SenseHat()
+    else:
+        sense = file_sense_hat(framebuffer)
+    return sense, sense._fb_device
+
+
+# --- Benchmarks ---
+
+def summarize(samples, total):
+    """Frames per second and per-frame milliseconds for a list of frame durations in seconds."""
+    ordered = sorted(samples)
+    return {
+        "frames": len(ordered),
+        "fps": len(ordered) / total if total else 0.0,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def time_frames(draw_frame, frames):
+    """Calls draw_frame(index) for every frame, timing each."""
+    samples = []
+    start = time.perf_counter()
+    for index in range(frames):
+        frame_start = time.perf_counter()
+        draw_frame(index)
+        samples.append(time.perf_counter() - frame_start)
+    return summarize(samples, time.perf_counter() - start)
+
+
+def bench_set_pixel(sense, frames):
+    """Whole frames drawn one set_pixel() call per pixel (like shrimp.py's startup animation used to)."""
+    def draw_frame(index):
+        pixels = CLEANING_FRAMES[index % len(CLEANING_FRAMES)]
+        for position, colour in enumerate(pixels):
+            sense.set_pixel(position % 8, position // 8, colour)
+    return time_frames(draw_frame, frames)
+
+
+def bench_set_pixels(sense, frames):
+    """Whole frames drawn with one set_pixels() call each."""
+    return time_frames(lambda index: sense.set_pixels(CLEANING_FRAMES[index % len(CLEANING_FRAMES)]), frames)
+
+
+def bench_show_letter(sense, frames):
+    """The character selection: one show_letter() call per frame."""
+    return time_frames(lambda index: sense.show_letter(LETTERS[index % len(LETTERS)], text_colour=(255, 165, 0)), frames)
+
+
+def scroll_frame_count(sense, text):
+    """Frames show_message() draws for text (each character is followed by a blank column,
+    and the text scrolls in from and out to a blank screen)."""
+    columns = sum(len(sense._trim_whitespace(sense._get_char_pixels(char))) // 8 + 1 for char in text)
+    return columns + 8
+
+
+def bench_show_message(sense, text, scroll_speed):
+    """A show_message() scroll: the frame rate it reaches against the one scroll_speed asks for."""
+    frames = scroll_frame_count(sense, text)
+    start = time.perf_counter()
+    sense.show_message(text, scroll_speed=scroll_speed)
+    total = time.perf_counter() - start
+    return {
+        "scroll_speed": scroll_speed,
+        "frames": frames,
+        "fps": frames / total,
+        "target_fps": 1 / scroll_speed if scroll_speed else None,
+        "overhead_ms": (total / frames - scroll_speed) * 1000, # Drawing time per frame on top of the sleep
+    }
+
+
+def pack_frame(pixels):
+    """RGB565 bytes of a frame, in framebuffer order (rotation 0)."""
+    return struct.pack("64H", *(((red >> 3) << 11) | ((green >> 2) << 5) | (blue >> 3) for red, green, blue in pixels))
+
+
+def bench_framebuffer(framebuffer, frames):
+    """Whole frames copied straight into the mmap'ed framebuffer, as shrimp.py's LED output writes them."""
+    packed = [pack_frame(pixels) for pixels in CLEANING_FRAMES]
+    fd = os.open(framebuffer, os.O_RDWR)
+    try:
+        screen = mmap.mmap(fd, FRAMEBUFFER_BYTES)
+    finally:
+        os.close(fd)
+    try:
+        def draw_frame(index):
+            screen[:FRAMEBUFFER_BYTES] = packed[index % len(packed)]
+        return time_frames(draw_frame, frames)
+    finally:
+        screen.close()
+
+
+def run_benchmarks(sense, framebuffer, frames, message):
+    results = {
+        "set_pixel": bench_set_pixel(sense, max(1, frames // 10)), # 64 calls a frame: fewer frames
+        "set_pixels": bench_set_pixels(sense, frames),
+        "show_letter": bench_show_letter(sense, frames),
+        "show_message": [bench_show_message(sense, message, speed) for speed in (0,) + SCROLL_SPEEDS],
+        "framebuffer": bench_framebuffer(framebuffer, frames),
+    }
+    sense.clear()
+    return results
+
+
+def print_results(results):
+    for name in ("set_pixel", "set_pixels", "show_letter", "framebuffer"):
+        result = results[name]
+        print(f"{name:>14}: {result['fps']:10.1f} fps, frame p50 {result['p50_ms']:.3f} ms, "
+              f"p95 {result['p95_ms']:.3f} ms, max {result['max_ms']:.3f} ms")
+    for result in results["show_message"]:
+        target = f"{result['target_fps']:.1f}" if result["target_fps"] else "max"
+        print(f"{'show_message':>14}: {result['fps']:10.1f} fps at scroll_speed {result['scroll_speed']} "
+              f"(asks for {target}), {result['overhead_ms']:.3f} ms drawing per frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clears the Sense HAT LEDs, or benchmarks the ways of drawing on them.")
+    parser.add_argument("--benchmark", action="store_true", help="measure LED output speed instead of cleaning")
+    parser.add_argument("--backend", choices=("hat", "emu", "file"), default="hat",
+                        help="Sense HAT, Sense HAT emulator, or a file standing in for the framebuffer")
+    parser.add_argument("--framebuffer", default=os.path.join(tempfile.gettempdir(), "shrimp-led.fb"),
+                        help="file used as the framebuffer by the file backend")
+    parser.add_argument("--frames", type=int, default=200, help="frames drawn per benchmark")
+    parser.add_argument("--message", default="SHRIMP", help="text scrolled by the show_message benchmarks")
+    parser.add_argument("--output", help="JSON file the benchmark results are written to")
+    args = parser.parse_args()
+
+    sense, framebuffer = open_backend(args.backend, args.framebuffer)
+    sense.set_rotation(270)
+    if not args.benchmark:
+        clean(sense)
+        return
+
+    results = run_benchmarks(sense, framebuffer, args.frames, args.message)
+    print_results(results)
+    if args.output:
+        report = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "backend": args.backend,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,41 @@
 import os
 import time
+import math
 import random
+import bisect
+import sqlite3
+import threading
+import queue
+import itertools
+import collections
+from array import array
 import vlc
-from sense_hat import SenseHat, stick
+import mutagen
 from mutagen.mp3 import MP3
 from mutagen.flac import FLAC
 import sys
-
-sense = SenseHat()
-sense.set_rotation(270)
-sense.clear()
+import signal
+import contextlib
+import atexit
+import logging
+import logging.handlers
+import struct
+import mmap
+import io
+import zlib
+import ctypes
+import ctypes.util
+import multiprocessing
+import argparse
+import shutil
+import subprocess
+import wave
+import operator
+import asyncio
+import json
+import stat
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait, Future
 
 # colours
 C_WHITE = (255, 255, 255)
@@ -20,24 +46,36 @@ C_BLUE = (0, 0, 255)
 C_YELLOW = (255, 255, 0)
 C_ORANGE = (255, 165, 0)
 C_CYAN = (0, 255, 255)
+C_MAGENTA = (255, 0, 255)
 
 # configuration
 MUSIC_DIR = "/home/[your_username_here]/Music" # <--- IMPORTANT: SET YOUR ACTUAL MUSIC FOLDER PATH
 DEFAULT_VOLUME = 70              # Default volume percentage (0-100)
 DISPLAY_IDLE_INTERVAL = 60       # Show song title every X seconds in Playing Now mode
-sense.low_light = True           # Level of brightness (True: Low / False: High)
+LOW_LIGHT = True                 # Level of brightness (True: Low / False: High)
+SCAN_WORKERS = 4                 # Processes reading tags during a library scan (1: read in-process)
+REPLAY_GAIN = True               # Level songs by the loudness measured with `shrimp.py --analyze`
+MAX_TRACK_GAIN = 12.0            # dB a song is raised or lowered by at most
+METADATA_CACHE_PATH = os.path.join(os.path.dirname(os.path.normpath(MUSIC_DIR)), ".shrimp_metadata.db") # Persistent tag cache, kept next to MUSIC_DIR
+LIBRARY_SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.normpath(MUSIC_DIR)), ".shrimp_library.snapshot") # Library saved for a fast start
+SESSION_STATE_PATH = os.path.join(os.path.dirname(os.path.normpath(MUSIC_DIR)), ".shrimp_session") # Song, position and queue to resume
+CONTROL_SOCKET_PATH = os.path.join(os.path.dirname(os.path.normpath(MUSIC_DIR)), ".shrimp_control.sock") # Unix socket taking commands (None: off)
+STATS_FILE = None                # Write timing stats to this file every STATS_INTERVAL seconds (None: only on SIGUSR1)
+STATS_INTERVAL = 60
+LOG_LEVEL = "INFO"               # "DEBUG" also logs every joystick event and display update
 
 # global variables
-all_music_files = []      # List of all discovered music file paths (sorted for filtering)
-current_playlist = []     # The currently active playlist (always shuffled for this version)
-current_track_index = -1  # Index of the current song in current_playlist
-current_track_metadata = {'title': 'N/A', 'artist': 'N/A', 'album': 'N/A'}
+all_music_files = array('I')   # Track IDs of all discovered music files (sorted by file name for filtering)
+current_track_metadata = {'title': 'N/A', 'artist': 'N/A', 'album': 'N/A', 'duration': 0.0}
 
 # player mode states
 MODE_STARTUP = "STARTUP"
 MODE_PLAYING_NOW = "PLAYING_NOW"
 MODE_SONG_SELECT_CHAR = "SONG_SELECT_CHAR"
 MODE_SONG_SELECT_TITLE = "SONG_SELECT_TITLE"
+MODE_SONG_SELECT_PREFIX = "SONG_SELECT_PREFIX"
+MODE_BROWSE_ARTIST = "BROWSE_ARTIST"
+MODE_BROWSE_ALBUM = "BROWSE_ALBUM"
 
 current_mode = MODE_STARTUP # Initial mode
 
@@ -47,163 +85,2526 @@ PLAYER_PAUSED = "PAUSED"
 PLAYER_STOPPED = "STOPPED"
 player_state = PLAYER_STOPPED
 
-# vlc player instance
-instance = vlc.Instance('--quiet')
-vlc_player = instance.media_player_new()
-vlc_player.audio_set_volume(DEFAULT_VOLUME)
+# hardware backends, created by init_backends()
+sense = None        # Sense HAT (LED matrix and joystick)
+instance = None     # vlc instance
+vlc_player = None
+list_player = None  # Plays the queued songs back to back on vlc_player
+
+def init_backends(display=None, player_instance=None):
+    """Sets up the Sense HAT and VLC. Benchmarks and tests can pass stand-ins for either."""
+    global sense, instance, vlc_player, list_player
+    on_device = display is None
+    if on_device:
+        from sense_hat import SenseHat # Only needed on the device itself
+        display = SenseHat()
+    sense = display
+    sense.set_rotation(270)
+    sense.clear()
+    sense.low_light = LOW_LIGHT
+    init_led_output(use_framebuffer=on_device)
+
+    instance = player_instance if player_instance is not None else vlc.Instance('--quiet')
+    vlc_player = instance.media_player_new()
+    vlc_player.audio_set_volume(DEFAULT_VOLUME)
+    list_player = instance.media_list_player_new()
+    list_player.set_media_player(vlc_player)
+
+# --- Logging ---
+# Log records are put on a queue and written out by a listener thread, so neither the main
+# loop nor the display thread ever wait for stdout (or journald behind it).
+log = logging.getLogger("shrimp")
+scan_log = logging.getLogger("shrimp.scan")       # Library scan, metadata cache and watcher
+player_log = logging.getLogger("shrimp.player")   # Playback, gapless queue and read-ahead
+display_log = logging.getLogger("shrimp.display") # LED output
+input_log = logging.getLogger("shrimp.input")     # Joystick and menus
+control_log = logging.getLogger("shrimp.control") # Control socket
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+log_listener = None # logging.handlers.QueueListener writing the queued records
+
+def setup_logging(level=None):
+    """Routes the shrimp loggers through a queue to a writer thread (level defaults to LOG_LEVEL)."""
+    global log_listener
+    if log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_listener = logging.handlers.QueueListener(log_queue, output)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level or LOG_LEVEL)
+    log.propagate = False
+    log_listener.start()
+    atexit.register(log_listener.stop) # Writes out what is still queued on exit
+
+def log_directly():
+    """Writes log records straight to stdout; for forked worker processes, which have no listener thread."""
+    for handler in log.handlers[:]:
+        log.removeHandler(handler)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    log.addHandler(output)
+
+# --- Instrumentation ---
+# Counters and timers around the hot paths, cheap enough to stay on. Each timer keeps its
+# most recent STATS_SAMPLES durations (time.perf_counter, so monotonic); "kill -USR1 <pid>"
+# prints counts and percentiles, and with STATS_FILE set they are also written periodically.
+STATS_SAMPLES = 1000 # Recent samples kept per timer
+
+stats_counters = collections.Counter()
+stats_timings = collections.defaultdict(lambda: collections.deque(maxlen=STATS_SAMPLES)) # name -> recent seconds
+stats_lock = threading.Lock()
+stats_dump_requested = threading.Event()
+stats_started = time.monotonic()
+
+def stats_count(name, amount=1):
+    """Adds to a counter."""
+    with stats_lock:
+        stats_counters[name] += amount
+
+def stats_timing(name, seconds):
+    """Records one duration of a timer."""
+    with stats_lock:
+        stats_timings[name].append(seconds)
+
+@contextlib.contextmanager
+def stats_timer(name):
+    """Times the body of a with statement."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats_timing(name, time.perf_counter() - start)
+
+def percentile(sorted_samples, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    return sorted_samples[min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))]
+
+def format_stats():
+    """Counters and timer percentiles (in milliseconds) as text."""
+    with stats_lock:
+        counters = sorted(stats_counters.items())
+        timings = sorted((name, sorted(samples)) for name, samples in stats_timings.items() if samples)
+    lines = [f"SHRIMP stats after {time.monotonic() - stats_started:.0f}s"]
+    for name, value in counters:
+        lines.append(f"  {name:<24} {value}")
+    for name, samples in timings:
+        lines.append(f"  {name:<24} n={len(samples):<5} p50={percentile(samples, 0.5) * 1000:.2f}ms "
+                     f"p90={percentile(samples, 0.9) * 1000:.2f}ms p99={percentile(samples, 0.99) * 1000:.2f}ms "
+                     f"max={samples[-1] * 1000:.2f}ms")
+    return "\n".join(lines) + "\n"
+
+def stats_summary():
+    """Counters and timer percentiles (in milliseconds) as a dictionary."""
+    with stats_lock:
+        counters = dict(stats_counters)
+        timings = sorted((name, sorted(samples)) for name, samples in stats_timings.items() if samples)
+    return {"uptime_s": round(time.monotonic() - stats_started), "counters": counters,
+            "timings": {name: {"n": len(samples), "p50_ms": percentile(samples, 0.5) * 1000,
+                               "p90_ms": percentile(samples, 0.9) * 1000, "p99_ms": percentile(samples, 0.99) * 1000,
+                               "max_ms": samples[-1] * 1000} for name, samples in timings}}
+
+def write_stats_file(path):
+    """Replaces the stats file in one step, so readers never see half of it."""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(format_stats())
+    os.replace(temp_path, path)
+
+def stats_reporter():
+    """Stats thread: prints the stats when asked to by SIGUSR1, and keeps STATS_FILE current."""
+    while True:
+        requested = stats_dump_requested.wait(STATS_INTERVAL if STATS_FILE else None)
+        stats_dump_requested.clear()
+        if requested:
+            log.info("%s", format_stats().rstrip())
+        if STATS_FILE:
+            try:
+                write_stats_file(STATS_FILE)
+            except OSError as e:
+                log.warning("Could not write stats to %s: %s", STATS_FILE, e)
+
+def start_stats_reporting():
+    """Starts the stats thread and hooks up SIGUSR1 (only possible from the main thread)."""
+    if threading.current_thread() is threading.main_thread():
+        # The handler only sets an event: it interrupts the main thread at an arbitrary
+        # point, where printing or taking a lock the main thread might hold is unsafe.
+        signal.signal(signal.SIGUSR1, lambda signum, frame: stats_dump_requested.set())
+    else:
+        log.warning("Not on the main thread, stats are not available on SIGUSR1.")
+    threading.Thread(target=stats_reporter, name="stats", daemon=True).start()
+
+# --- Display Engine ---
+# All LED output runs on one display thread. Callers queue jobs (lists of steps) and return
+# immediately; a job of higher priority preempts the one on screen, and interrupt_display()
+# discards everything queued so far, so a joystick press never waits for a scroll to finish.
+DISPLAY_PRIORITY_ALERT = 0     # Errors
+DISPLAY_PRIORITY_FEEDBACK = 1  # Responses to joystick input and player changes
+DISPLAY_PRIORITY_IDLE = 2      # Periodic title scroll, progress bar
+
+display_queue = queue.PriorityQueue()  # (priority, sequence, steps, done event)
+display_sequence = itertools.count()   # Keeps jobs of equal priority in submission order
+display_cancel = threading.Event()     # Set to abort the job currently on screen
+display_state_lock = threading.Lock()
+display_discard_before = 0             # Jobs queued before the last interrupt_display() are skipped
+display_current_priority = None        # Priority of the job on screen (None when idle)
+
+def show_on_display(steps, priority=DISPLAY_PRIORITY_FEEDBACK):
+    """Queues a display job and returns an Event that is set once it has been shown (or dropped).
+
+    Steps are tuples: ("clear",), ("letter", char, colour), ("pixel", x, y, colour),
+    ("pixels", pixel_list), ("scroll", text, text_colour, back_colour, scroll_speed)
+    and ("hold", seconds).
+    """
+    done = threading.Event()
+    with display_state_lock:
+        if display_current_priority is not None and priority < display_current_priority:
+            display_cancel.set() # Preempt the less important job on screen
+        display_queue.put((priority, next(display_sequence), steps, done))
+    return done
+
+def interrupt_display():
+    """Aborts whatever is on screen and drops all queued display jobs."""
+    global display_discard_before
+    with display_state_lock:
+        display_discard_before = next(display_sequence)
+        if display_current_priority is not None:
+            display_cancel.set()
+
+# Frames reach the LED matrix through a shadow buffer: drawing steps only change led_canvas,
+# and the finished frame is written in one go, straight into the Sense HAT framebuffer via
+# mmap when there is one. Frames the matrix already shows are skipped, and at most
+# LED_MAX_FPS are written per second. Frames are 64 RGB565 values in the framebuffer's own
+# pixel order, so writing one is a single 128-byte copy.
+LED_MAX_FPS = 50
+LED_FRAMEBUFFER_NAME = "RPi-Sense FB" # Name the Sense HAT driver gives its framebuffer
+
+led_canvas = array('H', bytes(128)) # Frame being drawn
+led_shown = array('H', bytes(128))  # Frame on the matrix
+led_blank = array('H', bytes(128))
+led_device = None       # mmap (or file descriptor) of the LED framebuffer; None: frames go through sense.set_pixels()
+led_rotation = 0        # Rotation frames are drawn for (as set on the Sense HAT)
+led_next_frame_at = 0.0 # time.monotonic() before which no further frame is written
+led_pixel_maps = {}     # rotation -> framebuffer index of each pixel, in set_pixels() order
+led_colours = {}        # (r, g, b) -> RGB565
+led_letters = {}        # (char, colour) -> show_letter() pixels as RGB565
+
+def rgb565(colour):
+    """Packs an (r, g, b) colour the way the Sense HAT framebuffer stores it."""
+    colour = tuple(colour)
+    value = led_colours.get(colour)
+    if value is None:
+        value = led_colours[colour] = ((colour[0] >> 3) << 11) | ((colour[1] >> 2) << 5) | (colour[2] >> 3)
+    return value
+
+def led_pixel_map(rotation):
+    """Framebuffer index of each pixel in set_pixels() order, mapped as the sense_hat library does."""
+    pixel_map = led_pixel_maps.get(rotation)
+    if pixel_map is None:
+        grid = [list(range(row * 8, row * 8 + 8)) for row in range(8)]
+        for _ in range(rotation // 90):
+            grid = [list(row) for row in zip(*grid)][::-1] # Like numpy.rot90: a quarter turn anticlockwise
+        pixel_map = led_pixel_maps[rotation] = [index for row in grid for index in row]
+    return pixel_map
+
+def open_led_framebuffer():
+    """Maps the Sense HAT LED framebuffer (a file descriptor if it cannot be mapped, None if there is none)."""
+    try:
+        devices = sorted(os.listdir("/sys/class/graphics"))
+    except OSError:
+        return None
+    for device in devices:
+        try:
+            with open(os.path.join("/sys/class/graphics", device, "name")) as f:
+                if f.read().strip() != LED_FRAMEBUFFER_NAME:
+                    continue
+            fd = os.open(os.path.join("/dev", device), os.O_RDWR)
+        except OSError:
+            continue
+        try:
+            framebuffer = mmap.mmap(fd, 128)
+        except (OSError, ValueError) as e:
+            display_log.info("Cannot map %s (%s), writing whole frames instead.", device, e)
+            return fd
+        os.close(fd) # The mapping keeps the device open
+        return framebuffer
+    return None
+
+def init_led_output(use_framebuffer):
+    """Starts the LED output from a blank matrix; use_framebuffer writes to the device instead of sense.set_pixels()."""
+    global led_device, led_rotation
+    led_device = open_led_framebuffer() if use_framebuffer else None
+    display_log.info("LED output: %s", "framebuffer" if led_device is not None else "sense.set_pixels()")
+    led_rotation = sense.rotation
+    led_canvas[:] = led_blank
+    led_shown[:] = led_blank
+
+def led_present():
+    """Shows led_canvas with a single write, unless the matrix already shows it."""
+    global led_next_frame_at
+    if led_canvas == led_shown:
+        stats_count("display.frames_skipped")
+        return
+    delay = led_next_frame_at - time.monotonic()
+    if delay > 0 and display_cancel.wait(delay): # Frame rate cap
+        return
+    if isinstance(led_device, mmap.mmap):
+        led_device[:] = led_canvas.tobytes()
+    elif led_device is not None:
+        os.pwrite(led_device, led_canvas.tobytes(), 0)
+    else:
+        sense.set_pixels([((value >> 11) << 3, ((value >> 5) & 0x3F) << 2, (value & 0x1F) << 3)
+                          for value in map(led_canvas.__getitem__, led_pixel_map(led_rotation))])
+    led_shown[:] = led_canvas
+    led_next_frame_at = time.monotonic() + 1 / LED_MAX_FPS
+    stats_count("display.frames")
+
+def led_draw(values, rotation=None):
+    """Draws 64 RGB565 values given in set_pixels() order."""
+    for index, value in zip(led_pixel_map(led_rotation if rotation is None else rotation), values):
+        led_canvas[index] = value
+
+def led_letter(char, colour):
+    """A character as show_letter() draws it, as RGB565 values (drawn a quarter turn back)."""
+    key = (char, tuple(colour))
+    letter = led_letters.get(key)
+    if letter is None:
+        fore = rgb565(colour)
+        letter = led_letters[key] = array('H', [0] * 8 + [fore if pixel == [255, 255, 255] else 0
+                                                          for pixel in sense._get_char_pixels(char)] + [0] * 16)
+    return letter
+
+# Scroll text is rasterised once per (text, colours) into a strip of 8-pixel columns stored as
+# RGB565 values; scrolling then only slides a 64-pixel window over the cached strip.
+TEXT_CACHE_MAX_BYTES = 256 * 1024 # Memory cap of the pre-rendered text cache (LRU)
+
+text_strip_cache = collections.OrderedDict() # (text, text_colour, back_colour) -> RGB column strip
+text_strip_cache_bytes = 0
+
+def render_text_strip(text, text_colour, back_colour):
+    """Returns the scroll strip for text, rendering and caching it on first use."""
+    global text_strip_cache_bytes
+    key = (text, tuple(text_colour), tuple(back_colour))
+    strip = text_strip_cache.get(key)
+    if strip is not None:
+        text_strip_cache.move_to_end(key)
+        return strip
+
+    # Same glyphs as SenseHat.show_message: a blank screen, each character followed by a
+    # blank column, then another blank screen so the text scrolls fully out
+    fore, back = rgb565(text_colour), rgb565(back_colour)
+    strip = array('H', [back] * 64)
+    for char in text:
+        strip.extend(fore if pixel == [255, 255, 255] else back
+                     for pixel in sense._trim_whitespace(sense._get_char_pixels(char)))
+        strip.extend([back] * 8)
+    strip.extend([back] * 64)
+
+    text_strip_cache[key] = strip
+    text_strip_cache_bytes += len(strip) * strip.itemsize
+    while text_strip_cache_bytes > TEXT_CACHE_MAX_BYTES and len(text_strip_cache) > 1:
+        _, evicted = text_strip_cache.popitem(last=False)
+        text_strip_cache_bytes -= len(evicted) * evicted.itemsize
+    return strip
+
+def scroll_on_display(text, text_colour, back_colour, scroll_speed):
+    """Scrolls text across the matrix frame by frame, stopping as soon as the job is cancelled."""
+    strip = render_text_strip(text, text_colour, back_colour)
+    rotation = (led_rotation - 90) % 360 # The strip is laid out in columns
+    for start in range(0, len(strip) - 64, 8):
+        if display_cancel.is_set():
+            break
+        led_draw(strip[start:start + 64], rotation)
+        led_present()
+        display_cancel.wait(scroll_speed)
+
+def run_display_job(steps):
+    """Shows the steps of one job in order, returning early if it gets cancelled.
+
+    Drawing steps only change the canvas; it is shown before a hold and at the end of the job.
+    """
+    led_canvas[:] = led_shown # Whatever a cancelled job drew but never showed is dropped
+    for step in steps:
+        if display_cancel.is_set():
+            return
+        kind = step[0]
+        if kind == "clear":
+            led_canvas[:] = led_blank
+        elif kind == "letter":
+            led_draw(led_letter(step[1], step[2]), (led_rotation - 90) % 360)
+        elif kind == "pixel":
+            led_canvas[led_pixel_map(led_rotation)[step[2] * 8 + step[1]]] = rgb565(step[3])
+        elif kind == "pixels":
+            led_draw(map(rgb565, step[1]))
+        elif kind == "scroll":
+            scroll_on_display(*step[1:])
+        elif kind == "hold":
+            led_present()
+            display_cancel.wait(step[1])
+    if not display_cancel.is_set():
+        led_present()
+
+def display_worker():
+    """Display thread: shows queued jobs by priority."""
+    global display_current_priority
+    while True:
+        priority, sequence, steps, done = display_queue.get()
+        with display_state_lock:
+            if sequence < display_discard_before: # Interrupted before it got on screen
+                done.set()
+                continue
+            display_cancel.clear()
+            display_current_priority = priority
+        start = time.perf_counter()
+        try:
+            run_display_job(steps)
+        except Exception as e:
+            display_log.error("Display job failed: %s", e)
+        else:
+            stats_timing("display.job", time.perf_counter() - start) # How long the message held the display
+        finally:
+            with display_state_lock:
+                display_current_priority = None
+            done.set()
+
+def start_display_engine():
+    """Starts the display thread."""
+    threading.Thread(target=display_worker, name="display", daemon=True).start()
 
 # sense hat display helpers
 
-def clear_display():
+def clear_display(priority=DISPLAY_PRIORITY_FEEDBACK):
     """Clears the Sense HAT display."""
-    sense.clear()
-
-def scroll_text_blocking(message, text_colour=C_WHITE, back_colour=C_BLACK, scroll_speed=0.08):
-    """Scrolls a message across the Sense HAT. This function blocks execution."""
-    sense.show_message(message, text_colour=text_colour, back_colour=back_colour, scroll_speed=scroll_speed)
-    clear_display()
-
-def flash_message(message, text_color, duration_secs=1.5, scroll_speed=0.08):
-    """Flashes a message, then attempts to restore previous display (if applicable)."""
-    # This function uses blocking scroll_text_blocking, so duration_secs is approximate
-    # and it will clear the screen after the message.
-    scroll_text_blocking(message, text_colour=text_color, scroll_speed=scroll_speed)
+    global last_progress_pixels
+    show_on_display([("clear",)], priority)
+    last_progress_pixels = -1 # Anything drawn after this has to redraw the progress bar
+
+def scroll_text(message, text_colour=C_WHITE, back_colour=C_BLACK, scroll_speed=0.08, priority=DISPLAY_PRIORITY_FEEDBACK):
+    """Scrolls a message across the Sense HAT in the background, clearing it afterwards."""
+    global last_progress_pixels
+    last_progress_pixels = -1
+    return show_on_display([("scroll", message, text_colour, back_colour, scroll_speed), ("clear",)], priority)
+
+def scroll_text_blocking(message, text_colour=C_WHITE, back_colour=C_BLACK, scroll_speed=0.08, priority=DISPLAY_PRIORITY_FEEDBACK):
+    """Scrolls a message across the Sense HAT and waits until it has been shown."""
+    scroll_text(message, text_colour, back_colour, scroll_speed, priority).wait()
+
+def flash_message(message, text_color, duration_secs=1.5, scroll_speed=0.08, priority=DISPLAY_PRIORITY_FEEDBACK):
+    """Flashes a message without blocking; the screen is cleared after the message."""
+    # duration_secs is approximate: the message takes as long as it needs to scroll.
     # The main loop's idle display logic will eventually refresh for Playing Now mode.
+    scroll_text(message, text_colour=text_color, scroll_speed=scroll_speed, priority=priority)
 
 def animate_enter_from_left(char_or_text, text_color=C_WHITE):
     """Animates a character or short text entering from the left."""
     # This is a simplified animation for show_message
     if len(char_or_text) > 1: # For longer text, just scroll in
-        scroll_text_blocking(char_or_text, text_colour=text_color, scroll_speed=0.04)
+        scroll_text(char_or_text, text_colour=text_color, scroll_speed=0.04)
         return
 
     # For single character, simulate slide in
     # This is still a simplification, full pixel animation is more involved
+    steps = []
     for i in range(8): # From off-screen left to final position
-        sense.clear()
-        # Create a simple representation of the character at position 'i'
-        # This will need to be replaced with actual pixel data for real character animation
-        if i < 8: # Just show character once it's fully on screen or scrolling in
-            sense.show_letter(char_or_text, text_colour=text_color)
-        time.sleep(0.05)
-    sense.show_letter(char_or_text, text_colour=text_color)
-    time.sleep(0.5) # Hold briefly
-    clear_display()
+        steps += [("clear",), ("letter", char_or_text, text_color), ("hold", 0.05)]
+    steps += [("letter", char_or_text, text_color), ("hold", 0.5), ("clear",)] # Hold briefly
+    show_on_display(steps)
 
 def animate_slide_out_left(char_or_text, text_color=C_WHITE):
     """Animates a character or short text sliding out to the left."""
     # Simplified animation for show_message
     if len(char_or_text) > 1: # For longer text, just scroll out
-        scroll_text_blocking(char_or_text, text_colour=text_color, scroll_speed=0.08) # Will just scroll then clear
+        scroll_text(char_or_text, text_colour=text_color, scroll_speed=0.08) # Will just scroll then clear
         return
-    
-    sense.show_letter(char_or_text, text_colour=text_color)
-    time.sleep(0.2) # Show briefly
+
     # For a single letter, a scroll-out animation isn't directly supported by show_letter.
     # We'll just clear it after a short delay for simplicity.
-    time.sleep(0.5)
-    clear_display()
+    show_on_display([("letter", char_or_text, text_color), ("hold", 0.7), ("clear",)])
+
+
+last_progress_pixels = -1 # Number of lit pixels on the progress display
+
+def display_progress(done, total, colour=C_GREEN):
+    """Shows done/total as a bar filling the 8x8 matrix row by row."""
+    global last_progress_pixels
+    lit = 0 if total <= 0 else done * 64 // total
+    if lit == last_progress_pixels: # Only redraw when the bar actually grows
+        return
+    last_progress_pixels = lit
+    show_on_display([("pixels", [colour] * lit + [C_BLACK] * (64 - lit))], DISPLAY_PRIORITY_IDLE)
 
 
 # --- Startup Animation ---
 def startup_animation():
-    """A cool startup animation."""
+    """A cool startup animation (queued on the display, so it never holds up input)."""
     # Example: Simple growing square from center
     colors = [C_BLUE, C_GREEN, C_YELLOW, C_RED]
-    
+
+    steps = []
     for i in range(4): # Loop to grow the square
-        sense.clear()
+        steps.append(("clear",))
         for x_offset in range(-i, i + 1):
             for y_offset in range(-i, i + 1):
                 px, py = 3 + x_offset, 3 + y_offset
                 if 0 <= px < 8 and 0 <= py < 8:
-                    sense.set_pixel(px, py, *colors[i % len(colors)])
-        time.sleep(0.15)
-    sense.clear() # Clear after animation ends
-
-    scroll_text_blocking("SHRIMP", text_colour=C_GREEN, scroll_speed=0.05)
-    scroll_text_blocking("Sense HAT Really Incredible Music Player", text_colour=C_WHITE, scroll_speed=0.05)
-    scroll_text_blocking("LOADING...", text_colour=C_YELLOW, scroll_speed=0.05)
-
+                    steps.append(("pixel", px, py, colors[i % len(colors)]))
+        steps.append(("hold", 0.15))
+    steps.append(("clear",)) # Clear after animation ends
+
+    for text, colour in (("SHRIMP", C_GREEN), ("Sense HAT Really Incredible Music Player", C_WHITE), ("LOADING...", C_YELLOW)):
+        steps += [("scroll", text, colour, C_BLACK, 0.05), ("clear",)]
+    show_on_display(steps)
+
+
+# --- Track Table ---
+# Every song gets a small integer ID the first time it is seen. Its path is stored once, as
+# an interned folder plus a file name; playlists, filters and the character index are
+# array('I') rows of IDs, so they take 4 bytes per song and are searched as integers.
+# IDs stay assigned when a song is removed, so a file that comes back keeps its old ID.
+track_dirs = []           # folder ID -> folder path
+track_dir_ids = {}        # folder path -> folder ID
+track_dir_songs = []      # folder ID -> {file name: track ID}
+track_names = []          # track ID -> file name
+track_dir_of = array('I') # track ID -> folder ID
+track_sort_keys = []      # track ID -> lower-case title (set when the song is indexed)
+track_in_library = bytearray() # track ID -> 1 while the song is part of the library
+track_lookup_ready = True # False while the two path lookups above still have to be built from a snapshot
+library_id = random.getrandbits(64) # Names this numbering of track IDs (saved with the snapshot and the session)
+
+def get_track_id(path, create=True):
+    """Returns the ID of the song at path, assigning one if needed (None if it has none and create is False)."""
+    directory, name = os.path.split(path)
+    ensure_track_lookup()
+    with library_lock:
+        dir_id = track_dir_ids.get(directory)
+        if dir_id is None:
+            if not create:
+                return None
+            directory = sys.intern(directory)
+            dir_id = track_dir_ids[directory] = len(track_dirs)
+            track_dirs.append(directory)
+            track_dir_songs.append({})
+        track_id = track_dir_songs[dir_id].get(name)
+        if track_id is None and create:
+            track_id = track_dir_songs[dir_id][name] = len(track_names)
+            track_names.append(name)
+            track_dir_of.append(dir_id)
+            track_sort_keys.append("")
+            track_in_library.append(0)
+        return track_id
+
+def track_path(track_id):
+    """Full path of a song."""
+    return os.path.join(track_dirs[track_dir_of[track_id]], track_names[track_id])
+
+def get_track_metadata_by_id(track_id):
+    """get_track_metadata() for a track ID (served from the library snapshot while it is current)."""
+    metadata = snapshot_track_metadata(track_id)
+    return metadata if metadata is not None else get_track_metadata(track_path(track_id))
+
+def tracks_below(directory):
+    """IDs of the songs ever seen in a folder or its subfolders."""
+    prefix = os.path.join(directory, "")
+    ensure_track_lookup()
+    with library_lock:
+        return [track_id for dir_id, dir_path in enumerate(track_dirs) if dir_path == directory or dir_path.startswith(prefix)
+                for track_id in track_dir_songs[dir_id].values()]
+
+def find_sorted_position(track_ids, key, sort_key):
+    """Binary search in track IDs sorted by sort_key: the first position whose key is not below key."""
+    low, high = 0, len(track_ids)
+    while low < high:
+        middle = (low + high) // 2
+        if sort_key(track_ids[middle]) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def clear_track_table():
+    """Forgets every track ID (only safe once nothing refers to them any more)."""
+    global track_lookup_ready, library_id
+    with library_lock:
+        track_dirs.clear()
+        track_dir_ids.clear()
+        track_dir_songs.clear()
+        track_names.clear()
+        del track_dir_of[:]
+        track_sort_keys.clear()
+        del track_in_library[:]
+        track_lookup_ready = True
+        library_id = random.getrandbits(64) # IDs handed out from now on mean different songs
 
 # --- Music Management ---
+SUPPORTED_EXTENSIONS = ('.mp3', '.wav', '.ogg', '.flac')
+
+library_first_track = threading.Event() # Set once a playable file was found (or the scan found none)
+library_scan_done = threading.Event()   # Set once the background scan has finished
+scan_progress = (0, 0)                  # (songs with tags read, songs discovered) of the running scan
+
+def iter_music_files(path):
+    """Yields supported audio files below path as soon as they are found (depth-first, via os.scandir)."""
+    pending_dirs = [path]
+    while pending_dirs:
+        directory = pending_dirs.pop()
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.name.lower().endswith(SUPPORTED_EXTENSIONS): # Filter before any further stat
+                            yield entry.path
+                    except OSError as e:
+                        scan_log.warning("Skipping %s: %s", entry.path, e)
+        except OSError as e:
+            scan_log.warning("Could not scan %s: %s", directory, e)
+        pending_dirs.extend(sorted(subdirs, reverse=True)) # Visit subfolders in name order
+
+def add_discovered_song(track_id):
+    """Adds a newly found song to the library (and so to the songs still to be shuffled)."""
+    with library_lock:
+        if track_in_library[track_id]: # Added ahead of the scan (see resume_session)
+            return
+        all_music_files.append(track_id)
+        track_in_library[track_id] = 1
+    library_first_track.set()
+
 def scan_music_directory(path):
-    """Scans the music directory and populates all_music_files."""
-    global all_music_files, current_playlist
+    """Streams the music directory into the library.
 
-    all_music_files = []
-    print(f"Scanning music directory: {path}")
+    Songs can be shuffled in the moment they are found, so playback can start
+    before the walk finishes; they are filed into the character index once their tags are read.
+    """
+    scan_log.info("Scanning music directory: %s", path)
+    scan_start = time.perf_counter()
 
-    if not os.path.exists(path):
-        print(f"ERROR: Music directory '{path}' does NOT exist!")
-        flash_message("NO DIR!", text_color=C_RED, scroll_speed=0.05)
-        time.sleep(1)
-        sys.exit()
+    def discovered(song_path):
+        add_discovered_song(get_track_id(song_path))
+        return song_path
 
-    found_supported_audio = False
-    for root, _, files in os.walk(path):
-        for file in files:
-            file_lower = file.lower()
-            full_path = os.path.join(root, file)
-            if file_lower.endswith(('.mp3', '.wav', '.ogg', '.flac')):
-                all_music_files.append(full_path)
-                found_supported_audio = True
-
-    if not found_supported_audio:
-        print("ERROR: No supported audio files (.mp3, .flac, .wav, .ogg) found.")
-        flash_message("NO MUSIC!", text_color=C_RED, scroll_speed=0.05)
-        time.sleep(1)
-        sys.exit()
+    def tags_ready(song_path):
+        index_song(get_track_id(song_path))
+
+    def report_progress(done, seen):
+        global scan_progress
+        scan_progress = (done, seen)
 
-    all_music_files.sort(key=lambda x: os.path.basename(x).lower()) # Keep a sorted list for filtering consistency
-    current_playlist = list(all_music_files) # Initialize playlist with all scanned music
-    random.shuffle(current_playlist) # Shuffle the main playlist on startup
+    try:
+        extract_library_metadata((discovered(song_path) for song_path in iter_music_files(path)),
+                                 progress=report_progress, on_ready=tags_ready)
+        with library_lock:
+            all_music_files[:] = array('I', sorted(all_music_files, key=song_sort_name)) # Keep a sorted list for filtering consistency
+            existing_paths = {track_path(track_id) for track_id in all_music_files}
+        prune_metadata_cache(existing_paths) # Forget tags of files that have been removed
+        build_browse_index() # Ready before anyone browses by artist
+        write_library_snapshot(path) # The next start can skip this scan
+    finally:
+        library_scan_done.set()
+        library_first_track.set() # Wake up main() even if nothing was found
 
-    print(f"Found {len(all_music_files)} music files. Playlist shuffled.")
+    scan_seconds = time.perf_counter() - scan_start
+    stats_timing("scan", scan_seconds)
+    scan_log.info("Found %d music files in %.1fs.", len(all_music_files), scan_seconds)
     return all_music_files
 
-def get_track_metadata(filepath):
-    """Retrieves title, artist, album from audio file metadata."""
+def reset_library_state():
+    """Forgets the scanned library and its index, e.g. before scanning again from scratch."""
+    global scan_progress, library_snapshot
+    with library_lock:
+        library_snapshot = None
+        snapshot_stale_paths.clear()
+        del all_music_files[:]
+        reset_shuffle()
+        indexed_songs.clear()
+        for char in CHAR_LIST:
+            char_buckets[char] = array('I')
+        clear_track_table()
+    scan_progress = (0, 0)
+    library_first_track.clear()
+    library_scan_done.clear()
+
+def start_library_scan(path):
+    """Runs scan_music_directory on a background thread."""
+    def run_scan():
+        try:
+            scan_music_directory(path)
+        except Exception as e:
+            scan_log.exception("Library scan failed: %s", e)
+
+    threading.Thread(target=run_scan, name="library-scan", daemon=True).start()
+
+# --- Tag Reader ---
+# Reads only the tag headers: the ID3v2 frames of MP3s (or their ID3v1 tag), the STREAMINFO
+# and VORBIS_COMMENT blocks of FLAC, the Vorbis/Opus headers of Ogg files and the fmt and
+# LIST/INFO chunks of WAV files. Audio data and cover art are skipped with seeks and every
+# read is bounded, so a file costs a few small reads. Anything it cannot make sense of is
+# handed to mutagen instead.
+TAG_READ_LIMIT = 1024 * 1024 # Largest tag structure read (bigger ones are skipped or cut short)
+MP3_SYNC_SEARCH = 64 * 1024  # Bytes after the ID3 tag searched for the first MPEG frame
+OGG_TAIL_BYTES = 65536       # Enough to hold the last Ogg page, which has the stream length
+
+ID3_TEXT_FRAMES = {b"TIT2": 'title', b"TPE1": 'artist', b"TALB": 'album',
+                   b"TT2": 'title', b"TP1": 'artist', b"TAL": 'album'} # ID3v2.3/2.4 and ID3v2.2 frame IDs
+ID3_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+VORBIS_FIELDS = {"title": 'title', "artist": 'artist', "album": 'album'}
+WAV_INFO_FIELDS = {b"INAM": 'title', b"IART": 'artist', b"IPRD": 'album'}
+
+MP3_BITRATES = { # (MPEG-1, layer) -> kbit/s by bitrate index
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = (44100, 48000, 32000) # MPEG-1; halved for MPEG-2, quartered for MPEG-2.5
+
+def read_exact(f, count):
+    """Reads count bytes, failing on a truncated file."""
+    data = f.read(count)
+    if len(data) < count:
+        raise ValueError("file is truncated")
+    return data
+
+def synchsafe(data):
+    """Decodes a 4-byte ID3v2 synchsafe integer (7 bits per byte)."""
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+def decode_id3_text(data):
+    """Decodes an ID3 text frame (encoding byte, then NUL-separated strings) to its first string."""
+    if not data:
+        return ""
+    if data[0] >= len(ID3_ENCODINGS):
+        raise ValueError(f"unknown ID3 text encoding {data[0]}")
+    return data[1:].decode(ID3_ENCODINGS[data[0]], errors="replace").split("\0", 1)[0]
+
+def unpack_id3_frame(data, major, flags):
+    """Frame content with extra header bytes, unsynchronisation and compression undone (None if encrypted)."""
+    if major == 4:
+        if flags & 0x04:
+            return None
+        if flags & 0x40: # Group ID
+            data = data[1:]
+        if flags & 0x01: # Data length indicator
+            data = data[4:]
+        if flags & 0x02:
+            data = data.replace(b"\xff\x00", b"\xff")
+        if flags & 0x08:
+            data = zlib.decompress(data)
+    elif major == 3:
+        if flags & 0x40:
+            return None
+        if flags & 0x80: # Decompressed size
+            data = data[4:]
+        if flags & 0x20: # Group ID
+            data = data[1:]
+        if flags & 0x80:
+            data = zlib.decompress(data)
+    return data
+
+def read_id3_frames(f, position, end, major, unsynchronised):
+    """Reads the frames we use from an ID3v2 tag body, seeking past all others."""
+    tags = {}
+    header_size = 6 if major == 2 else 10
+    while position + header_size <= end and len(tags) < 3:
+        f.seek(position)
+        header = f.read(header_size)
+        if len(header) < header_size or header[0] == 0: # Padding
+            break
+        if major == 2:
+            frame_id, size, flags = header[:3], int.from_bytes(header[3:6], "big"), 0
+        else:
+            frame_id = header[:4]
+            size = synchsafe(header[4:8]) if major == 4 else int.from_bytes(header[4:8], "big")
+            flags = header[9] | (0x02 if unsynchronised else 0)
+        position += header_size
+        if position + size > end:
+            break
+        field = ID3_TEXT_FRAMES.get(frame_id)
+        if field and field not in tags and size <= TAG_READ_LIMIT:
+            data = unpack_id3_frame(read_exact(f, size), major, flags)
+            if data is not None:
+                tags[field] = decode_id3_text(data)
+        position += size
+    return tags
+
+def read_id3v2(f, start=0):
+    """Reads an ID3v2 tag at start: returns (tags, offset after the tag), or (None, start) without one."""
+    f.seek(start)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return None, start
+    major, flags, size = header[3], header[5], synchsafe(header[6:10])
+    end = start + 10 + size + (10 if flags & 0x10 else 0) # Footer
+    if major not in (2, 3, 4):
+        return {}, end
+    position, body_end = start + 10, start + 10 + size
+    if flags & 0x80 and major < 4: # The whole tag is unsynchronised: undo it in memory
+        if size > TAG_READ_LIMIT:
+            return {}, end
+        body = read_exact(f, size).replace(b"\xff\x00", b"\xff")
+        f, position, body_end = io.BytesIO(body), 0, len(body)
+    if flags & 0x40 and major > 2: # Extended header
+        f.seek(position)
+        extended = read_exact(f, 4)
+        position += synchsafe(extended) if major == 4 else 4 + int.from_bytes(extended, "big")
+    return read_id3_frames(f, position, body_end, major, major == 4 and flags & 0x80), end
+
+def read_id3v1(f, file_size):
+    """Reads an ID3v1 tag from the last 128 bytes (None without one)."""
+    if file_size < 128:
+        return None
+    f.seek(file_size - 128)
+    data = f.read(128)
+    if data[:3] != b"TAG":
+        return None
+    fields = (data[3:33], data[33:63], data[63:93])
+    values = [field.split(b"\0", 1)[0].decode("latin-1").strip() for field in fields]
+    return {key: value for key, value in zip(('title', 'artist', 'album'), values) if value}
+
+def read_mp3_duration(f, audio_start, audio_end):
+    """Length of an MPEG audio stream from its first frame: Xing/Info or VBRI frame count, else the CBR bitrate."""
+    f.seek(audio_start)
+    data = f.read(MP3_SYNC_SEARCH)
+    position = data.find(b"\xff")
+    while 0 <= position <= len(data) - 4:
+        header = int.from_bytes(data[position:position + 4], "big")
+        version, layer_bits = (header >> 19) & 3, (header >> 17) & 3
+        bitrate_index, rate_index = (header >> 12) & 15, (header >> 10) & 3
+        if header >> 21 == 0x7FF and version != 1 and layer_bits and bitrate_index not in (0, 15) and rate_index != 3:
+            break
+        position = data.find(b"\xff", position + 1)
+    else:
+        return 0.0
+    mpeg1, layer = version == 3, 4 - layer_bits
+    sample_rate = MP3_SAMPLE_RATES[rate_index] >> (0 if mpeg1 else 1 if version == 2 else 2)
+    samples_per_frame = 384 if layer == 1 else 1152 if layer == 2 or mpeg1 else 576
+    mono = (header >> 6) & 3 == 3
+    xing = position + 4 + ((17 if mono else 32) if mpeg1 else (9 if mono else 17)) # After the side info
+    frames = None
+    if data[xing:xing + 4] in (b"Xing", b"Info") and len(data) >= xing + 12 and data[xing + 7] & 1:
+        frames = int.from_bytes(data[xing + 8:xing + 12], "big")
+    elif data[position + 36:position + 40] == b"VBRI" and len(data) >= position + 54:
+        frames = int.from_bytes(data[position + 50:position + 54], "big")
+    if frames is not None:
+        return frames * samples_per_frame / sample_rate
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    return (audio_end - audio_start - position) * 8 / bitrate
+
+def parse_vorbis_comment(data, position=0):
+    """Reads the fields we use from a Vorbis comment block (tolerating one that was cut short)."""
+    tags = {}
+    vendor_length, = struct.unpack_from("<I", data, position)
+    position += 4 + vendor_length
+    count, = struct.unpack_from("<I", data, position)
+    position += 4
+    for _ in range(count):
+        if position + 4 > len(data):
+            break
+        length, = struct.unpack_from("<I", data, position)
+        position += 4
+        if position + length > len(data):
+            break
+        key, _, value = data[position:position + length].partition(b"=")
+        position += length
+        field = VORBIS_FIELDS.get(key.decode("ascii", errors="replace").lower())
+        if field and field not in tags:
+            tags[field] = value.decode("utf-8", errors="replace")
+    return tags
+
+def read_flac_tags(f):
+    """Reads the VORBIS_COMMENT fields and the length (STREAMINFO) of a FLAC file."""
+    _, start = read_id3v2(f) # Some taggers put an ID3 tag in front of the stream
+    f.seek(start)
+    if f.read(4) != b"fLaC":
+        raise ValueError("not a FLAC stream")
+    tags, duration, found_comment = {}, 0.0, False
+    while not found_comment:
+        header = read_exact(f, 4)
+        block_type, length = header[0] & 0x7F, int.from_bytes(header[1:4], "big")
+        if block_type == 0: # STREAMINFO
+            packed = int.from_bytes(read_exact(f, length)[10:18], "big")
+            sample_rate, total_samples = packed >> 44, packed & 0xFFFFFFFFF
+            duration = total_samples / sample_rate if sample_rate else 0.0
+        elif block_type == 4 and length <= TAG_READ_LIMIT: # VORBIS_COMMENT
+            tags = parse_vorbis_comment(read_exact(f, length))
+            found_comment = True
+        else:
+            f.seek(length, os.SEEK_CUR)
+        if header[0] & 0x80: # Last metadata block
+            break
+    tags['duration'] = duration
+    return tags
+
+def read_ogg_packets(f, count):
+    """Reassembles the first count packets of the first logical stream; returns (packets, stream serial)."""
+    packets, pieces, piece_bytes, serial = [], [], 0, None
+    while True:
+        header = read_exact(f, 27)
+        if header[:4] != b"OggS":
+            raise ValueError("lost Ogg page sync")
+        page_serial, = struct.unpack_from("<I", header, 14)
+        lacing = read_exact(f, header[26])
+        if serial is None:
+            serial = page_serial
+        if page_serial != serial: # Page of another multiplexed stream
+            f.seek(sum(lacing), os.SEEK_CUR)
+            continue
+        body = read_exact(f, sum(lacing)) if piece_bytes < TAG_READ_LIMIT else None
+        offset = 0
+        for segment in lacing:
+            if body is not None and piece_bytes < TAG_READ_LIMIT: # Longer packets (cover art) are cut short
+                pieces.append(body[offset:offset + segment])
+            offset += segment
+            piece_bytes += segment
+            if segment < 255: # Packet ends here
+                packets.append(b"".join(pieces))
+                pieces, piece_bytes = [], 0
+                if len(packets) == count:
+                    return packets, serial
+        if body is None:
+            f.seek(offset, os.SEEK_CUR)
+
+def read_last_ogg_granule(f, file_size, serial):
+    """Granule position of the last page of a stream (-1 if none is found)."""
+    start = max(0, file_size - OGG_TAIL_BYTES)
+    f.seek(start)
+    data = f.read(file_size - start)
+    position = data.rfind(b"OggS")
+    while position >= 0:
+        if position + 27 <= len(data):
+            granule, page_serial = struct.unpack_from("<qI", data, position + 6)
+            if page_serial == serial and granule != -1:
+                return granule
+        position = data.rfind(b"OggS", 0, position)
+    return -1
+
+def read_ogg_tags(f, file_size):
+    """Reads the comment fields and the length of an Ogg Vorbis or Opus file (None for other codecs)."""
+    (identification, comment), serial = read_ogg_packets(f, 2)
+    if identification.startswith(b"\x01vorbis"):
+        sample_rate, pre_skip = struct.unpack_from("<I", identification, 12)[0], 0
+        tags = parse_vorbis_comment(comment, 7) if comment.startswith(b"\x03vorbis") else {}
+    elif identification.startswith(b"OpusHead"):
+        sample_rate, pre_skip = 48000, struct.unpack_from("<H", identification, 10)[0] # Opus always runs at 48 kHz
+        tags = parse_vorbis_comment(comment, 8) if comment.startswith(b"OpusTags") else {}
+    else:
+        return None
+    granule = read_last_ogg_granule(f, file_size, serial)
+    tags['duration'] = max(0, granule - pre_skip) / sample_rate if granule > 0 and sample_rate else 0.0
+    return tags
+
+def decode_info_text(data):
+    """Decodes a RIFF INFO string (NUL-terminated, usually UTF-8 or Latin-1)."""
+    data = data.split(b"\0", 1)[0]
+    try:
+        return data.decode("utf-8").strip()
+    except UnicodeDecodeError:
+        return data.decode("latin-1").strip()
+
+def read_wav_tags(f, file_size):
+    """Reads the LIST/INFO (or ID3) fields and the length of a WAV file."""
+    header = read_exact(f, 12)
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE file")
+    tags, byte_rate, data_size = {}, 0, 0
+    position = 12
+    while position + 8 <= file_size:
+        f.seek(position)
+        chunk_id, size = struct.unpack("<4sI", read_exact(f, 8))
+        if chunk_id == b"fmt ":
+            byte_rate, = struct.unpack_from("<I", read_exact(f, min(size, 16)), 8)
+        elif chunk_id == b"data":
+            data_size = min(size, file_size - position - 8) # Streamed files may not fill in the size
+        elif chunk_id == b"LIST" and size <= TAG_READ_LIMIT:
+            data = read_exact(f, size)
+            offset = 4
+            while data[:4] == b"INFO" and offset + 8 <= len(data):
+                item_id, item_size = struct.unpack_from("<4sI", data, offset)
+                field = WAV_INFO_FIELDS.get(item_id)
+                if field and field not in tags:
+                    tags[field] = decode_info_text(data[offset + 8:offset + 8 + item_size])
+                offset += 8 + item_size + (item_size & 1)
+        elif chunk_id.lower() == b"id3 ":
+            for field, value in (read_id3v2(f, position + 8)[0] or {}).items():
+                tags.setdefault(field, value)
+        position += 8 + size + (size & 1) # Chunks are padded to an even size
+    tags['duration'] = data_size / byte_rate if byte_rate else 0.0
+    return tags
+
+def read_tags(filepath):
+    """Header-only tag reading: the title/artist/album found plus 'duration' (None for formats it does not read)."""
+    extension = os.path.splitext(filepath)[1].lower()
+    with open(filepath, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if extension == '.mp3':
+            tags, audio_start = read_id3v2(f)
+            id3v1 = read_id3v1(f, file_size)
+            if tags is None:
+                tags = id3v1 or {}
+            tags['duration'] = read_mp3_duration(f, audio_start, file_size - (128 if id3v1 is not None else 0))
+            return tags
+        if extension == '.flac':
+            return read_flac_tags(f)
+        if extension == '.ogg':
+            return read_ogg_tags(f, file_size)
+        if extension == '.wav':
+            return read_wav_tags(f, file_size)
+    return None
+
+def read_track_metadata(filepath):
+    """Reads title, artist, album and duration straight from the audio file tags."""
+    try:
+        tags = read_tags(filepath)
+    except (OSError, ValueError, struct.error, zlib.error) as e:
+        scan_log.debug("Header tag reader failed on %s (%s), trying mutagen", os.path.basename(filepath), e)
+        tags = None
+    if tags is None:
+        return read_track_metadata_mutagen(filepath)
+    if filepath.lower().endswith(('.mp3', '.flac')):
+        defaults = ("Unknown Title", "Unknown Artist", "Unknown Album")
+    else: # Untagged Ogg and WAV files are named after the file, as before
+        defaults = (os.path.splitext(os.path.basename(filepath))[0], "Various", "Various")
+    return {'title': tags.get('title') or defaults[0], 'artist': tags.get('artist') or defaults[1],
+            'album': tags.get('album') or defaults[2], 'duration': float(tags['duration'])}
+
+def read_track_metadata_mutagen(filepath):
+    """Reads title, artist, album and duration with mutagen (slower: it parses the stream info too)."""
     try:
         file_lower = filepath.lower()
+        duration = 0.0
         if file_lower.endswith('.mp3'):
             audio = MP3(filepath)
             title = audio.get("TIT2", ["Unknown Title"])[0]
             artist = audio.get("TPE1", ["Unknown Artist"])[0]
             album = audio.get("TALB", ["Unknown Album"])[0]
+            duration = audio.info.length
         elif file_lower.endswith('.flac'):
             audio = FLAC(filepath)
             title = audio.get("title", ["Unknown Title"])[0] if "title" in audio else "Unknown Title"
             artist = audio.get("artist", ["Unknown Artist"])[0] if "artist" in audio else "Unknown Artist"
             album = audio.get("album", ["Unknown Album"])[0] if "album" in audio else "Unknown Album"
+            duration = audio.info.length
         else:
             title = os.path.splitext(os.path.basename(filepath))[0]
             artist = "Various"
             album = "Various"
-        return {'title': title, 'artist': artist, 'album': album}
+        return {'title': str(title), 'artist': str(artist), 'album': str(album), 'duration': float(duration)}
     except Exception as e:
-        print(f"Warning: Could not read metadata for {os.path.basename(filepath)}: {e}")
-        return {'title': os.path.splitext(os.path.basename(filepath))[0], 'artist': 'Unknown', 'album': 'Unknown'}
+        scan_log.warning("Could not read metadata for %s: %s", os.path.basename(filepath), e)
+        return {'title': os.path.splitext(os.path.basename(filepath))[0], 'artist': 'Unknown', 'album': 'Unknown', 'duration': 0.0}
+
+# --- Metadata Cache ---
+# Tags are cached in a small SQLite database keyed by path and validated against the
+# file's size and mtime, so a warm start never has to open the audio files again.
+# The analysis table holds what `shrimp.py --analyze` measured (see Library Analysis).
+METADATA_SCHEMA_VERSION = 4 # 2: Ogg and WAV tags are read instead of using the file name, 3: analysis table,
+                            # 4: the analysis notes whether a decoder was installed (and stereo loudness sums the channels)
+METADATA_UPGRADABLE_VERSIONS = (2, 3) # Older versions whose cached tags are still valid (the analysis is measured again)
+METADATA_FLUSH_EVERY = 500 # Commit pending cache writes after this many new entries
+
+metadata_db = None           # sqlite3 connection of the persistent cache (None if unavailable)
+metadata_cache = {}          # path -> (size, mtime_ns, metadata) as loaded from / written to the cache
+metadata_validated = set()   # paths whose cache entry was checked against the file this session
+track_analysis = {}          # path -> (size, mtime_ns, duration, bitrate, gain, decoder installed) measured by --analyze
+track_analysis_loaded = False # True once open_metadata_cache has run (until then songs are looked up one by one)
+metadata_pending_writes = 0  # cache writes not yet committed
+metadata_lock = threading.RLock()
+
+def open_metadata_cache(db_path=METADATA_CACHE_PATH):
+    """Opens (or creates) the persistent metadata cache and loads it into memory."""
+    global metadata_db, track_analysis_loaded
+    try:
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version != METADATA_SCHEMA_VERSION:
+            if version not in METADATA_UPGRADABLE_VERSIONS:
+                db.execute("DROP TABLE IF EXISTS tracks")
+            db.execute("DROP TABLE IF EXISTS analysis")
+            db.execute(f"PRAGMA user_version = {METADATA_SCHEMA_VERSION}")
+        db.execute("CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                   "title TEXT, artist TEXT, album TEXT, duration REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS analysis (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                   "duration REAL, bitrate INTEGER, gain REAL, decoded INTEGER)")
+        rows = db.execute("SELECT path, size, mtime_ns, title, artist, album, duration FROM tracks").fetchall()
+        analysis_rows = db.execute("SELECT path, size, mtime_ns, duration, bitrate, gain, decoded FROM analysis").fetchall()
+    except sqlite3.Error as e:
+        scan_log.warning("Metadata cache '%s' unavailable, reading tags directly: %s", db_path, e)
+        track_analysis_loaded = True
+        return
+    with metadata_lock:
+        metadata_db = db
+        metadata_cache.clear()
+        metadata_validated.clear()
+        for path, size, mtime_ns, title, artist, album, duration in rows:
+            metadata_cache[path] = (size, mtime_ns, {'title': title, 'artist': artist, 'album': album, 'duration': duration})
+        track_analysis.clear()
+        for path, *analysis in analysis_rows:
+            track_analysis[path] = tuple(analysis)
+        track_analysis_loaded = True
+    scan_log.info("Loaded %d cached metadata entries (%d analysed).", len(rows), len(analysis_rows))
+
+def read_track_analysis(filepath, db_path=METADATA_CACHE_PATH):
+    """The analysis of a single song straight from the cache file, before open_metadata_cache has loaded it (None if there is none)."""
+    try: # Read-only, so a missing cache is not created here
+        with contextlib.closing(sqlite3.connect(f"file:{urllib.parse.quote(db_path)}?mode=ro", uri=True)) as db:
+            if db.execute("PRAGMA user_version").fetchone()[0] != METADATA_SCHEMA_VERSION:
+                return None
+            row = db.execute("SELECT size, mtime_ns, duration, bitrate, gain, decoded FROM analysis WHERE path = ?",
+                             (filepath,)).fetchone()
+    except sqlite3.Error: # No analysis yet; open_metadata_cache reports an unusable cache
+        return None
+    return tuple(row) if row is not None else None
+
+def store_track_metadata(filepath, size, mtime_ns, metadata):
+    """Records freshly read metadata in memory and (lazily committed) in the cache database."""
+    global metadata_pending_writes
+    with metadata_lock:
+        metadata_cache[filepath] = (size, mtime_ns, metadata)
+        metadata_validated.add(filepath)
+        if metadata_db is None:
+            return
+        try:
+            metadata_db.execute("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (filepath, size, mtime_ns, metadata['title'], metadata['artist'], metadata['album'], metadata['duration']))
+            metadata_pending_writes += 1
+            if metadata_pending_writes >= METADATA_FLUSH_EVERY:
+                flush_metadata_cache()
+        except sqlite3.Error as e:
+            scan_log.warning("Could not cache metadata for %s: %s", os.path.basename(filepath), e)
+
+def store_track_analysis(filepath, size, mtime_ns, duration, bitrate, gain, decoded):
+    """Records what --analyze measured for a file, in memory and (lazily committed) in the cache database."""
+    global metadata_pending_writes
+    with metadata_lock:
+        track_analysis[filepath] = (size, mtime_ns, duration, bitrate, gain, decoded)
+        if metadata_db is None:
+            return
+        try:
+            metadata_db.execute("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (filepath, size, mtime_ns, duration, bitrate, gain, int(decoded)))
+            metadata_pending_writes += 1
+        except sqlite3.Error as e:
+            scan_log.warning("Could not store the analysis of %s: %s", os.path.basename(filepath), e)
+
+def flush_metadata_cache():
+    """Commits pending metadata cache writes to disk."""
+    global metadata_pending_writes
+    with metadata_lock:
+        if metadata_db is None or not metadata_pending_writes:
+            return
+        try:
+            metadata_db.commit()
+            metadata_pending_writes = 0
+        except sqlite3.Error as e:
+            scan_log.warning("Could not save metadata cache: %s", e)
+
+def forget_track_metadata(paths):
+    """Drops the cache entries of the given files."""
+    global metadata_pending_writes
+    with metadata_lock:
+        for path in paths:
+            metadata_cache.pop(path, None)
+            metadata_validated.discard(path)
+            track_analysis.pop(path, None)
+        if metadata_db is not None and paths:
+            try:
+                metadata_db.executemany("DELETE FROM tracks WHERE path = ?", [(path,) for path in paths])
+                metadata_db.executemany("DELETE FROM analysis WHERE path = ?", [(path,) for path in paths])
+                metadata_pending_writes += len(paths)
+            except sqlite3.Error as e:
+                scan_log.warning("Could not prune metadata cache: %s", e)
+
+def prune_metadata_cache(existing_paths):
+    """Drops cache entries for files that are no longer part of the library."""
+    with metadata_lock:
+        forget_track_metadata([path for path in metadata_cache if path not in existing_paths])
+    flush_metadata_cache()
+
+def move_track_metadata(old_path, new_path):
+    """Carries a cache entry over to a renamed file, so it does not have to be parsed again."""
+    with metadata_lock:
+        cached = metadata_cache.get(old_path)
+        analysis = track_analysis.get(old_path)
+        forget_track_metadata([old_path])
+        if cached is not None:
+            store_track_metadata(new_path, *cached)
+            metadata_validated.discard(new_path) # Still re-checked against the file on next use
+        if analysis is not None:
+            store_track_analysis(new_path, *analysis)
+
+def invalidate_track_metadata(path):
+    """Forces the next get_track_metadata(path) to re-check the file against its cache entry."""
+    forget_snapshot_metadata(path)
+    with metadata_lock:
+        metadata_validated.discard(path)
+
+def close_metadata_cache():
+    """Flushes and closes the persistent metadata cache."""
+    global metadata_db
+    flush_metadata_cache()
+    with metadata_lock:
+        if metadata_db is not None:
+            metadata_db.close()
+            metadata_db = None
+
+def lookup_cached_metadata(filepath):
+    """Returns (metadata, stat) for a file; metadata is None when the cache entry is missing or stale."""
+    with metadata_lock:
+        cached = metadata_cache.get(filepath)
+        if cached is not None and filepath in metadata_validated:
+            stats_count("metadata.cache_hit")
+            return cached[2], None
+    try:
+        st = os.stat(filepath)
+    except OSError as e:
+        scan_log.warning("Could not stat %s: %s", os.path.basename(filepath), e)
+        return None, None
+    with metadata_lock:
+        analysis = track_analysis.get(filepath)
+        if analysis is not None and analysis[:2] != (st.st_size, st.st_mtime_ns):
+            del track_analysis[filepath] # Measured on older contents; --analyze measures it again
+    if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+        with metadata_lock:
+            metadata_validated.add(filepath)
+        stats_count("metadata.cache_hit")
+        return cached[2], st
+    stats_count("metadata.cache_miss")
+    return None, st
 
-# --- Player Controls ---
-def play_track(index):
-    """Plays the track at the given index in the current_playlist."""
-    global current_track_index, player_state, current_track_metadata
+def get_track_metadata(filepath):
+    """Retrieves title, artist, album and duration, reading the file only if the cache is stale."""
+    with stats_timer("metadata.get"):
+        metadata, st = lookup_cached_metadata(filepath)
+        if metadata is not None:
+            return metadata
+        metadata = read_track_metadata(filepath)
+        if st is not None:
+            store_track_metadata(filepath, st.st_size, st.st_mtime_ns, metadata)
+        return metadata
+
+METADATA_BATCH_SIZE = 32 # Files per task handed to a metadata worker process
+
+def read_metadata_batch(paths):
+    """Worker entry point: reads the tags of several files."""
+    return [read_track_metadata(path) for path in paths]
+
+def extract_library_metadata(paths, workers=SCAN_WORKERS, progress=None, on_ready=None):
+    """Makes sure the metadata cache holds current tags for every path.
+
+    paths may be any iterable, including the lazy directory scanner. Stale files are read in a
+    bounded process pool; on_ready(path) and progress(done, seen) are called on the calling
+    thread as tags become available.
+    """
+    seen = done = read = 0
+
+    def finished(path, ready=True):
+        nonlocal done
+        done += 1
+        if ready and on_ready:
+            on_ready(path)
+        if progress:
+            progress(done, seen)
+
+    if workers <= 1:
+        for path in paths:
+            seen += 1
+            metadata, st = lookup_cached_metadata(path)
+            if metadata is None and st is not None:
+                store_track_metadata(path, st.st_size, st.st_mtime_ns, read_track_metadata(path))
+                read += 1
+            finished(path, ready=metadata is not None or st is not None)
+    else:
+        # Stale files are handed out in small batches to keep inter-process overhead low, and only
+        # a few batches are queued per worker, so the source is consumed at the pace tags are read.
+        # Workers are forked so they never re-import (and re-initialise) this script.
+        source = iter(paths)
+        exhausted = False
+        batch = []
+        in_flight = {}
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=log_directly) as pool:
+            while True:
+                while not exhausted and len(in_flight) < workers * 2:
+                    path = next(source, None)
+                    if path is None:
+                        exhausted = True
+                        break
+                    seen += 1
+                    metadata, st = lookup_cached_metadata(path)
+                    if metadata is not None or st is None: # Cached, or vanished since it was found
+                        finished(path, ready=metadata is not None)
+                        continue
+                    batch.append((path, st.st_size, st.st_mtime_ns))
+                    if len(batch) == METADATA_BATCH_SIZE:
+                        in_flight[pool.submit(read_metadata_batch, [job[0] for job in batch])] = batch
+                        batch = []
+                if exhausted and batch:
+                    in_flight[pool.submit(read_metadata_batch, [job[0] for job in batch])] = batch
+                    batch = []
+                if not in_flight:
+                    break
+                completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    jobs = in_flight.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as e: # A worker died; read this batch here instead
+                        scan_log.warning("Metadata worker failed, reading %d files in-process: %s", len(jobs), e)
+                        results = read_metadata_batch([job[0] for job in jobs])
+                    for (path, size, mtime_ns), metadata in zip(jobs, results):
+                        store_track_metadata(path, size, mtime_ns, metadata)
+                        read += 1
+                        finished(path)
+    flush_metadata_cache()
+    scan_log.info("Metadata: %d cached, %d read with %d worker(s).", done - read, read, workers)
+
+# --- Library Analysis ---
+# `shrimp.py --analyze` measures duration, bitrate and loudness of every song ahead of time
+# and keeps them in the metadata cache, so playback can level songs by their gain without
+# reading or decoding anything. Loudness comes from ReplayGain tags where the files have them,
+# otherwise songs are decoded (16-bit WAV directly, anything else through ffmpeg, if installed)
+# and measured like EBU R128 / ReplayGain 2, minus the K-weighting filter. Results are
+# committed every few songs and songs whose analysis still matches their size and mtime are
+# skipped, so an interrupted run picks up where it stopped.
+ANALYSIS_REFERENCE_LOUDNESS = -18.0 # LUFS songs are levelled to (the ReplayGain 2 reference)
+ANALYSIS_SAMPLE_RATE = 11025        # Rate ffmpeg decodes at for measuring
+ANALYSIS_BLOCK_SECS = 0.4           # Gating block length, blocks overlap by 75%
+ANALYSIS_ABSOLUTE_GATE = -70.0      # LUFS below which blocks count as silence
+ANALYSIS_RELATIVE_GATE = -10.0      # LU below the ungated loudness below which blocks are left out
+ANALYSIS_CHECKPOINT_EVERY = 25      # Results are committed after this many songs
+ANALYSIS_READ_BYTES = 64 * 1024     # Size of each read of decoded audio
+ANALYSIS_DECODER = "ffmpeg"         # Decodes compressed songs for measuring (optional)
+
+analysis_decoder = None # Path of ANALYSIS_DECODER if it is installed
+
+def power_to_loudness(power):
+    """Loudness (LUFS) of a block power: the sum of its channels' mean squares (full scale = 1 per channel)."""
+    return -0.691 + 10 * math.log10(power)
+
+def gated_loudness(block_powers):
+    """Integrated loudness of the blocks after the absolute and relative gates, or None if all is silence."""
+    audible = [power for power in block_powers if power > 0 and power_to_loudness(power) > ANALYSIS_ABSOLUTE_GATE]
+    if not audible:
+        return None
+    threshold = power_to_loudness(sum(audible) / len(audible)) + ANALYSIS_RELATIVE_GATE
+    gated = [power for power in audible if power_to_loudness(power) > threshold]
+    return power_to_loudness(sum(gated) / len(gated))
+
+def decode_wav(path):
+    """(rate, channels, chunks) of a 16-bit PCM WAV file, or None for any other kind of WAV."""
+    try:
+        with wave.open(path, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                return None
+            rate, channels = wav.getframerate(), wav.getnchannels()
+    except (wave.Error, EOFError):
+        return None
+
+    def chunks():
+        with wave.open(path, 'rb') as wav:
+            frames = ANALYSIS_READ_BYTES // (2 * wav.getnchannels())
+            while True:
+                data = wav.readframes(frames)
+                if not data:
+                    return
+                yield data
+
+    return rate, channels, chunks()
+
+def decode_with_ffmpeg(path):
+    """(rate, channels, chunks) of a song decoded by ffmpeg to 16-bit stereo at ANALYSIS_SAMPLE_RATE."""
+    command = [analysis_decoder, "-v", "error", "-nostdin", "-i", path, "-vn", "-f", "s16le",
+               "-acodec", "pcm_s16le", "-ac", "2", "-ar", str(ANALYSIS_SAMPLE_RATE), "-"]
+
+    def chunks():
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+            while True:
+                data = process.stdout.read(ANALYSIS_READ_BYTES)
+                if not data:
+                    break
+                yield data
+            if process.wait() != 0:
+                raise OSError(f"{ANALYSIS_DECODER} exited with status {process.returncode}")
+
+    return ANALYSIS_SAMPLE_RATE, 2, chunks()
+
+def measure_loudness(path):
+    """Returns (loudness in LUFS or None if silent, seconds decoded), or None if the song cannot be decoded."""
+    decoded = decode_wav(path) if path.lower().endswith('.wav') else None
+    if decoded is None:
+        if analysis_decoder is None:
+            return None
+        decoded = decode_with_ffmpeg(path)
+    rate, channels, chunks = decoded
+
+    # Power of every quarter block: the mean squares of its channels, summed (as BS.1770 adds up
+    # the front channels); each gating block is four consecutive ones
+    frames = max(1, round(rate * ANALYSIS_BLOCK_SECS / 4))
+    quarter = frames * channels
+    quarter_bytes = quarter * 2
+    full_scale = frames * 32768.0 ** 2 # Per frame, not per sample: the channels add up
+    powers = []
+    pending = bytearray()
+    for data in chunks:
+        pending += data
+        usable = len(pending) // quarter_bytes * quarter_bytes
+        samples = array('h', bytes(pending[:usable]))
+        del pending[:usable]
+        if sys.byteorder == 'big': # Decoded audio is little-endian
+            samples.byteswap()
+        for start in range(0, len(samples), quarter):
+            block = samples[start:start + quarter]
+            powers.append(sum(map(operator.mul, block, block)) / full_scale)
+    block_powers = [sum(powers[i:i + 4]) / 4 for i in range(len(powers) - 3)]
+    seconds = (len(powers) * quarter + len(pending) // 2) / channels / rate
+    return gated_loudness(block_powers), seconds
+
+def tagged_track_gain(tags):
+    """The track gain (dB) of a song's ReplayGain (or Opus R128) tag, or None."""
+    if not tags:
+        return None
+    if hasattr(tags, "getall"): # ID3 (MP3 and WAV)
+        values = [frame.text[0] for frame in tags.getall("TXXX") if frame.desc.upper() == "REPLAYGAIN_TRACK_GAIN" and frame.text]
+    else: # Vorbis comments (FLAC and Ogg)
+        values = tags.get("replaygain_track_gain") or []
+        for r128 in tags.get("r128_track_gain") or []: # Q7.8 dB relative to -23 LUFS
+            with contextlib.suppress(ValueError):
+                return int(r128) / 256 + ANALYSIS_REFERENCE_LOUDNESS + 23
+    for text in values:
+        with contextlib.suppress(ValueError):
+            return float(text.lower().replace("db", "").strip())
+    return None
+
+def analyze_track(path):
+    """Worker entry point: (duration in s, bitrate in kbit/s, gain in dB) of a song; unknown values are None."""
+    duration = bitrate = gain = None
+    try:
+        audio = mutagen.File(path)
+    except (mutagen.MutagenError, OSError) as e:
+        scan_log.warning("Could not read stream info of %s: %s", os.path.basename(path), e)
+        audio = None
+    if audio is not None:
+        duration = audio.info.length or None
+        bitrate = getattr(audio.info, "bitrate", 0) // 1000 or None
+        gain = tagged_track_gain(audio.tags)
+    if gain is None:
+        try:
+            measured = measure_loudness(path)
+        except (OSError, ValueError, wave.Error, EOFError) as e:
+            scan_log.warning("Could not measure the loudness of %s: %s", os.path.basename(path), e)
+            measured = None
+        if measured is not None:
+            loudness, seconds = measured
+            if loudness is not None:
+                gain = ANALYSIS_REFERENCE_LOUDNESS - loudness
+            duration = duration or seconds or None
+    if bitrate is None and duration:
+        bitrate = round(os.path.getsize(path) * 8 / duration / 1000)
+    return duration, bitrate, gain
+
+def songs_to_analyze(music_dir, skipped):
+    """Yields (path, stat) of every song whose analysis is missing or out of date; skipped counts the others."""
+    for path in iter_music_files(music_dir):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            scan_log.warning("Could not stat %s: %s", os.path.basename(path), e)
+            continue
+        with metadata_lock:
+            analysis = track_analysis.get(path)
+        # Songs left without a loudness for want of a decoder are tried again once one is installed
+        if analysis is not None and analysis[:2] == (st.st_size, st.st_mtime_ns) and \
+                (analysis[4] is not None or analysis[5] or analysis_decoder is None):
+            skipped[0] += 1
+            continue
+        yield path, st
+
+def analyze_library(music_dir=MUSIC_DIR, workers=SCAN_WORKERS):
+    """--analyze: measures every new or changed song in a process pool and stores the results."""
+    global analysis_decoder
+    open_metadata_cache()
+    if metadata_db is None:
+        scan_log.error("The metadata cache is needed to keep the analysis, giving up.")
+        return 0
+    analysis_decoder = shutil.which(ANALYSIS_DECODER)
+    if analysis_decoder is None:
+        scan_log.warning("%s not found: only ReplayGain tags and 16-bit WAV files give a loudness.", ANALYSIS_DECODER)
+
+    scan_log.info("Analysing %s with %d worker(s)...", music_dir, workers)
+    start = time.perf_counter()
+    skipped = [0]
+    analysed = unmeasured = 0
+    source = songs_to_analyze(music_dir, skipped)
+    exhausted = False
+    in_flight = {}
+    try:
+        # As in extract_library_metadata: a few songs queued per worker, forked workers
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context("fork"),
+                                 initializer=log_directly) as pool:
+            while True:
+                while not exhausted and len(in_flight) < max(1, workers) * 2:
+                    job = next(source, None)
+                    if job is None:
+                        exhausted = True
+                        break
+                    in_flight[pool.submit(analyze_track, job[0])] = job
+                if not in_flight:
+                    break
+                completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    path, st = in_flight.pop(future)
+                    try:
+                        duration, bitrate, gain = future.result()
+                    except Exception as e:
+                        scan_log.warning("Could not analyse %s: %s", os.path.basename(path), e)
+                        continue
+                    store_track_analysis(path, st.st_size, st.st_mtime_ns, duration, bitrate, gain, analysis_decoder is not None)
+                    analysed += 1
+                    unmeasured += gain is None
+                    if analysed % ANALYSIS_CHECKPOINT_EVERY == 0:
+                        flush_metadata_cache() # A checkpoint: an interrupted run resumes from here
+                        scan_log.info("Analysed %d songs (%d up to date)...", analysed, skipped[0])
+    finally:
+        close_metadata_cache()
+    scan_log.info("Analysed %d songs in %.1fs (%d up to date, %d without a loudness).",
+                  analysed, time.perf_counter() - start, skipped[0], unmeasured)
+    return analysed
+
+# --- Library Index ---
+# Every song is filed once under the CHAR_LIST entry its title starts with. Each bucket
+# is kept sorted by title, so selecting a character is a dictionary lookup.
+CHAR_LIST = ['#', '1', 'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z']
+
+char_buckets = {char: array('I') for char in CHAR_LIST} # CHAR_LIST entry -> track IDs sorted by title
+indexed_songs = {}                                      # track ID -> CHAR_LIST entry (or None) of each indexed song
+library_lock = threading.RLock()
+
+def get_title_char(title):
+    """Returns the CHAR_LIST entry a title is filed under, or None if it fits none."""
+    title_lower = title.lower()
+    if not title_lower:
+        return None
+    if title_lower[0].isdigit(): # Numbers
+        return '1'
+    if not title_lower[0].isalpha(): # Symbols
+        return '#'
+    letter = title_lower[0].upper()
+    return letter if letter in char_buckets else None # Non-latin letters fit no bucket
+
+def song_title_key(track_id):
+    """Sort key of the character buckets (the ID keeps songs with the same title apart)."""
+    return track_sort_keys[track_id], track_id
+
+def index_song(track_id):
+    """Files a single song into its bucket, replacing any previous entry for it."""
+    title = get_track_metadata_by_id(track_id)['title']
+    char = get_title_char(title)
+    global browse_index_dirty
+    with library_lock:
+        unindex_song(track_id)
+        browse_index_dirty = True
+        track_sort_keys[track_id] = title.lower()
+        indexed_songs[track_id] = char
+        if char is not None:
+            bucket = char_buckets[char]
+            bucket.insert(find_sorted_position(bucket, song_title_key(track_id), song_title_key), track_id)
+            prefix_runs_cache.pop(char, None)
+
+def unindex_song(track_id):
+    """Removes a single song from its bucket (no-op if it was never indexed)."""
+    global browse_index_dirty
+    ensure_track_lookup()
+    with library_lock:
+        if track_id in indexed_songs:
+            browse_index_dirty = True
+        char = indexed_songs.pop(track_id, None)
+        if char is None:
+            return
+        bucket = char_buckets[char]
+        position = find_sorted_position(bucket, song_title_key(track_id), song_title_key)
+        if position < len(bucket) and bucket[position] == track_id:
+            del bucket[position]
+            prefix_runs_cache.pop(char, None)
+
+def char_bucket_count(char):
+    """Number of songs filed under a CHAR_LIST entry."""
+    return len(char_buckets[char])
+
+# Within a bucket, the songs are sorted by title, which does not keep the titles sharing a
+# second character together ("S x", "S1", "S!" and "Sa" file their second characters under
+# '#', '1', '#' and 'A'). So the second level of the title selection regroups the bucket by
+# second character, in CHAR_LIST order and by title within each group: a list of runs, each
+# one's character and first position in the regrouped songs. The runs of a bucket are worked
+# out in one pass the first time it is opened after it changed; from then on every jump is an
+# offset into the regrouped songs.
+PrefixRuns = collections.namedtuple("PrefixRuns", [
+    "chars",   # Second character of each run (as get_title_char files it; '#' for one-character titles)
+    "starts",  # array('I'): first position of each run in tracks, plus the length of tracks
+    "tracks",  # array('I'): the track IDs of the bucket, grouped by second character
+])
+
+prefix_runs_cache = {} # CHAR_LIST entry -> (bucket, PrefixRuns) of the bucket the runs were worked out for
+
+def get_prefix_char(title_key):
+    """The run a title is filed in within its bucket: its second character, filed like the first."""
+    return get_title_char(title_key[1:2]) or '#'
+
+def char_prefix_runs(char):
+    """PrefixRuns of the bucket of a CHAR_LIST entry."""
+    with library_lock:
+        bucket = char_buckets[char]
+        cached = prefix_runs_cache.get(char)
+        if cached is not None and cached[0] is bucket: # Not replaced (e.g. by a snapshot) since
+            return cached[1]
+        groups = {}
+        for track_id in bucket: # Titles stay in order within each group
+            prefix_char = get_prefix_char(track_sort_keys[track_id])
+            group = groups.get(prefix_char)
+            if group is None:
+                group = groups[prefix_char] = array('I')
+            group.append(track_id)
+        chars, starts, tracks = [], array('I'), array('I')
+        for prefix_char in CHAR_LIST:
+            if prefix_char in groups:
+                chars.append(prefix_char)
+                starts.append(len(tracks))
+                tracks.extend(groups[prefix_char])
+        starts.append(len(tracks))
+        runs = PrefixRuns(chars, starts, tracks)
+        prefix_runs_cache[char] = (bucket, runs)
+        return runs
+
+def prefix_run_at(runs, position):
+    """Index of the run a position in the regrouped songs falls in."""
+    return max(0, bisect.bisect_right(runs.starts, position, 0, len(runs.chars)) - 1)
+
+# --- Browse Index ---
+# Artists, their albums and the albums' songs as sorted arrays, built from the metadata cache
+# (no file I/O). Artists are grouped by the CHAR_LIST entry they start with and albums by
+# artist, so every level of the artist -> album -> song browser is found by bisecting for
+# its prefix. The index is replaced as a whole when it is rebuilt after library changes.
+BrowseIndex = collections.namedtuple("BrowseIndex", [
+    "artist_keys",   # (CHAR_LIST position, lower-case artist) of each artist, sorted
+    "artist_names",  # Parallel: artist as tagged
+    "album_keys",    # (lower-case artist, lower-case album) of each album, sorted
+    "album_names",   # Parallel: album as tagged
+    "album_starts",  # Album -> first position in album_tracks (plus one entry ending the last album)
+    "album_tracks",  # Track IDs, album after album, sorted by title within an album
+])
+
+browse_index = None       # Current BrowseIndex (None until first built)
+browse_index_dirty = True # Set when songs were (re)indexed after the last build
+
+def build_browse_index():
+    """Rebuilds the artist/album index from the tags of all indexed songs."""
+    global browse_index, browse_index_dirty
+    browse_index_dirty = False # Changes made while building mark it dirty again
+    ensure_track_lookup()
+    with library_lock:
+        track_ids = list(indexed_songs)
+    songs = []
+    for track_id in track_ids:
+        metadata = get_track_metadata_by_id(track_id)
+        songs.append((metadata['artist'].lower(), metadata['album'].lower(), track_sort_keys[track_id], track_id,
+                      metadata['artist'], metadata['album']))
+    songs.sort()
+
+    artists = {} # lower-case artist -> artist as first tagged
+    album_keys, album_names = [], []
+    album_starts, album_tracks = array('I'), array('I')
+    for artist_key, album_key, _, track_id, artist, album in songs:
+        if not album_keys or album_keys[-1] != (artist_key, album_key):
+            album_keys.append((artist_key, album_key))
+            album_names.append(album)
+            album_starts.append(len(album_tracks))
+            artists.setdefault(artist_key, artist)
+        album_tracks.append(track_id)
+    album_starts.append(len(album_tracks))
+
+    artist_entries = []
+    for artist_key, artist in artists.items():
+        char = get_title_char(artist)
+        if char is not None: # Filed like titles: artists that fit no CHAR_LIST entry are not listed
+            artist_entries.append(((CHAR_LIST.index(char), artist_key), artist))
+    artist_entries.sort()
+    browse_index = BrowseIndex([key for key, _ in artist_entries], [artist for _, artist in artist_entries],
+                               album_keys, album_names, album_starts, album_tracks)
+    scan_log.info("Browse index: %d artists, %d albums.", len(artist_entries), len(album_keys))
+
+def get_browse_index():
+    """The artist/album index, rebuilt first if the library changed since it was built."""
+    if browse_index is None or browse_index_dirty:
+        build_browse_index()
+    return browse_index
+
+def artist_range(index, char):
+    """(first, end) positions of the artists filed under a CHAR_LIST entry."""
+    position = CHAR_LIST.index(char)
+    return bisect.bisect_left(index.artist_keys, (position,)), bisect.bisect_left(index.artist_keys, (position + 1,))
+
+def album_range(index, artist_position):
+    """(first, end) positions of an artist's albums."""
+    artist_key = index.artist_keys[artist_position][1]
+    return bisect.bisect_left(index.album_keys, (artist_key,)), bisect.bisect_left(index.album_keys, (artist_key + "\0",))
+
+def album_songs(index, album_position):
+    """Track IDs of an album's songs, sorted by title."""
+    return index.album_tracks[index.album_starts[album_position]:index.album_starts[album_position + 1]]
+
+# --- Library Watcher ---
+# Changes below MUSIC_DIR are applied to the library while it plays: inotify reports them
+# as they happen; where it is unavailable the tree is re-checked every WATCH_POLL_INTERVAL.
+WATCH_POLL_INTERVAL = 60 # Seconds between library checks when inotify is unavailable
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct("iIII") # wd, mask, cookie, name length
+
+def song_sort_name(track_id):
+    """Sort key of all_music_files."""
+    return track_names[track_id].lower()
+
+def add_library_song(path):
+    """Adds a song that appeared on disk, or refreshes one whose file changed."""
+    if not path.lower().endswith(SUPPORTED_EXTENSIONS) or not os.path.isfile(path):
+        return
+    global library_changes
+    invalidate_track_metadata(path)
+    with library_lock:
+        library_changes += 1
+        track_id = get_track_id(path)
+        if track_id not in indexed_songs:
+            all_music_files.insert(find_sorted_position(all_music_files, song_sort_name(track_id), song_sort_name), track_id)
+            track_in_library[track_id] = 1
+            scan_log.info("Library: added %s", os.path.basename(path))
+        else:
+            scan_log.info("Library: updated %s", os.path.basename(path))
+    index_song(track_id) # Re-reads the tags if the file changed
+    flush_metadata_cache()
+
+def remove_library_song(path):
+    """Removes a song that disappeared from disk, without interrupting playback."""
+    global library_changes
+    with library_lock:
+        track_id = get_track_id(path, create=False)
+        if track_id not in indexed_songs:
+            return
+        library_changes += 1
+        unindex_song(track_id)
+        all_music_files.remove(track_id)
+        track_in_library[track_id] = 0 # The shuffle, history and up-next queue skip it from now on
+    forget_track_metadata([path])
+    flush_metadata_cache()
+    scan_log.info("Library: removed %s", os.path.basename(path))
+
+def remove_library_folder(directory):
+    """Removes every song below a folder that was deleted or moved away."""
+    for track_id in tracks_below(directory):
+        remove_library_song(track_path(track_id))
+
+def rename_library_song(old_path, new_path):
+    """Applies a rename, keeping the cached tags of the file."""
+    move_track_metadata(old_path, new_path)
+    remove_library_song(old_path)
+    add_library_song(new_path)
+
+def watch_library_inotify(path):
+    """Applies library changes reported by inotify. Returns False if inotify is unavailable."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return False
+    if fd < 0:
+        return False
+
+    watched_dirs = {} # watch descriptor -> directory
+
+    def watch_tree(top):
+        for directory, _, _ in os.walk(top):
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK)
+            if wd >= 0:
+                watched_dirs[wd] = directory
+            else:
+                scan_log.warning("Cannot watch %s: %s", directory, os.strerror(ctypes.get_errno()))
+
+    watch_tree(path)
+    library_scan_done.wait() # Changes made during the initial scan are queued by the kernel until now
+    scan_log.info("Watching %d folders for library changes.", len(watched_dirs))
+
+    moved_from = {} # rename cookie -> old path, for files moved within the library
+    while True:
+        data = os.read(fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            name_start = offset + INOTIFY_EVENT.size
+            name = os.fsdecode(data[name_start:name_start + name_length].rstrip(b"\0"))
+            offset = name_start + name_length
+
+            if mask & IN_Q_OVERFLOW: # Events were lost: fall back to comparing with the disk
+                scan_log.warning("Library watcher overflowed, re-checking library.")
+                sync_library_with_disk(path)
+                continue
+            if mask & IN_IGNORED:
+                watched_dirs.pop(wd, None)
+                continue
+            directory = watched_dirs.get(wd)
+            if directory is None:
+                continue
+            full_path = os.path.join(directory, name)
+
+            try:
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO): # New folder: watch it and add what it already holds
+                        watch_tree(full_path)
+                        for song in iter_music_files(full_path):
+                            add_library_song(song)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        remove_library_folder(full_path)
+                elif mask & IN_MOVED_FROM:
+                    moved_from[cookie] = full_path
+                elif mask & IN_MOVED_TO and cookie in moved_from:
+                    rename_library_song(moved_from.pop(cookie), full_path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO): # Written, or moved in from outside the library
+                    add_library_song(full_path)
+                elif mask & IN_DELETE:
+                    remove_library_song(full_path)
+            except Exception as e:
+                scan_log.warning("Could not apply library change for %s: %s", full_path, e)
+
+        # A file moved out of the library never gets its matching MOVED_TO
+        for old_path in moved_from.values():
+            remove_library_song(old_path)
+        moved_from.clear()
+
+last_disk_state = None # {song path: (size, mtime_ns)} seen by the previous sync_library_with_disk()
+
+def sync_library_with_disk(path):
+    """Brings the library in line with the disk by comparing file listings (no tag parsing)."""
+    global last_disk_state
+    disk_state = {}
+    for song in iter_music_files(path):
+        try:
+            st = os.stat(song)
+        except OSError:
+            continue
+        disk_state[song] = (st.st_size, st.st_mtime_ns)
+
+    with library_lock:
+        known = {track_path(track_id) for track_id in indexed_songs}
+    for song in known - disk_state.keys():
+        remove_library_song(song)
+    for song, signature in disk_state.items():
+        if song not in known:
+            add_library_song(song)
+        elif last_disk_state is not None and last_disk_state.get(song) != signature:
+            add_library_song(song) # Changed since the last check
+    last_disk_state = disk_state
+
+def watch_library(path):
+    """Keeps the library in sync with the music folder (runs on its own thread)."""
+    try:
+        if watch_library_inotify(path):
+            return
+    except Exception as e:
+        scan_log.warning("inotify library watcher failed, falling back to polling: %s", e)
+    library_scan_done.wait()
+    scan_log.info("Polling library for changes every %ss.", WATCH_POLL_INTERVAL)
+    while True:
+        try:
+            sync_library_with_disk(path)
+        except Exception as e:
+            scan_log.warning("Library check failed: %s", e)
+        time.sleep(WATCH_POLL_INTERVAL)
+
+def start_library_watcher(path):
+    """Runs watch_library on a background thread."""
+    threading.Thread(target=watch_library, args=(path,), name="library-watcher", daemon=True).start()
+
+# --- Library Snapshot ---
+# After a scan the library is saved as one binary file: the track table, the library in
+# file-name order, the character buckets and the tags, with all strings in a single pool.
+# On the next start the file is mapped with mmap and used as it is: integer rows are
+# copied out in one go, strings are decoded only when something looks at them, and the
+# path lookup is built on first need. The disk is then compared with the snapshot on a
+# background thread, applying whatever changed while SHRIMP was not running, so playback
+# starts without waiting for a directory walk however big the library is.
+LIBRARY_SNAPSHOT_VERSION = 2 # 2: records library_id
+SNAPSHOT_MAGIC = b"SHRIMPLS"
+SNAPSHOT_NOT_INDEXED = 255 # Character code of songs not in the character index
+SNAPSHOT_NO_CHAR = 254     # Character code of indexed songs that fit no CHAR_LIST entry
+SNAPSHOT_SECTIONS = ( # Name and array type code (None: raw bytes), in file order
+    ("root", None), ("dir_of", 'I'), ("in_library", None), ("chars", None), ("library", 'I'),
+    ("bucket_starts", 'I'), ("bucket_tracks", 'I'), ("sizes", 'q'), ("mtimes", 'q'), ("durations", 'd'),
+    ("dirs", 'I'), ("names", 'I'), ("sort_keys", 'I'), ("titles", 'I'), ("artists", 'I'), ("albums", 'I'),
+    ("pool", None),
+)
+SNAPSHOT_HEADER = struct.Struct("=8sIIQ" + "QQ" * len(SNAPSHOT_SECTIONS)) # Native byte order: the file never leaves the device
+
+LibrarySnapshot = collections.namedtuple("LibrarySnapshot", [
+    "track_count", # Songs in the snapshot (track IDs from here on were assigned later)
+    "chars",       # Track ID -> CHAR_LIST position, SNAPSHOT_NO_CHAR or SNAPSHOT_NOT_INDEXED
+    "sizes",       # Track ID -> file size the tags were read at (-1: no tags stored)
+    "mtimes",      # Track ID -> file mtime_ns the tags were read at
+    "durations",
+    "titles", "artists", "albums", # SnapshotStrings
+])
+
+library_snapshot = None        # LibrarySnapshot the library was loaded from (None after a scan)
+snapshot_stale_paths = set()   # Files changed since the snapshot was written (their snapshot tags are not used)
+library_changes = 0            # Songs added, changed or removed by the watcher so far
+snapshot_saved_changes = 0     # library_changes when the snapshot was last written or loaded
+
+class SnapshotStrings:
+    """A list of strings backed by a string table of the mapped snapshot.
+
+    Entries are decoded the first time they are read; assignments and appends stay in
+    memory, so the mapped file is never written to.
+    """
+
+    def __init__(self, pool, offsets):
+        self.pool = pool
+        self.offsets = offsets
+        self.mapped_count = len(offsets) - 1
+        self.values = {} # index -> decoded or assigned string
+        self.added = []  # entries appended after loading
+
+    def __len__(self):
+        return self.mapped_count + len(self.added)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index >= self.mapped_count or index < 0:
+            return self.added[index - self.mapped_count]
+        value = self.values.get(index)
+        if value is None:
+            value = self.values[index] = str(self.pool[self.offsets[index]:self.offsets[index + 1]], "utf-8", "surrogatepass")
+        return value
+
+    def __setitem__(self, index, value):
+        if index >= self.mapped_count:
+            self.added[index - self.mapped_count] = value
+        else:
+            self.values[index] = value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def append(self, value):
+        self.added.append(value)
+
+    def clear(self):
+        self.pool, self.offsets, self.mapped_count = b"", array('I', [0]), 0
+        self.values.clear()
+        self.added.clear()
+
+def pack_strings(strings, pool):
+    """Appends strings to the pool (a bytearray); returns their offsets (one more than there are strings)."""
+    offsets = array('I', [len(pool)])
+    for string in strings:
+        pool += string.encode("utf-8", "surrogatepass") # Round-trips any str, including undecodable file names
+        offsets.append(len(pool))
+    return offsets
+
+def snapshot_track_metadata(track_id):
+    """Tags of a song as stored in the snapshot (None if it has none, or the file changed since)."""
+    snapshot = library_snapshot
+    if snapshot is None or track_id >= snapshot.track_count or snapshot.sizes[track_id] < 0:
+        return None
+    if snapshot_stale_paths and track_path(track_id) in snapshot_stale_paths:
+        return None
+    stats_count("metadata.snapshot_hit")
+    return {'title': snapshot.titles[track_id], 'artist': snapshot.artists[track_id],
+            'album': snapshot.albums[track_id], 'duration': snapshot.durations[track_id]}
+
+def forget_snapshot_metadata(path):
+    """Stops serving a file's tags from the snapshot (called when the file changed)."""
+    if library_snapshot is not None:
+        snapshot_stale_paths.add(path)
+
+def snapshot_track_record(track_id):
+    """(size, mtime_ns, metadata) of a song as far as it is known without touching the file (None if unknown)."""
+    metadata = snapshot_track_metadata(track_id)
+    if metadata is not None:
+        return library_snapshot.sizes[track_id], library_snapshot.mtimes[track_id], metadata
+    with metadata_lock:
+        return metadata_cache.get(track_path(track_id))
+
+def write_library_snapshot(music_dir=MUSIC_DIR, path=None):
+    """Saves the library for the next start (written to a temporary file first, then swapped in)."""
+    global snapshot_saved_changes
+    path = LIBRARY_SNAPSHOT_PATH if path is None else path
+    start = time.perf_counter()
+    ensure_track_lookup()
+    char_positions = {char: position for position, char in enumerate(CHAR_LIST)}
+    with library_lock: # Copy the integer rows; strings only ever change by being appended or reassigned
+        changes = library_changes
+        track_count, dir_count = len(track_names), len(track_dirs)
+        dir_of = track_dir_of[:track_count]
+        in_library = bytes(track_in_library[:track_count])
+        library = all_music_files[:]
+        chars = bytearray([SNAPSHOT_NOT_INDEXED]) * track_count
+        for track_id, char in indexed_songs.items():
+            chars[track_id] = SNAPSHOT_NO_CHAR if char is None else char_positions[char]
+        bucket_starts, bucket_tracks = array('I', [0]), array('I')
+        for char in CHAR_LIST:
+            bucket_tracks.extend(char_buckets[char])
+            bucket_starts.append(len(bucket_tracks))
+
+    sizes, mtimes, durations = array('q'), array('q'), array('d')
+    titles, artists, albums = [], [], []
+    for track_id in range(track_count):
+        record = snapshot_track_record(track_id) if in_library[track_id] else None
+        size, mtime_ns, metadata = record if record is not None else (-1, 0, {'title': "", 'artist': "", 'album': "", 'duration': 0.0})
+        sizes.append(size)
+        mtimes.append(mtime_ns)
+        durations.append(metadata['duration'])
+        titles.append(metadata['title'])
+        artists.append(metadata['artist'])
+        albums.append(metadata['album'])
+    pool = bytearray()
+    sections = {
+        "root": os.path.normpath(music_dir).encode("utf-8", "surrogatepass"),
+        "dir_of": dir_of, "in_library": in_library, "chars": chars, "library": library,
+        "bucket_starts": bucket_starts, "bucket_tracks": bucket_tracks,
+        "sizes": sizes, "mtimes": mtimes, "durations": durations,
+        "dirs": pack_strings((track_dirs[dir_id] for dir_id in range(dir_count)), pool),
+        "names": pack_strings((track_names[track_id] for track_id in range(track_count)), pool),
+        "sort_keys": pack_strings((track_sort_keys[track_id] for track_id in range(track_count)), pool),
+        "titles": pack_strings(titles, pool), "artists": pack_strings(artists, pool), "albums": pack_strings(albums, pool),
+        "pool": pool,
+    }
+
+    layout, position = [], SNAPSHOT_HEADER.size
+    for name, _ in SNAPSHOT_SECTIONS:
+        data = sections[name]
+        size = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        position += -position % 8 # Keep every section 8-byte aligned
+        layout.append((position, size))
+        position += size
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, LIBRARY_SNAPSHOT_VERSION, METADATA_SCHEMA_VERSION, library_id,
+                                         *itertools.chain.from_iterable(layout)))
+            for (name, _), (offset, _) in zip(SNAPSHOT_SECTIONS, layout):
+                f.write(b"\0" * (offset - f.tell()))
+                f.write(sections[name])
+        os.replace(tmp_path, path) # A mapped older snapshot stays valid: it keeps its own inode
+    except OSError as e:
+        scan_log.warning("Could not save library snapshot '%s': %s", path, e)
+        return
+    snapshot_saved_changes = changes
+    stats_timing("snapshot.write", time.perf_counter() - start)
+    scan_log.info("Library snapshot saved: %d songs, %d KiB.", len(library), position // 1024)
+
+def read_snapshot_sections(mapped, music_dir):
+    """Checks a mapped snapshot's header; returns its library_id and its sections as memoryviews (raises ValueError if unusable)."""
+    try:
+        header = SNAPSHOT_HEADER.unpack_from(mapped)
+    except struct.error:
+        raise ValueError("file is truncated")
+    magic, version, schema_version, snapshot_library_id = header[:4]
+    if magic != SNAPSHOT_MAGIC or version != LIBRARY_SNAPSHOT_VERSION or schema_version != METADATA_SCHEMA_VERSION:
+        raise ValueError("written by another version")
+    view = memoryview(mapped)
+    sections = {}
+    for index, (name, typecode) in enumerate(SNAPSHOT_SECTIONS):
+        offset, size = header[4 + 2 * index], header[5 + 2 * index]
+        if offset + size > len(mapped):
+            raise ValueError(f"section {name} is truncated")
+        section = view[offset:offset + size]
+        try:
+            sections[name] = section.cast(typecode) if typecode else section
+        except TypeError:
+            raise ValueError(f"section {name} is malformed")
+    if str(sections["root"], "utf-8", "surrogatepass") != os.path.normpath(music_dir):
+        raise ValueError("made for another music folder")
+    track_count = len(sections["dir_of"])
+    if any(len(sections[name]) != track_count for name in ("in_library", "chars", "sizes", "mtimes", "durations")) or \
+            any(len(sections[name]) != track_count + 1 for name in ("names", "sort_keys", "titles", "artists", "albums")) or \
+            len(sections["bucket_starts"]) != len(CHAR_LIST) + 1:
+        raise ValueError("sections do not match")
+    return snapshot_library_id, sections
+
+def load_library_snapshot(music_dir=MUSIC_DIR, path=None):
+    """Maps the library snapshot and makes it the library. Returns False if there is no usable one."""
+    global library_snapshot, track_dirs, track_names, track_sort_keys, track_dir_of, track_in_library
+    global track_lookup_ready, scan_progress, snapshot_saved_changes, library_id
+    path = LIBRARY_SNAPSHOT_PATH if path is None else path
+    start = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        snapshot_library_id, sections = read_snapshot_sections(mapped, music_dir)
+    except (OSError, ValueError) as e: # ValueError also covers an empty file, which cannot be mapped
+        scan_log.info("Not using library snapshot '%s': %s", path, e)
+        return False
+    if not len(sections["library"]):
+        return False
+
+    pool = sections["pool"]
+    with library_lock:
+        track_dirs = SnapshotStrings(pool, sections["dirs"])
+        track_names = SnapshotStrings(pool, sections["names"])
+        track_sort_keys = SnapshotStrings(pool, sections["sort_keys"])
+        track_dir_of = array('I')
+        track_dir_of.frombytes(sections["dir_of"].cast('B'))
+        track_in_library = bytearray(sections["in_library"])
+        track_dir_ids.clear()
+        track_dir_songs.clear()
+        track_lookup_ready = False # Built by ensure_track_lookup() when first needed
+        library_id = snapshot_library_id # The track IDs are the ones the snapshot was written with
+        del all_music_files[:]
+        all_music_files.frombytes(sections["library"].cast('B'))
+        bucket_starts, bucket_tracks = sections["bucket_starts"], sections["bucket_tracks"]
+        for position, char in enumerate(CHAR_LIST):
+            char_buckets[char] = array('I')
+            char_buckets[char].frombytes(bucket_tracks[bucket_starts[position]:bucket_starts[position + 1]].cast('B'))
+        library_snapshot = LibrarySnapshot(len(sections["dir_of"]), sections["chars"], sections["sizes"], sections["mtimes"],
+                                           sections["durations"], SnapshotStrings(pool, sections["titles"]),
+                                           SnapshotStrings(pool, sections["artists"]), SnapshotStrings(pool, sections["albums"]))
+        snapshot_stale_paths.clear()
+        snapshot_saved_changes = library_changes
+    scan_progress = (len(all_music_files), len(all_music_files))
+    library_first_track.set()
+    load_seconds = time.perf_counter() - start
+    stats_timing("snapshot.load", load_seconds)
+    scan_log.info("Loaded library snapshot: %d songs in %.1f ms.", len(all_music_files), load_seconds * 1000)
+    return True
+
+def ensure_track_lookup():
+    """Builds the path -> track ID lookup and the indexed-song map a snapshot leaves out (once, on first need)."""
+    global track_lookup_ready
+    if track_lookup_ready:
+        return
+    with library_lock:
+        if track_lookup_ready:
+            return
+        for dir_id in range(len(track_dirs)):
+            track_dir_ids[sys.intern(track_dirs[dir_id])] = dir_id
+            track_dir_songs.append({})
+        for track_id in range(library_snapshot.track_count):
+            track_dir_songs[track_dir_of[track_id]][track_names[track_id]] = track_id
+        for track_id, position in enumerate(library_snapshot.chars):
+            if position != SNAPSHOT_NOT_INDEXED:
+                indexed_songs[track_id] = None if position == SNAPSHOT_NO_CHAR else CHAR_LIST[position]
+        track_lookup_ready = True
+
+def validate_library_snapshot(path):
+    """Compares the snapshot with the disk and applies what changed since it was written."""
+    global last_disk_state
+    start = time.perf_counter()
+    try:
+        open_metadata_cache()
+        ensure_track_lookup()
+        snapshot = library_snapshot
+        with library_lock: # Seed the watcher's last listing with the snapshot, so changed files are noticed
+            last_disk_state = {track_path(track_id): (snapshot.sizes[track_id], snapshot.mtimes[track_id])
+                               for track_id in all_music_files if track_id < snapshot.track_count}
+        sync_library_with_disk(path)
+        build_browse_index()
+        if library_changes != snapshot_saved_changes:
+            write_library_snapshot(path)
+    finally:
+        library_scan_done.set()
+    scan_log.info("Library snapshot checked in %.1fs: %d changes applied.", time.perf_counter() - start, library_changes)
+
+def start_snapshot_validation(path):
+    """Runs validate_library_snapshot on a background thread."""
+    def run_validation():
+        try:
+            validate_library_snapshot(path)
+        except Exception as e:
+            scan_log.exception("Library snapshot check failed: %s", e)
+
+    threading.Thread(target=run_validation, name="snapshot-check", daemon=True).start()
+
+def save_library_snapshot_if_changed(music_dir=MUSIC_DIR):
+    """Writes the snapshot again if the watcher changed the library since it was saved."""
+    if library_scan_done.is_set() and library_changes != snapshot_saved_changes:
+        write_library_snapshot(music_dir)
+
+# --- Shuffle Engine ---
+# Songs are drawn with a lazy Fisher-Yates shuffle over the track IDs: each draw swaps one
+# random not-yet-drawn ID into place, so a round over the library is never generated up
+# front and every step is O(1). Songs added meanwhile simply extend the range still to be
+# drawn. Songs picked by hand go to an up-next queue, and what was played is kept in a
+# bounded history that "previous" walks back through (and "next" forward again).
+SHUFFLE_HISTORY_SIZE = 200 # Songs remembered for "previous"
+SHUFFLE_REDRAWS = 3        # Attempts to avoid drawing a song that is playing or about to
+
+shuffle_swaps = {}   # position -> track ID swapped there by an earlier draw of this round
+shuffle_drawn = 0    # Positions of this round drawn so far
+shuffle_ahead = collections.deque()  # Drawn songs not played yet (the gapless queue peeks at them)
+up_next = collections.deque()        # Songs queued by hand, played before the shuffle continues
+play_history = collections.deque(maxlen=SHUFFLE_HISTORY_SIZE) # Recently played songs, oldest first
+history_position = -1 # Index in play_history of the current song (not the last one after "previous")
+
+def reset_shuffle():
+    """Starts over with a fresh shuffle, no history and nothing queued."""
+    global shuffle_drawn, history_position
+    with library_lock:
+        shuffle_swaps.clear()
+        shuffle_drawn = 0
+        shuffle_ahead.clear()
+        up_next.clear()
+        play_history.clear()
+        history_position = -1
+
+def current_song():
+    """Track ID of the current song (None before the first one)."""
+    with library_lock:
+        return play_history[history_position] if history_position >= 0 else None
+
+def draw_shuffled_song(avoid=()):
+    """Draws the next song of the shuffle, starting a new round when all were drawn (None if the library is empty)."""
+    global shuffle_drawn
+    with library_lock:
+        for _ in range(2): # The rest of this round, then at most one new round
+            while shuffle_drawn < len(track_names):
+                for _ in range(SHUFFLE_REDRAWS): # Only tiny libraries ever need more than one try
+                    position = random.randrange(shuffle_drawn, len(track_names))
+                    track_id = shuffle_swaps.get(position, position)
+                    if track_id not in avoid:
+                        break
+                shuffle_swaps.pop(position, None)
+                if position != shuffle_drawn: # Move the song at the front of the undrawn range into its spot
+                    shuffle_swaps[position] = shuffle_swaps.pop(shuffle_drawn, shuffle_drawn)
+                shuffle_drawn += 1
+                if track_in_library[track_id]: # Removed songs and stale IDs are passed over
+                    return track_id
+            shuffle_swaps.clear()
+            shuffle_drawn = 0
+            if not all_music_files:
+                break
+        return None
+
+def upcoming_songs(count):
+    """The next count songs "next" will play, drawing them from the shuffle as needed."""
+    with library_lock:
+        count = min(count, len(all_music_files) - 1) # No song comes up twice at once
+        upcoming = [track_id for track_id in itertools.islice(play_history, history_position + 1, None)
+                    if track_in_library[track_id]]
+        upcoming += [track_id for track_id in up_next if track_in_library[track_id]]
+        upcoming += [track_id for track_id in shuffle_ahead if track_in_library[track_id]]
+        while len(upcoming) < count:
+            track_id = draw_shuffled_song(avoid=set(upcoming) | {current_song()})
+            if track_id is None:
+                break
+            shuffle_ahead.append(track_id)
+            upcoming.append(track_id)
+        return upcoming[:max(count, 0)]
+
+def push_history(track_id):
+    """Makes track_id the current song, forgetting the songs "previous" had stepped back over."""
+    global history_position
+    while len(play_history) > history_position + 1:
+        play_history.pop()
+    play_history.append(track_id)
+    history_position = len(play_history) - 1
+
+def next_song():
+    """Moves on to the next song (forward in the history, up next, then the shuffle) and returns it."""
+    global history_position
+    with library_lock:
+        while history_position + 1 < len(play_history):
+            history_position += 1
+            if track_in_library[play_history[history_position]]:
+                return play_history[history_position]
+        for pending in (up_next, shuffle_ahead):
+            while pending:
+                track_id = pending.popleft()
+                if track_in_library[track_id]:
+                    push_history(track_id)
+                    return track_id
+        track_id = draw_shuffled_song(avoid={current_song()})
+        if track_id is not None:
+            push_history(track_id)
+        return track_id
+
+def previous_song():
+    """Steps back to the song played before the current one (the current song again at the start of the history)."""
+    global history_position
+    with library_lock:
+        for position in range(history_position - 1, -1, -1):
+            if track_in_library[play_history[position]]:
+                history_position = position
+                return play_history[position]
+        return current_song()
+
+def forget_pending_song(track_id):
+    """Takes a song out of up next and the drawn songs, so picking it by hand does not play it twice."""
+    with library_lock:
+        for pending in (up_next, shuffle_ahead):
+            while track_id in pending:
+                pending.remove(track_id)
+
+def play_song_now(track_id):
+    """Makes a hand-picked song the current one; "next" continues with the shuffle after it."""
+    with library_lock:
+        forget_pending_song(track_id)
+        push_history(track_id)
+
+def enqueue_song(track_id):
+    """Queues a song to play after the current one (and after songs queued before it)."""
+    with library_lock:
+        if track_id in shuffle_ahead: # Drawn already: it plays from up next instead
+            shuffle_ahead.remove(track_id)
+        up_next.append(track_id)
+
+def advance_to_song(track_id):
+    """Follows the player to track_id: a normal "next" if it was next up, otherwise like play_song_now()."""
+    with library_lock:
+        if upcoming_songs(1) == [track_id]:
+            next_song()
+        elif current_song() != track_id: # What comes next changed after the song was queued
+            play_song_now(track_id)
+
+# --- Gapless Queue ---
+# The current song and the next LOOKAHEAD_TRACKS are handed to VLC up front as a media
+# list, so it moves on to the next file without waiting for us. Songs about to be queued
+# are parsed (VLC and tags) ahead of time on a background thread.
+LOOKAHEAD_TRACKS = 2   # Upcoming songs kept queued in VLC
+MEDIA_QUEUE_MAX = 32   # Songs a VLC media list may collect before the played ones are taken off it
+
+queued_media_list = None  # vlc.MediaList handed to list_player
+queued_tracks = []        # Track IDs of the songs in queued_media_list, in order
+queued_mrls = {}          # MRL -> position in queued_tracks, to recognise what VLC moved on to
+queued_position = 0       # Position in queued_tracks of the song VLC is playing
+prepared_media = collections.OrderedDict() # track ID -> vlc.Media parsed ahead of time
+prepared_lock = threading.Lock()
+prepare_requests = queue.Queue()
+
+def prepare_worker():
+    """Look-ahead thread: parses upcoming songs with VLC and warms their metadata."""
+    while True:
+        track_id = prepare_requests.get()
+        with prepared_lock:
+            if track_id in prepared_media:
+                continue
+        path = track_path(track_id)
+        try:
+            media = instance.media_new(path)
+            media.parse_with_options(vlc.MediaParseFlag.local, 0) # Asynchronous inside libVLC
+            get_track_metadata_by_id(track_id)
+        except Exception as e:
+            player_log.warning("Could not prepare %s: %s", os.path.basename(path), e)
+            continue
+        with prepared_lock:
+            prepared_media[track_id] = media
+            while len(prepared_media) > LOOKAHEAD_TRACKS + 1: # Drop songs we skipped past
+                prepared_media.popitem(last=False)
+
+def start_prepare_worker():
+    """Starts the look-ahead thread."""
+    threading.Thread(target=prepare_worker, name="prepare", daemon=True).start()
+
+def queue_media(track_id):
+    """Appends a song to the VLC media list, using its prepared media if there is one."""
+    with prepared_lock:
+        media = prepared_media.pop(track_id, None)
+    if media is None:
+        media = instance.media_new(track_path(track_id))
+    queued_media_list.lock()
+    try:
+        queued_media_list.add_media(media)
+    finally:
+        queued_media_list.unlock()
+    queued_mrls[media.get_mrl()] = len(queued_tracks)
+    queued_tracks.append(track_id)
+
+def top_up_media_queue():
+    """Keeps LOOKAHEAD_TRACKS songs queued after the current one and the song after them prepared."""
+    upcoming = upcoming_songs(LOOKAHEAD_TRACKS + 1)
+    already_queued = len(queued_tracks) - queued_position - 1
+    if len(queued_tracks) >= MEDIA_QUEUE_MAX:
+        trim_media_queue()
+    for track_id in upcoming[already_queued:LOOKAHEAD_TRACKS]:
+        queue_media(track_id)
+    for track_id in upcoming[LOOKAHEAD_TRACKS:]:
+        prepare_requests.put(track_id)
+    for track_id in upcoming:
+        readahead_requests.put(track_path(track_id))
+
+def trim_media_queue():
+    """Takes the songs played before the current one off the head of VLC's list, so the list never runs out."""
+    global queued_mrls, queued_position
+    queued_media_list.lock()
+    try:
+        for _ in range(queued_position):
+            queued_media_list.remove_index(0)
+    finally:
+        queued_media_list.unlock()
+    del queued_tracks[:queued_position]
+    queued_mrls = {mrl: position - queued_position for mrl, position in queued_mrls.items() if position >= queued_position}
+    queued_position = 0
+
+def unqueue_upcoming():
+    """Takes the songs queued after the current one off VLC's list (top_up_media_queue() queues what comes next now)."""
+    global queued_mrls
+    if queued_media_list is None:
+        return
+    queued_media_list.lock()
+    try:
+        for position in range(len(queued_tracks) - 1, queued_position, -1):
+            queued_media_list.remove_index(position)
+    finally:
+        queued_media_list.unlock()
+    del queued_tracks[queued_position + 1:]
+    queued_mrls = {mrl: position for mrl, position in queued_mrls.items() if position <= queued_position}
+
+def start_media_queue(track_id):
+    """Replaces VLC's media list with a song followed by the upcoming songs, and starts playing it."""
+    global queued_media_list, queued_tracks, queued_mrls, queued_position
+    queued_media_list = instance.media_list_new()
+    queued_tracks = []
+    queued_mrls = {}
+    queued_position = 0
+    queue_media(track_id)
+    top_up_media_queue()
+    list_player.set_media_list(queued_media_list)
+    list_player.play_item_at_index(0)
+
+def handle_next_item():
+    """Follows VLC moving on to the next queued song by itself."""
+    global queued_position, current_track_metadata
+    media = vlc_player.get_media()
+    position = queued_mrls.get(media.get_mrl()) if media is not None else None
+    if position is None or position == queued_position: # Not ours, or the song we just started
+        return
+    queued_position = position
+    track_id = queued_tracks[position]
+    filepath = track_path(track_id)
+    advance_to_song(track_id)
+    current_track_metadata = get_track_metadata_by_id(track_id) # Already cached by the look-ahead
+    record_track_start(filepath)
+    level_track(filepath)
+    player_log.info("Playing: %s by %s", current_track_metadata['title'], current_track_metadata['artist'])
+    flash_message("PLAY", C_GREEN, duration_secs=1.5) # Flash play sign
+    top_up_media_queue()
+
+# --- Storage Read-Ahead ---
+# Upcoming songs are read into the page cache in the background, so VLC does not have to
+# wait for a slow SD card or USB stick when it opens them (and competes less with tag reads).
+READAHEAD_BUDGET_BYTES = 64 * 1024 * 1024 # Bytes of upcoming songs kept read ahead
+READAHEAD_CHUNK_BYTES = 1024 * 1024       # Size of each background read
+
+readahead_requests = queue.Queue()
+readahead_window = collections.OrderedDict() # path -> (bytes read ahead, file size) for upcoming songs
+readahead_lock = threading.Lock()
+
+def readahead_file(path, budget, buffer):
+    """Reads up to budget bytes of a file so they land in the page cache; returns (bytes read, file size)."""
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        length = min(size, budget)
+        if hasattr(os, "posix_fadvise"): # Let the kernel queue the whole range at once
+            os.posix_fadvise(f.fileno(), 0, length, os.POSIX_FADV_WILLNEED)
+        view = memoryview(buffer)
+        done = 0
+        while done < length:
+            count = f.readinto(view[:min(len(buffer), length - done)])
+            if not count:
+                break
+            done += count
+    return done, size
+
+def readahead_worker():
+    """Read-ahead thread: warms upcoming songs within READAHEAD_BUDGET_BYTES."""
+    buffer = bytearray(READAHEAD_CHUNK_BYTES)
+    while True:
+        path = readahead_requests.get()
+        with readahead_lock:
+            if path in readahead_window:
+                continue
+            while len(readahead_window) > LOOKAHEAD_TRACKS + 1: # Forget songs that were skipped
+                readahead_window.popitem(last=False)
+            budget = READAHEAD_BUDGET_BYTES - sum(done for done, _ in readahead_window.values())
+        if budget <= 0:
+            continue
+        try:
+            done, size = readahead_file(path, budget, buffer)
+        except OSError as e:
+            player_log.warning("Could not read ahead %s: %s", os.path.basename(path), e)
+            continue
+        with readahead_lock:
+            readahead_window[path] = (done, size)
+
+def start_readahead_worker():
+    """Starts the read-ahead thread."""
+    threading.Thread(target=readahead_worker, name="readahead", daemon=True).start()
+
+def record_track_start(path):
+    """Counts whether a song that starts had been fully read ahead."""
+    with readahead_lock:
+        done, size = readahead_window.pop(path, (0, -1))
+    stats_count("readahead.hit" if done == size else "readahead.miss")
 
-    if not current_playlist or not (0 <= index < len(current_playlist)):
-        print("Error: No valid track to play or index out of bounds.")
+# --- Player Controls ---
+play_requested_at = None # perf_counter() of the last play_track() until VLC reports it playing
+volume_setting = DEFAULT_VOLUME # The volume shown as "Vol"; VLC gets it levelled by the song's gain
+track_gain = 0.0                # dB the current song is levelled by
+
+def analysed_track_gain(filepath):
+    """The gain --analyze measured for a song (0 dB if none); a dictionary lookup once the cache is loaded."""
+    if not REPLAY_GAIN:
+        return 0.0
+    with metadata_lock:
+        analysis = track_analysis.get(filepath)
+        loaded = track_analysis_loaded
+    if analysis is None and not loaded: # Snapshot start: the cache is still being opened in the background
+        analysis = read_track_analysis(filepath)
+    if analysis is None or analysis[4] is None:
+        return 0.0
+    return max(-MAX_TRACK_GAIN, min(MAX_TRACK_GAIN, analysis[4]))
+
+def apply_volume():
+    """Sets VLC's volume: the chosen volume, levelled by the current song's gain."""
+    vlc_player.audio_set_volume(max(0, min(100, round(volume_setting * 10 ** (track_gain / 20)))))
+
+def level_track(filepath):
+    """Applies the gain of a song that starts playing."""
+    global track_gain
+    gain = analysed_track_gain(filepath)
+    if gain != track_gain:
+        track_gain = gain
+        apply_volume()
+
+def play_track(track_id):
+    """Plays a song (the shuffle engine decides which one is current; this only starts playback)."""
+    global player_state, current_track_metadata, play_requested_at
+
+    if track_id is None or not track_in_library[track_id]:
+        player_log.error("No valid track to play.")
         player_state = PLAYER_STOPPED
         return
 
-    current_track_index = index
-    filepath = current_playlist[current_track_index]
-    current_track_metadata = get_track_metadata(filepath)
+    play_requested_at = time.perf_counter()
+    filepath = track_path(track_id)
+    current_track_metadata = get_track_metadata_by_id(track_id)
 
-    print(f"Playing: {current_track_metadata['title']} by {current_track_metadata['artist']}")
-    media = instance.media_new(filepath)
-    vlc_player.set_media(media)
-    vlc_player.play()
+    player_log.info("Playing: %s by %s", current_track_metadata['title'], current_track_metadata['artist'])
+    record_track_start(filepath)
+    level_track(filepath)
+    start_media_queue(track_id)
     player_state = PLAYER_PLAYING
+    stats_timing("play_track.call", time.perf_counter() - play_requested_at)
     flash_message("PLAY", C_GREEN, duration_secs=1.5) # Flash play sign
 
 def play_pause():
@@ -212,47 +2613,45 @@ def play_pause():
     if vlc_player.is_playing():
         vlc_player.pause()
         player_state = PLAYER_PAUSED
-        print("Paused.")
+        player_log.info("Paused.")
         flash_message("PAUSE", C_BLUE, duration_secs=1.5) # Flash pause sign
     else:
         if player_state == PLAYER_PAUSED:
             vlc_player.play()
             player_state = PLAYER_PLAYING
-            print("Resumed.")
+            player_log.info("Resumed.")
             flash_message("PLAY", C_GREEN, duration_secs=1.5) # Flash play sign
-        elif player_state == PLAYER_STOPPED and len(current_playlist) > 0:
-            play_track(0) # Start from first song if stopped and no track loaded
+        elif player_state == PLAYER_STOPPED and len(all_music_files) > 0:
+            play_next_song() # Start the shuffle if stopped and no track loaded
         else:
-            print("No track to resume/play.")
+            player_log.info("No track to resume/play.")
 
 def play_next_song():
-    """Plays the next song in the playlist (repeats all)."""
-    global current_track_index
-    if not current_playlist: return
-    next_index = (current_track_index + 1) % len(current_playlist)
-    play_track(next_index)
+    """Plays the next song (up next first, then the shuffle, which repeats all)."""
+    track_id = next_song()
+    if track_id is None: return
+    play_track(track_id)
 
 def play_previous_song():
-    """Plays the previous song in the playlist (repeats all)."""
-    global current_track_index
-    if not current_playlist: return
-    prev_index = (current_track_index - 1 + len(current_playlist)) % len(current_playlist)
-    play_track(prev_index)
+    """Plays the song played before the current one."""
+    track_id = previous_song()
+    if track_id is None: return
+    play_track(track_id)
 
 def change_volume(delta):
     """Adjusts volume by delta and displays it."""
-    current_vol = vlc_player.audio_get_volume()
-    new_vol = max(0, min(100, current_vol + delta))
-    vlc_player.audio_set_volume(new_vol)
-    print(f"Volume: {new_vol}%")
-    flash_message(f"Vol {new_vol}%", C_CYAN, duration_secs=1.5)
+    global volume_setting
+    volume_setting = max(0, min(100, volume_setting + delta))
+    apply_volume()
+    player_log.info("Volume: %d%% (song gain %+.1f dB)", volume_setting, track_gain)
+    flash_message(f"Vol {volume_setting}%", C_CYAN, duration_secs=1.5)
 
 def stop_player():
     """Stops the current playback."""
     global player_state
-    vlc_player.stop()
+    list_player.stop()
     player_state = PLAYER_STOPPED
-    print("Stopped.")
+    player_log.info("Stopped.")
     clear_display()
 
 # --- Joystick Rotation Mapping ---
@@ -278,28 +2677,47 @@ def get_rotated_direction(original_direction):
 
 # --- Playing Now Mode Display & Input ---
 last_display_idle_time = 0
+library_ready_announced = False
 
 def handle_playing_now_display():
     """Manages display in Playing Now mode."""
-    global last_display_idle_time
+    global last_display_idle_time, library_ready_announced
+
+    # While the library is still being scanned, show how far indexing has got
+    if not library_scan_done.is_set():
+        display_progress(*scan_progress)
+        return
+    if not library_ready_announced:
+        library_ready_announced = True
+        scroll_text("READY!", text_colour=C_GREEN, scroll_speed=0.05)
 
     # Display song name periodically if not flashing other messages
     if player_state == PLAYER_PLAYING and time.time() - last_display_idle_time > DISPLAY_IDLE_INTERVAL:
         message = f"{current_track_metadata['title']}"
         if current_track_metadata['artist'] and current_track_metadata['artist'] != 'Unknown':
             message += f" - {current_track_metadata['artist']}"
-        print(f"Displaying idle: {message}")
-        scroll_text_blocking(message, text_colour=C_YELLOW, scroll_speed=0.08)
+        display_log.debug("Displaying idle: %s", message)
+        scroll_text(message, text_colour=C_YELLOW, scroll_speed=0.08, priority=DISPLAY_PRIORITY_IDLE)
         last_display_idle_time = time.time()
     elif player_state == PLAYER_STOPPED:
         clear_display()
 
+SCAN_PROGRESS_REFRESH = 0.25 # Seconds between progress bar updates while the library is scanned
+
+def playing_now_display_timeout():
+    """Seconds until handle_playing_now_display() has something new to show (None: nothing scheduled)."""
+    if not library_ready_announced:
+        return SCAN_PROGRESS_REFRESH
+    if player_state == PLAYER_PLAYING:
+        return max(0, last_display_idle_time + DISPLAY_IDLE_INTERVAL - time.time())
+    return None
+
 def handle_playing_now_input(event):
     """Handles joystick input in Playing Now mode."""
     global current_mode # Need to be able to change mode
 
     rotated_direction = get_rotated_direction(event.direction)
-    print(f"Playing Now: Physical {event.direction} -> Logical {rotated_direction}") # Debug print
+    input_log.debug("Playing Now: Physical %s -> Logical %s", event.direction, rotated_direction)
 
     if event.action == "pressed":
         if rotated_direction == "up":
@@ -310,7 +2728,7 @@ def handle_playing_now_input(event):
             play_next_song()
         elif rotated_direction == "left":
             # Transition to Song Select Character menu
-            print("Changing to Song Select (Character) Mode")
+            input_log.debug("Changing to Song Select (Character) Mode")
             animate_enter_from_left("#", C_WHITE) # Animation for menu change
             init_song_select_char_mode()
             current_mode = MODE_SONG_SELECT_CHAR
@@ -318,115 +2736,217 @@ def handle_playing_now_input(event):
             play_pause()
 
 # --- Song Select (Characters) Mode ---
-CHAR_LIST = ['#', '1', 'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z']
+# The characters filter song titles (orange) or, after "down", artists (magenta).
+SELECT_BY_TITLE = "TITLE"
+SELECT_BY_ARTIST = "ARTIST"
+
+BUCKET_SIZE_DELAY = 0.8 # Seconds a character is shown before the number of songs under it scrolls by
+
 current_char_index = 0
-filtered_song_paths = [] # Songs that start with selected character/type
+char_select_source = SELECT_BY_TITLE # What the characters filter
+filtered_song_ids = array('I') # Track IDs of the songs that start with selected character/type
 last_selected_char_display = None # To re-display when returning from title select
 
-def init_song_select_char_mode():
+def init_song_select_char_mode(source=SELECT_BY_TITLE, char_index=None):
     """Initializes state for Character Selection mode."""
-    global current_char_index, filtered_song_paths, last_selected_char_display
-    current_char_index = 0 # Reset to first character
-    filtered_song_paths = [] # Clear previous filters
+    global current_char_index, filtered_song_ids, last_selected_char_display, char_select_source, browsing_index
+    char_select_source = source
+    if source == SELECT_BY_ARTIST:
+        browsing_index = get_browse_index()
+    if char_index is None:
+        char_index = find_nonempty_char_index(0, 1) # Reset to first character that has songs
+    current_char_index = char_index
+    filtered_song_ids = array('I') # Clear previous filters
     last_selected_char_display = CHAR_LIST[current_char_index] # Initial display
     display_current_char(animate=False) # Display without animation initially
-    print("Entered Song Select (Character) Mode")
+    input_log.debug("Entered Song Select (Character) Mode, by %s", source.lower())
+
+def char_entry_count(char):
+    """Number of songs (or artists, when selecting by artist) filed under a CHAR_LIST entry."""
+    if char_select_source == SELECT_BY_ARTIST:
+        first, end = artist_range(browsing_index, char)
+        return end - first
+    return char_bucket_count(char)
+
+def char_select_colour():
+    """Colour of the characters: tells selecting by title and by artist apart."""
+    return C_MAGENTA if char_select_source == SELECT_BY_ARTIST else C_ORANGE
+
+def find_nonempty_char_index(start_index, step):
+    """Walks CHAR_LIST from start_index in the given direction to the first character with songs."""
+    for offset in range(len(CHAR_LIST)):
+        index = (start_index + offset * step) % len(CHAR_LIST)
+        if char_entry_count(CHAR_LIST[index]):
+            return index
+    return start_index % len(CHAR_LIST) # Empty library: nothing to skip to
 
 def display_current_char(animate=True, direction=None):
     """Displays the current character on Sense HAT with optional animation."""
     global last_selected_char_display
     char_to_display = CHAR_LIST[current_char_index]
-    
-    # Simplified animation: show the letter directly
-    clear_display()
-    sense.show_letter(char_to_display, text_colour=C_ORANGE) # Show character brightly
+    colour = char_select_colour()
+
+    # Simplified animation: show the letter directly; if it stays selected, how many songs (or artists) it holds
+    show_on_display([("letter", char_to_display, colour), ("hold", BUCKET_SIZE_DELAY),
+                     ("scroll", str(char_entry_count(char_to_display)), colour, C_BLACK, 0.05),
+                     ("letter", char_to_display, colour)])
     last_selected_char_display = char_to_display # Update last displayed char
 
 def handle_song_select_char_input(event):
     """Handles joystick input in Character Selection mode."""
-    global current_mode, current_char_index, filtered_song_paths
+    global current_mode, current_char_index, filtered_song_ids, title_select_parent
 
     rotated_direction = get_rotated_direction(event.direction)
-    print(f"Char Select: Physical {event.direction} -> Logical {rotated_direction}") # Debug print
+    input_log.debug("Char Select: Physical %s -> Logical %s", event.direction, rotated_direction)
 
     if event.action == "pressed":
         if rotated_direction == "up":
             # Back to Playing Now
-            print("Changing to Playing Now Mode from Char Select")
-            animate_slide_out_left(CHAR_LIST[current_char_index], C_ORANGE) # Animation
+            input_log.debug("Changing to Playing Now Mode from Char Select")
+            animate_slide_out_left(CHAR_LIST[current_char_index], char_select_colour()) # Animation
             current_mode = MODE_PLAYING_NOW
             handle_playing_now_display() # Re-display current song info (idle)
+        elif rotated_direction == "down" and char_select_source == SELECT_BY_TITLE:
+            # First down: the characters select artists instead of titles
+            input_log.debug("Char Select now by Artist")
+            flash_message("ARTIST", C_MAGENTA, duration_secs=0.5, scroll_speed=0.05)
+            init_song_select_char_mode(SELECT_BY_ARTIST)
         elif rotated_direction == "down":
             # Down idea: Go directly to 'All Songs' list (bypassing initial char filter)
-            print("Direct to All Songs from Char Select")
-            # Ensure filtered_song_paths is updated correctly
-            filtered_song_paths[:] = list(all_music_files) # Set to all music files
-            if filtered_song_paths:
+            input_log.debug("Direct to All Songs from Char Select")
+            # Ensure filtered_song_ids is updated correctly
+            filtered_song_ids = all_music_files # Set to all music files (kept current by the library watcher)
+            if filtered_song_ids:
+                title_select_parent = MODE_SONG_SELECT_CHAR
                 init_song_select_title_mode()
                 current_mode = MODE_SONG_SELECT_TITLE
             else:
                 flash_message("No Songs!", C_RED)
                 display_current_char(animate=False) # Remain on char select
         elif rotated_direction == "left":
-            # Previous Character
-            current_char_index = (current_char_index - 1 + len(CHAR_LIST)) % len(CHAR_LIST)
+            # Previous Character (skipping characters without songs)
+            current_char_index = find_nonempty_char_index(current_char_index - 1, -1)
             display_current_char(animate=True, direction="right") # Animate entry from right
         elif rotated_direction == "right":
-            # Next Character
-            current_char_index = (current_char_index + 1) % len(CHAR_LIST)
+            # Next Character (skipping characters without songs)
+            current_char_index = find_nonempty_char_index(current_char_index + 1, 1)
             display_current_char(animate=True, direction="left") # Animate entry from left
+        elif rotated_direction == "middle" and char_select_source == SELECT_BY_ARTIST:
+            # Select Character: browse the artists filed under it
+            selected_char = CHAR_LIST[current_char_index]
+            input_log.debug("Selected artist character: %s", selected_char)
+            if char_entry_count(selected_char):
+                init_browse_artist_mode(selected_char)
+                current_mode = MODE_BROWSE_ARTIST
+            else:
+                flash_message("No Match!", C_RED, duration_secs=1)
+                display_current_char(animate=False)
         elif rotated_direction == "middle":
             # Select Character
             selected_char = CHAR_LIST[current_char_index]
-            print(f"Selected character: {selected_char}")
+            input_log.debug("Selected character: %s", selected_char)
             
             # Animation: Character zooms (simplified)
-            clear_display()
-            sense.show_letter(selected_char, text_colour=C_GREEN)
-            time.sleep(0.3) # "Zoom" effect pause
-            clear_display()
-            time.sleep(0.1)
-            sense.show_letter(selected_char, text_colour=C_GREEN)
-            time.sleep(0.3)
-            clear_display()
-
-            # Filter songs based on selected character (using song title metadata)
-            temp_filtered_songs = []
-            for s in all_music_files:
-                metadata = get_track_metadata(s)
-                title_lower = metadata['title'].lower()
-                
-                if selected_char == '#': # Symbols/Numbers
-                    if title_lower and not title_lower[0].isalpha() and not title_lower[0].isdigit():
-                        temp_filtered_songs.append(s)
-                elif selected_char == '1': # Numbers
-                    if title_lower and title_lower[0].isdigit():
-                        temp_filtered_songs.append(s)
-                else: # Alphabetical
-                    if title_lower and title_lower.startswith(selected_char.lower()):
-                        temp_filtered_songs.append(s)
-            
-            # Assign to global only after processing all
-            filtered_song_paths[:] = temp_filtered_songs # Use slice assignment to modify list in place
-            filtered_song_paths.sort(key=lambda x: get_track_metadata(x)['title'].lower()) # Sort by title
-
-            if filtered_song_paths:
-                print(f"Found {len(filtered_song_paths)} songs for character '{selected_char}'")
+            show_on_display([("letter", selected_char, C_GREEN), ("hold", 0.3), # "Zoom" effect pause
+                             ("clear",), ("hold", 0.1),
+                             ("letter", selected_char, C_GREEN), ("hold", 0.3), ("clear",)])
+
+            # Songs are pre-filtered and sorted by title in the character index
+            filtered_song_ids = char_buckets[selected_char]
+
+            if len(filtered_song_ids) >= PREFIX_SELECT_MIN_SONGS:
+                # Too many titles to step through: narrow them down by their second character first
+                init_song_select_prefix_mode(selected_char)
+                current_mode = MODE_SONG_SELECT_PREFIX
+            elif filtered_song_ids:
+                input_log.debug("Found %d songs for character '%s'", len(filtered_song_ids), selected_char)
+                title_select_parent = MODE_SONG_SELECT_CHAR
                 init_song_select_title_mode()
                 current_mode = MODE_SONG_SELECT_TITLE
             else:
                 flash_message("No Match!", C_RED, duration_secs=1)
                 display_current_char(animate=False) # Go back to character selection if no match
 
+# --- Song Select (Prefix) Mode ---
+# Characters with PREFIX_SELECT_MIN_SONGS songs or more are narrowed down by the second
+# character of the titles (yellow) before the titles themselves. Each second character is a
+# run of the character's regrouped songs (see char_prefix_runs), so moving between them and on
+# to their first title are jumps to known positions, however many songs the character holds.
+PREFIX_SELECT_MIN_SONGS = 40 # Characters with fewer songs go straight to their titles
+
+prefix_select_char = None # CHAR_LIST entry whose titles are narrowed down
+prefix_select_runs = None # PrefixRuns of its bucket, as they were when it was opened
+current_prefix_index = 0  # Selected run
+
+def init_song_select_prefix_mode(char, prefix_index=0):
+    """Initializes state for Prefix Selection mode."""
+    global prefix_select_char, prefix_select_runs, current_prefix_index
+    prefix_select_char = char
+    prefix_select_runs = char_prefix_runs(char)
+    current_prefix_index = prefix_index
+    display_current_prefix()
+    input_log.debug("Entered Song Select (Prefix) Mode for '%s'", char)
+
+def display_current_prefix():
+    """Shows the selected second character; if it stays selected, both characters and how many titles start with them."""
+    global current_prefix_index
+    runs = prefix_select_runs
+    if not runs.chars: # The songs were removed meanwhile
+        clear_display()
+        return
+    current_prefix_index = min(current_prefix_index, len(runs.chars) - 1)
+    prefix_char = runs.chars[current_prefix_index]
+    count = runs.starts[current_prefix_index + 1] - runs.starts[current_prefix_index]
+    show_on_display([("letter", prefix_char, C_YELLOW), ("hold", BUCKET_SIZE_DELAY),
+                     ("scroll", f"{prefix_select_char}{prefix_char} {count}", C_YELLOW, C_BLACK, 0.05),
+                     ("letter", prefix_char, C_YELLOW)])
+
+def next_prefix_position(position, steps):
+    """Position of the first title steps runs away from the run of position (wrapping around)."""
+    runs = prefix_select_runs
+    return runs.starts[(prefix_run_at(runs, position) + steps) % len(runs.chars)]
+
+def handle_song_select_prefix_input(event):
+    """Handles joystick input in Prefix Selection mode."""
+    global current_mode, current_prefix_index, filtered_song_ids, title_select_parent
+
+    rotated_direction = get_rotated_direction(event.direction)
+    input_log.debug("Prefix Select: Physical %s -> Logical %s", event.direction, rotated_direction)
+
+    if event.action == "pressed":
+        runs = prefix_select_runs
+        if rotated_direction == "up":
+            # Back to Character Selection, on the same character
+            input_log.debug("Changing to Song Select (Character) Mode from Prefix Select")
+            init_song_select_char_mode(char_index=CHAR_LIST.index(prefix_select_char))
+            current_mode = MODE_SONG_SELECT_CHAR
+        elif not runs.chars:
+            flash_message("No Match!", C_RED, duration_secs=1)
+        elif rotated_direction == "left":
+            # Previous second character
+            current_prefix_index = (current_prefix_index - 1) % len(runs.chars)
+            display_current_prefix()
+        elif rotated_direction == "right":
+            # Next second character
+            current_prefix_index = (current_prefix_index + 1) % len(runs.chars)
+            display_current_prefix()
+        elif rotated_direction == "middle":
+            # Select: the titles of the character, from the first one starting with both characters
+            filtered_song_ids = runs.tracks
+            title_select_parent = MODE_SONG_SELECT_PREFIX
+            init_song_select_title_mode(runs.starts[min(current_prefix_index, len(runs.chars) - 1)])
+            current_mode = MODE_SONG_SELECT_TITLE
+
 # --- Song Select (Title) Mode ---
 current_filtered_index = 0
+title_select_parent = MODE_SONG_SELECT_CHAR # Mode "up" goes back to
 
-def init_song_select_title_mode():
+def init_song_select_title_mode(start_index=0):
     """Initializes state for Title Selection mode."""
     global current_filtered_index
-    current_filtered_index = 0
-    print("Entered Song Select (Title) Mode")
-    if filtered_song_paths:
+    current_filtered_index = start_index
+    input_log.debug("Entered Song Select (Title) Mode")
+    if filtered_song_ids:
         display_current_title()
     else:
         clear_display()
@@ -437,26 +2957,35 @@ def init_song_select_title_mode():
 
 def display_current_title():
     """Displays the current title from the filtered list on Sense HAT."""
-    if filtered_song_paths and 0 <= current_filtered_index < len(filtered_song_paths):
-        filepath = filtered_song_paths[current_filtered_index]
-        metadata = get_track_metadata(filepath)
+    if filtered_song_ids and 0 <= current_filtered_index < len(filtered_song_ids):
+        metadata = get_track_metadata_by_id(filtered_song_ids[current_filtered_index])
         message = f"{metadata['title']}"
-        print(f"Displaying title: {message}")
-        scroll_text_blocking(message, text_colour=C_YELLOW, scroll_speed=0.08)
+        display_log.debug("Displaying title: %s", message)
+        scroll_text(message, text_colour=C_YELLOW, scroll_speed=0.08)
     else:
         clear_display() # No title to display
 
 def handle_song_select_title_input(event):
     """Handles joystick input in Title Selection mode."""
-    global current_mode, current_filtered_index, current_playlist, current_track_index
+    global current_mode, current_filtered_index
 
     rotated_direction = get_rotated_direction(event.direction)
-    print(f"Title Select: Physical {event.direction} -> Logical {rotated_direction}") # Debug print
+    input_log.debug("Title Select: Physical %s -> Logical %s", event.direction, rotated_direction)
 
     if event.action == "pressed":
-        if rotated_direction == "up":
+        if rotated_direction == "up" and title_select_parent == MODE_BROWSE_ALBUM:
+            # Back to the albums of the artist
+            input_log.debug("Changing to Browse (Album) Mode from Title Select")
+            display_current_album()
+            current_mode = MODE_BROWSE_ALBUM
+        elif rotated_direction == "up" and title_select_parent == MODE_SONG_SELECT_PREFIX:
+            # Back to the second characters, on the one of the current title
+            input_log.debug("Changing to Song Select (Prefix) Mode from Title Select")
+            init_song_select_prefix_mode(prefix_select_char, prefix_run_at(prefix_select_runs, current_filtered_index))
+            current_mode = MODE_SONG_SELECT_PREFIX
+        elif rotated_direction == "up":
             # Back to Character Selection
-            print("Changing to Song Select (Character) Mode from Title Select")
+            input_log.debug("Changing to Song Select (Character) Mode from Title Select")
             # Animation: Last character zooms out (simplified)
             if last_selected_char_display:
                 flash_message(last_selected_char_display, C_ORANGE, duration_secs=0.5, scroll_speed=0.05)
@@ -464,117 +2993,907 @@ def handle_song_select_title_input(event):
             current_mode = MODE_SONG_SELECT_CHAR
         elif rotated_direction == "down":
             # Next Title (scrolling through filtered list)
-            if filtered_song_paths:
-                current_filtered_index = (current_filtered_index + 1) % len(filtered_song_paths)
+            if filtered_song_ids:
+                current_filtered_index = (current_filtered_index + 1) % len(filtered_song_ids)
                 display_current_title()
             else:
                 flash_message("No Titles!", C_RED, duration_secs=1)
         elif rotated_direction == "left":
             # Previous Title (scrolling through filtered list)
-            if filtered_song_paths:
-                current_filtered_index = (current_filtered_index - 1 + len(filtered_song_paths)) % len(filtered_song_paths)
+            if filtered_song_ids:
+                current_filtered_index = (current_filtered_index - 1 + len(filtered_song_ids)) % len(filtered_song_ids)
                 display_current_title()
             else:
                 flash_message("No Titles!", C_RED, duration_secs=1)
+        elif rotated_direction == "right" and title_select_parent == MODE_SONG_SELECT_PREFIX and filtered_song_ids:
+            # First title of the next second character
+            current_filtered_index = next_prefix_position(current_filtered_index, 1)
+            display_current_title()
         elif rotated_direction == "right":
             # Next Title (same as down for now, can be for paging later)
-            if filtered_song_paths:
-                current_filtered_index = (current_filtered_index + 1) % len(filtered_song_paths)
+            if filtered_song_ids:
+                current_filtered_index = (current_filtered_index + 1) % len(filtered_song_ids)
                 display_current_title()
             else:
                 flash_message("No Titles!", C_RED, duration_secs=1)
         elif rotated_direction == "middle":
             # Select Title - go back to Playing Now and play selected song
-            if filtered_song_paths and 0 <= current_filtered_index < len(filtered_song_paths):
-                selected_song_path = filtered_song_paths[current_filtered_index]
-                
-                # To play selected song, re-shuffle current_playlist to put it first,
-                # then play it from index 0. This ensures "next/previous" after selection
-                # still works on a full (but re-shuffled) playlist.
-                # Remove selected song from its current position, then re-insert at beginning
-                current_playlist.remove(selected_song_path) 
-                random.shuffle(current_playlist) # Shuffle the remaining
-                current_playlist.insert(0, selected_song_path) # Insert selected at beginning
-
-                play_track(0) # Play the selected song (now at index 0)
+            if filtered_song_ids and 0 <= current_filtered_index < len(filtered_song_ids):
+                selected_song_id = filtered_song_ids[current_filtered_index]
+
+                # Play the selected song now; "next" carries on with the shuffle after it
+                # and "previous" goes back to the song that was interrupted.
+                play_song_now(selected_song_id)
+                play_track(selected_song_id)
                 current_mode = MODE_PLAYING_NOW # Back to playing mode
                 handle_playing_now_display() # Force immediate song info display
             else:
                 flash_message("Select Song!", C_RED, duration_secs=1)
 
+# --- Browse (Artist / Album) Modes ---
+# Reached by selecting a character while the characters select artists. Both levels are
+# positions in browsing_index, a snapshot kept while browsing even if the library changes.
+browsing_index = None          # BrowseIndex being browsed
+browse_artist_range = (0, 0)   # (first, end) positions of the artists under the selected character
+current_artist_index = 0
+browse_album_range = (0, 0)    # (first, end) positions of the selected artist's albums
+current_album_index = 0
+
+def step_in_range(position, position_range, step):
+    """Moves position by step within (first, end), wrapping around."""
+    first, end = position_range
+    return first + (position - first + step) % (end - first)
+
+def init_browse_artist_mode(char):
+    """Initializes state for Artist Browse mode with the artists filed under char."""
+    global browse_artist_range, current_artist_index
+    browse_artist_range = artist_range(browsing_index, char)
+    current_artist_index = browse_artist_range[0]
+    input_log.debug("Entered Browse (Artist) Mode: %d artists", browse_artist_range[1] - browse_artist_range[0])
+    display_current_artist()
+
+def display_current_artist():
+    """Displays the current artist on Sense HAT."""
+    artist = browsing_index.artist_names[current_artist_index]
+    display_log.debug("Displaying artist: %s", artist)
+    scroll_text(artist, text_colour=C_MAGENTA, scroll_speed=0.08)
+
+def handle_browse_artist_input(event):
+    """Handles joystick input in Artist Browse mode."""
+    global current_mode, current_artist_index, browse_album_range, current_album_index
+
+    rotated_direction = get_rotated_direction(event.direction)
+    input_log.debug("Artist Browse: Physical %s -> Logical %s", event.direction, rotated_direction)
+
+    if event.action == "pressed":
+        if rotated_direction == "up":
+            # Back to Character Selection, on the character of the artists
+            input_log.debug("Changing to Song Select (Character) Mode from Artist Browse")
+            init_song_select_char_mode(SELECT_BY_ARTIST, char_index=current_char_index)
+            current_mode = MODE_SONG_SELECT_CHAR
+        elif rotated_direction in ("down", "right"):
+            # Next Artist
+            current_artist_index = step_in_range(current_artist_index, browse_artist_range, 1)
+            display_current_artist()
+        elif rotated_direction == "left":
+            # Previous Artist
+            current_artist_index = step_in_range(current_artist_index, browse_artist_range, -1)
+            display_current_artist()
+        elif rotated_direction == "middle":
+            # Select Artist: browse their albums
+            browse_album_range = album_range(browsing_index, current_artist_index)
+            current_album_index = browse_album_range[0]
+            input_log.debug("Entered Browse (Album) Mode: %d albums", browse_album_range[1] - browse_album_range[0])
+            display_current_album()
+            current_mode = MODE_BROWSE_ALBUM
+
+def display_current_album():
+    """Displays the current album on Sense HAT."""
+    album = browsing_index.album_names[current_album_index]
+    display_log.debug("Displaying album: %s", album)
+    scroll_text(album, text_colour=C_CYAN, scroll_speed=0.08)
+
+def handle_browse_album_input(event):
+    """Handles joystick input in Album Browse mode."""
+    global current_mode, current_album_index, filtered_song_ids, title_select_parent
+
+    rotated_direction = get_rotated_direction(event.direction)
+    input_log.debug("Album Browse: Physical %s -> Logical %s", event.direction, rotated_direction)
+
+    if event.action == "pressed":
+        if rotated_direction == "up":
+            # Back to the artists
+            input_log.debug("Changing to Browse (Artist) Mode from Album Browse")
+            display_current_artist()
+            current_mode = MODE_BROWSE_ARTIST
+        elif rotated_direction in ("down", "right"):
+            # Next Album
+            current_album_index = step_in_range(current_album_index, browse_album_range, 1)
+            display_current_album()
+        elif rotated_direction == "left":
+            # Previous Album
+            current_album_index = step_in_range(current_album_index, browse_album_range, -1)
+            display_current_album()
+        elif rotated_direction == "middle":
+            # Select Album: pick one of its songs
+            filtered_song_ids = album_songs(browsing_index, current_album_index)
+            title_select_parent = MODE_BROWSE_ALBUM
+            init_song_select_title_mode()
+            current_mode = MODE_SONG_SELECT_TITLE
+
+# --- Joystick Auto-Repeat ---
+# Holding the joystick keeps moving through the lists, faster the longer it is held: once
+# REPEAT_DELAY_SECS have passed, the step rate doubles every REPEAT_DOUBLING_SECS up to
+# REPEAT_MAX_RATE. Steps are worked out from the event timestamps, so merging held events
+# that queued up loses none. While moving only a position bar is drawn; the selection
+# scrolls in full once the joystick is released or stops repeating.
+REPEAT_DELAY_SECS = 0.5     # Hold time before repeating starts
+REPEAT_START_RATE = 4.0     # Steps per second when repeating starts
+REPEAT_DOUBLING_SECS = 1.0  # The step rate doubles this often while held
+REPEAT_MAX_RATE = 60.0      # Steps per second at most
+REPEAT_SETTLE_SECS = 0.3    # Quiet time after which the selection is shown in full
+
+repeat_direction = None     # Logical direction of the press being held
+repeat_pressed_at = 0.0     # event.timestamp of that press
+repeat_applied_until = 0.0  # event.timestamp up to which repeat steps were counted
+repeat_credit = 0.0         # Fraction of a step counted but not taken yet
+repeat_settle_at = None     # time.monotonic() at which the selection gets shown in full (None: nothing pending)
+
+def start_hold(event):
+    """Remembers a press, in case the joystick stays held."""
+    global repeat_direction, repeat_pressed_at, repeat_applied_until, repeat_credit, repeat_settle_at
+    repeat_direction = get_rotated_direction(event.direction)
+    repeat_settle_at = None # The press is answered in full anyway
+    repeat_pressed_at = event.timestamp
+    repeat_applied_until = event.timestamp + REPEAT_DELAY_SECS
+    repeat_credit = 1.0 # The first repeat happens as soon as the delay is over
+
+def display_list_position(position, length, colour):
+    """Position bar shown while moving fast: lights position/length of the matrix, row by row."""
+    lit = (position + 1) * 64 // length if length else 0
+    show_on_display([("pixels", [colour] * lit + [C_BLACK] * (64 - lit))])
+
+def step_selection(direction, steps):
+    """Moves the selection of the current mode by steps in a logical direction; False if it does not move that way.
+
+    Whatever is on screen is cut short only when the selection moves, so feedback such as
+    "Vol" stays up while a direction that moves nothing is held.
+    """
+    global current_char_index, current_prefix_index, current_filtered_index, current_artist_index, current_album_index
+    sign = -1 if direction == "left" else 1
+    if current_mode == MODE_SONG_SELECT_CHAR and direction in ("left", "right"):
+        for _ in range(min(steps, len(CHAR_LIST))):
+            current_char_index = find_nonempty_char_index(current_char_index + sign, sign)
+        interrupt_display()
+        display_current_char() # A letter is cheap enough to show every time
+        return True
+    if current_mode == MODE_SONG_SELECT_PREFIX and direction in ("left", "right"):
+        runs = prefix_select_runs
+        if runs.chars:
+            current_prefix_index = (current_prefix_index + sign * steps) % len(runs.chars)
+            interrupt_display()
+            display_current_prefix()
+        return True
+    if direction not in ("left", "right", "down"):
+        return False
+    if current_mode == MODE_SONG_SELECT_TITLE and filtered_song_ids:
+        if direction == "right" and title_select_parent == MODE_SONG_SELECT_PREFIX: # Run by run
+            current_filtered_index = next_prefix_position(current_filtered_index, steps)
+        else:
+            current_filtered_index = (current_filtered_index + sign * steps) % len(filtered_song_ids)
+        position = (current_filtered_index, len(filtered_song_ids), C_YELLOW)
+    elif current_mode == MODE_BROWSE_ARTIST:
+        current_artist_index = step_in_range(current_artist_index, browse_artist_range, sign * steps)
+        position = (current_artist_index - browse_artist_range[0], browse_artist_range[1] - browse_artist_range[0], C_MAGENTA)
+    elif current_mode == MODE_BROWSE_ALBUM:
+        current_album_index = step_in_range(current_album_index, browse_album_range, sign * steps)
+        position = (current_album_index - browse_album_range[0], browse_album_range[1] - browse_album_range[0], C_CYAN)
+    else:
+        return False
+    interrupt_display()
+    display_list_position(*position)
+    return True
+
+def repeat_distance(seconds):
+    """Steps the repeat has taken after repeating for this long (the integral of the step rate)."""
+    full_speed_after = REPEAT_DOUBLING_SECS * math.log2(REPEAT_MAX_RATE / REPEAT_START_RATE)
+    accelerating = min(seconds, full_speed_after)
+    distance = REPEAT_START_RATE * REPEAT_DOUBLING_SECS / math.log(2) * (2 ** (accelerating / REPEAT_DOUBLING_SECS) - 1)
+    return distance + REPEAT_MAX_RATE * max(0.0, seconds - full_speed_after)
+
+def handle_held_event(event):
+    """Turns held events into steps at the accelerating repeat rate."""
+    global repeat_applied_until, repeat_credit, repeat_settle_at
+    direction = get_rotated_direction(event.direction)
+    if direction != repeat_direction or event.timestamp <= repeat_applied_until:
+        return
+    repeat_start = repeat_pressed_at + REPEAT_DELAY_SECS
+    repeat_credit += repeat_distance(event.timestamp - repeat_start) - repeat_distance(repeat_applied_until - repeat_start)
+    repeat_applied_until = event.timestamp
+    steps = int(repeat_credit)
+    if not steps:
+        return
+    repeat_credit -= steps
+    if step_selection(direction, steps):
+        stats_count("input.repeat_steps", steps)
+        repeat_settle_at = time.monotonic() + REPEAT_SETTLE_SECS
+
+def settle_selection():
+    """Shows the selection in full once moving has stopped."""
+    global repeat_settle_at
+    repeat_settle_at = None
+    interrupt_display()
+    if current_mode == MODE_SONG_SELECT_TITLE:
+        display_current_title()
+    elif current_mode == MODE_BROWSE_ARTIST:
+        display_current_artist()
+    elif current_mode == MODE_BROWSE_ALBUM:
+        display_current_album()
+
+def settle_timeout():
+    """Seconds until settle_selection() is due (None: nothing pending)."""
+    if repeat_settle_at is None:
+        return None
+    return max(0, repeat_settle_at - time.monotonic())
+
+
+# --- Session State ---
+# What is playing is saved to a small binary file, so a restart (or a power cut) resumes the
+# same song at the same spot, with its history, up-next queue and shuffle round. Changes are
+# collected for SESSION_SAVE_DELAY seconds and written together, and the position alone only
+# every SESSION_POSITION_INTERVAL seconds, so the SD card is not written on every event.
+# Track IDs are only trusted when the library still numbers them the same way (library_id);
+# otherwise just the saved song is looked up by its path.
+SESSION_VERSION = 1
+SESSION_MAGIC = b"SHRIMPSS"
+SESSION_SAVE_DELAY = 2.0         # Seconds after a change before the session is written
+SESSION_POSITION_INTERVAL = 15.0 # Seconds between writes of the playback position alone
+SESSION_MODES = (MODE_PLAYING_NOW, MODE_SONG_SELECT_CHAR, MODE_SONG_SELECT_TITLE, MODE_BROWSE_ARTIST, MODE_BROWSE_ALBUM,
+                 MODE_SONG_SELECT_PREFIX) # New modes go last: saved sessions store the position
+# magic, version, library_id, position (ms), volume, history position, shuffle positions drawn,
+# mode, paused, selecting by artist, character index, then the lengths of the rows that follow:
+# history, up next, shuffle ahead, shuffle swaps (pairs) and the current song's path
+SESSION_HEADER = struct.Struct("=8sIQqiiIBBBBIIIII")
+
+Session = collections.namedtuple("Session", [
+    "library_id", "position_ms", "volume", "history_position", "shuffle_drawn",
+    "mode", "paused", "by_artist", "char_index",
+    "history", "up_next", "shuffle_ahead", "shuffle_swaps", "path",
+])
+
+session_save_at = None        # time.monotonic() when the pending session write is due (None: nothing pending)
+last_session_save = 0.0       # time.monotonic() of the last session write
+last_session_key = None       # session_key() at the last write
+resume_position_ms = None     # Where to seek once VLC starts playing the resumed song
+resume_paused = False         # Pause the resumed song once it is at its position
+session_writes = queue.Queue() # Encoded sessions waiting for the writer thread
+session_writer_thread = None  # The writer thread, once started
+
+def session_key():
+    """The parts of the session whose change calls for a write."""
+    return (current_song(), history_position, len(up_next), player_state, volume_setting,
+            current_mode, char_select_source, current_char_index)
+
+def encode_session():
+    """The current session as bytes (None before the first song)."""
+    with library_lock:
+        track_id = current_song()
+        if track_id is None:
+            return None
+        rows = [array('I', play_history), array('I', up_next), array('I', shuffle_ahead),
+                array('I', itertools.chain.from_iterable(shuffle_swaps.items()))]
+        position, drawn = history_position, shuffle_drawn
+    path = track_path(track_id).encode("utf-8", "surrogatepass")
+    mode = SESSION_MODES.index(current_mode) if current_mode in SESSION_MODES else 0
+    header = SESSION_HEADER.pack(SESSION_MAGIC, SESSION_VERSION, library_id, max(0, vlc_player.get_time()),
+                                 volume_setting, position, drawn, mode, player_state == PLAYER_PAUSED,
+                                 char_select_source == SELECT_BY_ARTIST, current_char_index,
+                                 len(rows[0]), len(rows[1]), len(rows[2]), len(rows[3]) // 2, len(path))
+    return header + b"".join(row.tobytes() for row in rows) + path
+
+def write_session_file(data, path=None):
+    """Writes an encoded session to a temporary file, syncs it and swaps it in."""
+    path = SESSION_STATE_PATH if path is None else path
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno()) # Survives a power cut right after the rename
+        os.replace(tmp_path, path)
+    except OSError as e:
+        player_log.warning("Could not save session '%s': %s", path, e)
+
+def session_writer():
+    """Writer thread: writes the latest queued session (older ones still waiting are skipped)."""
+    while True:
+        data = session_writes.get()
+        taken = 1
+        while not session_writes.empty():
+            data = session_writes.get_nowait()
+            taken += 1
+        with stats_timer("session.write"):
+            write_session_file(data)
+        for _ in range(taken):
+            session_writes.task_done()
+
+def start_session_writer():
+    """Runs session_writer on a background thread."""
+    global session_writer_thread
+    session_writer_thread = threading.Thread(target=session_writer, name="session-writer", daemon=True)
+    session_writer_thread.start()
+
+def save_session(wait=False):
+    """Saves the session on the writer thread; with wait set, returns once it is on disk."""
+    global session_save_at, last_session_save, last_session_key
+    session_save_at = None
+    last_session_save = time.monotonic()
+    last_session_key = session_key()
+    data = encode_session()
+    if data is None:
+        return
+    if wait and session_writer_thread is None: # No writer thread to share the temporary file with
+        write_session_file(data)
+        return
+    session_writes.put(data)
+    if wait:
+        session_writes.join() # After any write still under way, never alongside it
+
+def update_session():
+    """Main loop: schedules a session write when something changed, and saves once it is due."""
+    global session_save_at
+    now = time.monotonic()
+    if session_save_at is None and (session_key() != last_session_key or
+                                    player_state == PLAYER_PLAYING and now - last_session_save >= SESSION_POSITION_INTERVAL):
+        session_save_at = now + SESSION_SAVE_DELAY
+    if session_save_at is not None and now >= session_save_at:
+        save_session()
+
+def session_timeout():
+    """Seconds until update_session() has something to do (None: only after an event)."""
+    if session_save_at is not None:
+        return max(0, session_save_at - time.monotonic())
+    if player_state == PLAYER_PLAYING:
+        return max(0, last_session_save + SESSION_POSITION_INTERVAL - time.monotonic())
+    return None
+
+def load_session_state(path=None):
+    """Reads the saved session (None if there is none or it cannot be used)."""
+    path = SESSION_STATE_PATH if path is None else path
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        fields = SESSION_HEADER.unpack_from(data)
+    except (OSError, struct.error) as e:
+        player_log.info("No session to resume: %s", e)
+        return None
+    magic, version, session_library_id, position_ms, volume, position, drawn, mode, paused, by_artist, char_index = fields[:11]
+    lengths = fields[11:15]
+    path_length = fields[15]
+    offset = SESSION_HEADER.size
+    if magic != SESSION_MAGIC or version != SESSION_VERSION or \
+            len(data) != offset + 4 * (sum(lengths) + lengths[3]) + path_length:
+        player_log.warning("Ignoring session '%s': written by another version or damaged.", path)
+        return None
+    rows = []
+    for count in lengths[:3] + (lengths[3] * 2,):
+        row = array('I')
+        row.frombytes(data[offset:offset + 4 * count])
+        rows.append(row)
+        offset += 4 * count
+    return Session(session_library_id, position_ms, volume, position, drawn,
+                   SESSION_MODES[mode] if mode < len(SESSION_MODES) else MODE_PLAYING_NOW, bool(paused), bool(by_artist),
+                   min(char_index, len(CHAR_LIST) - 1), *rows, str(data[offset:], "utf-8", "surrogatepass"))
+
+def resume_session(session):
+    """Restores the saved history, queue, shuffle round and volume, and plays the saved song from where it was.
+
+    Returns False if the saved song is no longer in the library (what was restored is kept,
+    so "next" carries on from the saved queue).
+    """
+    global shuffle_drawn, history_position, resume_position_ms, resume_paused, volume_setting
+    with library_lock:
+        track_count = len(track_names)
+        same_ids = (session.library_id == library_id and 0 <= session.history_position < len(session.history)
+                    and max(itertools.chain(session.history, session.up_next, session.shuffle_ahead, session.shuffle_swaps)) < track_count
+                    and track_path(session.history[session.history_position]) == session.path)
+        reset_shuffle()
+        if same_ids:
+            play_history.extend(session.history)
+            history_position = session.history_position
+            up_next.extend(session.up_next)
+            shuffle_ahead.extend(session.shuffle_ahead)
+            shuffle_swaps.update(zip(session.shuffle_swaps[::2], session.shuffle_swaps[1::2]))
+            shuffle_drawn = min(session.shuffle_drawn, track_count)
+            track_id = current_song()
+        else: # Songs were numbered afresh: only the song itself can be found again
+            track_id = get_track_id(session.path, create=False)
+            if ((track_id is None or not track_in_library[track_id]) and session.path.startswith(os.path.join(MUSIC_DIR, ""))
+                    and session.path.lower().endswith(SUPPORTED_EXTENSIONS) and os.path.isfile(session.path)):
+                track_id = get_track_id(session.path) # The scan has not reached it yet; it finds it already added
+                add_discovered_song(track_id)
+            if track_id is not None and track_in_library[track_id]:
+                push_history(track_id)
+        if track_id is None or not track_in_library[track_id]:
+            return False
+    volume_setting = session.volume
+    apply_volume()
+    resume_position_ms = session.position_ms
+    resume_paused = session.paused
+    play_track(track_id)
+    player_log.info("Resumed session at %d:%02d.", session.position_ms // 60000, session.position_ms // 1000 % 60)
+    return True
+
+def resume_playback_position():
+    """Seeks the resumed song to its saved position once VLC plays it, and pauses it again if it was paused."""
+    global resume_position_ms, resume_paused
+    if resume_position_ms:
+        vlc_player.set_time(resume_position_ms)
+    if resume_paused and player_state == PLAYER_PLAYING:
+        play_pause()
+    resume_position_ms, resume_paused = None, False
+
+def restore_session_mode(session):
+    """Returns to the character selection the session was in (lists below it are picked again from there)."""
+    global current_mode
+    if session.mode == MODE_PLAYING_NOW:
+        return False
+    init_song_select_char_mode(SELECT_BY_ARTIST if session.by_artist else SELECT_BY_TITLE, session.char_index)
+    current_mode = MODE_SONG_SELECT_CHAR
+    return True
+
+# --- Control Socket ---
+# A Unix socket for scripts and home automation, served by asyncio on its own thread. One
+# command per line, as text ("next", "search abba", "enqueue 42") or as JSON
+# ({"command": "enqueue", "argument": 42}); every command is answered with one line of JSON.
+# Commands that change what plays are handed to the main loop like joystick presses and
+# answered once it ran them; search, status and stats are answered on the socket thread.
+CONTROL_SEARCH_LIMIT = 20     # Songs a search returns at most
+CONTROL_LINE_LIMIT = 4096     # Longest command line accepted
+CONTROL_COMMAND_TIMEOUT = 5.0 # Seconds a command waits for the main loop
+
+def describe_song(track_id):
+    """ID, title, artist and album of a song, as the control socket reports it."""
+    metadata = get_track_metadata_by_id(track_id)
+    return {"id": track_id, "title": metadata['title'], "artist": metadata['artist'], "album": metadata['album']}
+
+def search_songs(query, limit=CONTROL_SEARCH_LIMIT):
+    """IDs of the songs whose title, artist or album contains query (ignoring case), in library order."""
+    needle = query.casefold()
+    with library_lock:
+        songs = array('I', all_music_files)
+    matches = []
+    for track_id in songs:
+        metadata = get_track_metadata_by_id(track_id)
+        if any(needle in str(metadata[field]).casefold() for field in ('title', 'artist', 'album')):
+            matches.append(track_id)
+            if len(matches) == limit:
+                break
+    return matches
+
+def resolve_track(argument):
+    """The song a play or enqueue argument names: a track ID (as search reports them) or the first match of a search."""
+    if isinstance(argument, int) or str(argument).isdigit():
+        track_id = int(argument)
+        with library_lock:
+            if 0 <= track_id < len(track_in_library) and track_in_library[track_id]:
+                return track_id
+        raise ValueError(f"no song {track_id}")
+    matches = search_songs(str(argument), limit=1)
+    if not matches:
+        raise ValueError(f"no song matches {argument!r}")
+    return matches[0]
+
+def control_status(argument=None):
+    """What is playing, where, and at which volume."""
+    with library_lock:
+        track_id = current_song()
+        queued = len(up_next)
+    metadata = current_track_metadata
+    return {"state": player_state, "song": track_id, "title": metadata['title'], "artist": metadata['artist'],
+            "album": metadata['album'], "position_ms": max(0, vlc_player.get_time()),
+            "duration_ms": round((metadata['duration'] or 0) * 1000), "volume": volume_setting,
+            "gain_db": track_gain, "up_next": queued, "mode": current_mode, "songs": len(all_music_files)}
+
+def control_search(argument):
+    if not argument:
+        raise ValueError("search needs a text")
+    return {"songs": [describe_song(track_id) for track_id in search_songs(str(argument))]}
+
+def control_stats(argument=None):
+    return stats_summary()
+
+def control_play(track_id):
+    """Main loop: plays a song now, or resumes (or starts) playback without one."""
+    if track_id is None:
+        if player_state != PLAYER_PLAYING:
+            play_pause()
+    else:
+        if not track_in_library[track_id]:
+            raise ValueError(f"no song {track_id}")
+        play_song_now(track_id)
+        play_track(track_id)
+    return control_status()
+
+def control_pause(argument=None):
+    """Main loop: pauses playback (pausing twice does not resume)."""
+    if player_state == PLAYER_PLAYING:
+        play_pause()
+    return control_status()
+
+def control_next(argument=None):
+    """Main loop: skips to the next song."""
+    play_next_song()
+    return control_status()
+
+def control_enqueue(track_id):
+    """Main loop: puts a song up next, after the songs queued before it."""
+    if track_id is None or not track_in_library[track_id]:
+        raise ValueError("enqueue needs a song")
+    unqueue_upcoming() # First, so a failure leaves up next and VLC's list as they were
+    enqueue_song(track_id)
+    if queued_media_list is not None:
+        top_up_media_queue()
+    flash_message("QUEUED", C_CYAN, duration_secs=1)
+    with library_lock:
+        return {"up_next": len(up_next)}
+
+def control_volume(argument):
+    """Main loop: changes the volume by a step ("+10", "-10")."""
+    try:
+        delta = int(argument)
+    except (TypeError, ValueError):
+        raise ValueError("volume needs a step such as +10 or -10") from None
+    change_volume(delta)
+    return {"volume": volume_setting}
+
+CONTROL_QUERIES = {"status": control_status, "stats": control_stats}            # Answered on the socket thread
+CONTROL_BLOCKING_QUERIES = {"search": control_search}                           # Answered on a worker thread
+CONTROL_PLAYER_COMMANDS = {"play": control_play, "pause": control_pause, "next": control_next,
+                           "enqueue": control_enqueue, "volume": control_volume} # Run by the main loop
+CONTROL_TRACK_COMMANDS = ("play", "enqueue") # Player commands whose argument names a song
+
+def run_control_command(payload):
+    """Main loop: runs a player command from the control socket and hands back its answer."""
+    command, argument, answer = payload
+    if not answer.set_running_or_notify_cancel(): # The client stopped waiting
+        return
+    interrupt_display() # Like a joystick press, the response replaces what is on screen
+    try:
+        answer.set_result(CONTROL_PLAYER_COMMANDS[command](argument))
+    except Exception as e:
+        answer.set_exception(e)
+
+def parse_control_line(line):
+    """(command, argument) of a text or JSON command line."""
+    text = line.decode("utf-8", "replace").strip()
+    if text.startswith("{"):
+        request = json.loads(text)
+        if not isinstance(request, dict):
+            raise ValueError("a JSON command must be an object")
+        return str(request.get("command", "")).lower(), request.get("argument")
+    command, _, argument = text.partition(" ")
+    return command.lower(), argument.strip() or None
+
+async def answer_control_line(line):
+    """The JSON answer to one command line."""
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        command, argument = parse_control_line(line)
+        if command in CONTROL_QUERIES:
+            result = CONTROL_QUERIES[command](argument)
+        elif command in CONTROL_BLOCKING_QUERIES:
+            result = await loop.run_in_executor(None, CONTROL_BLOCKING_QUERIES[command], argument)
+        elif command in CONTROL_PLAYER_COMMANDS:
+            if command in CONTROL_TRACK_COMMANDS and argument is not None:
+                argument = await loop.run_in_executor(None, resolve_track, argument)
+            answer = Future()
+            post_main_event(EVENT_CONTROL, (command, argument, answer))
+            result = await asyncio.wait_for(asyncio.wrap_future(answer), CONTROL_COMMAND_TIMEOUT)
+        else:
+            raise ValueError(f"unknown command {command!r}")
+        reply = {"ok": True, **result}
+    except asyncio.TimeoutError:
+        reply = {"ok": False, "error": "the player did not answer in time"}
+    except Exception as e:
+        control_log.debug("Command %r failed: %s", line, e)
+        reply = {"ok": False, "error": str(e)}
+    stats_count("control.commands")
+    stats_timing("control.command", time.perf_counter() - start)
+    return reply
+
+async def handle_control_client(reader, writer):
+    """Answers the commands of one connection, in order, until it closes."""
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError: # Longer than CONTROL_LINE_LIMIT
+                writer.write(b'{"ok": false, "error": "command too long"}\n')
+                break
+            if not line:
+                break
+            writer.write(json.dumps(await answer_control_line(line)).encode() + b"\n")
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+def control_server(path):
+    """Control socket thread: runs the asyncio server until the program ends."""
+    async def serve():
+        with contextlib.suppress(FileNotFoundError):
+            if stat.S_ISSOCK(os.lstat(path).st_mode): # Left behind by a previous run
+                os.unlink(path)
+        server = await asyncio.start_unix_server(handle_control_client, path, limit=CONTROL_LINE_LIMIT)
+        os.chmod(path, 0o600) # Only for the user running the player
+        control_log.info("Listening for commands on %s", path)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except OSError as e:
+        control_log.warning("Control socket '%s' unavailable: %s", path, e)
+
+def start_control_socket(path=None):
+    """Starts serving the control socket (unless CONTROL_SOCKET_PATH is None)."""
+    path = path or CONTROL_SOCKET_PATH
+    if path is None:
+        return
+    threading.Thread(target=control_server, args=(path,), name="control", daemon=True).start()
+
+def remove_control_socket(path=None):
+    """Removes the socket file on shutdown."""
+    path = path or CONTROL_SOCKET_PATH
+    if path is not None:
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+
+# --- Event Loop ---
+# The main loop sleeps until something happens: a joystick event, a player event from
+# libVLC, or the next scheduled display update. Other threads only ever post events.
+EVENT_JOYSTICK = "JOYSTICK"
+EVENT_TRACK_ENDED = "TRACK_ENDED"
+EVENT_NEXT_ITEM = "NEXT_ITEM"
+EVENT_PLAYER_ERROR = "PLAYER_ERROR"
+EVENT_RESUME_POSITION = "RESUME_POSITION"
+EVENT_CONTROL = "CONTROL" # A player command from the control socket
+
+main_events = queue.Queue() # (kind, payload) for the main loop
+deferred_main_events = collections.deque() # Taken off main_events while merging held events, handled next
+
+def post_main_event(kind, payload=None):
+    """Hands an event to the main loop (safe to call from any thread)."""
+    main_events.put((kind, payload))
+
+def joystick_reader():
+    """Joystick thread: blocks on the joystick device and forwards its events to the main loop."""
+    while True:
+        event = sense.stick.wait_for_event() # select() on the input device, no polling
+        post_main_event(EVENT_JOYSTICK, event)
+
+def on_vlc_list_played(event):
+    """libVLC callback (VLC thread): the last queued track finished."""
+    # libVLC must not be called back from inside its own event thread, so just hand over
+    post_main_event(EVENT_TRACK_ENDED)
+
+def on_vlc_next_item(event):
+    """libVLC callback (VLC thread): the list player moved to another queued track."""
+    post_main_event(EVENT_NEXT_ITEM)
+
+def on_vlc_playing(event):
+    """libVLC callback (VLC thread): output started; completes the play_track() timing."""
+    global play_requested_at
+    started, play_requested_at = play_requested_at, None
+    if started is not None:
+        stats_timing("play_track.audible", time.perf_counter() - started)
+    if resume_position_ms is not None or resume_paused: # A resumed session still has to seek
+        post_main_event(EVENT_RESUME_POSITION)
+
+def on_vlc_error(event):
+    """libVLC callback (VLC thread): the current track could not be played."""
+    post_main_event(EVENT_PLAYER_ERROR)
+
+def start_event_sources():
+    """Attaches the libVLC callbacks and starts the joystick, look-ahead and read-ahead threads."""
+    vlc_events = vlc_player.event_manager()
+    vlc_events.event_attach(vlc.EventType.MediaPlayerEncounteredError, on_vlc_error)
+    vlc_events.event_attach(vlc.EventType.MediaPlayerPlaying, on_vlc_playing)
+    list_events = list_player.event_manager()
+    list_events.event_attach(vlc.EventType.MediaListPlayerNextItemSet, on_vlc_next_item)
+    list_events.event_attach(vlc.EventType.MediaListPlayerPlayed, on_vlc_list_played)
+    start_prepare_worker()
+    start_readahead_worker()
+    threading.Thread(target=joystick_reader, name="joystick", daemon=True).start()
+
+def handle_joystick_event(event):
+    """Dispatches a joystick event to the handler of the current mode."""
+    # Wrap event handling in a try-except to catch and report errors
+    # that might cause silent exits.
+    try:
+        if event.action == "held":
+            handle_held_event(event)
+        elif event.action == "released":
+            if repeat_settle_at is not None:
+                settle_selection()
+        elif event.action == "pressed": # Only react to 'pressed' for main controls
+            start_hold(event)
+            interrupt_display() # Whatever is scrolling gives way to the response to this press
+            if current_mode == MODE_PLAYING_NOW:
+                handle_playing_now_input(event)
+            elif current_mode == MODE_SONG_SELECT_CHAR:
+                handle_song_select_char_input(event)
+            elif current_mode == MODE_SONG_SELECT_PREFIX:
+                handle_song_select_prefix_input(event)
+            elif current_mode == MODE_SONG_SELECT_TITLE:
+                handle_song_select_title_input(event)
+            elif current_mode == MODE_BROWSE_ARTIST:
+                handle_browse_artist_input(event)
+            elif current_mode == MODE_BROWSE_ALBUM:
+                handle_browse_album_input(event)
+            stats_count("input.presses")
+            stats_timing("input.latency", max(0.0, time.time() - event.timestamp)) # From the kernel's event timestamp
+    except Exception as e:
+        input_log.exception("Joystick event handling failed in %s mode: %s", current_mode, e)
+        # Optionally flash an error message on Sense HAT
+        flash_message("ERROR!", C_RED, priority=DISPLAY_PRIORITY_ALERT)
+        # Decide if you want to exit or try to recover. For now, log and continue.
+
+def handle_main_event(kind, payload=None):
+    """Handles one event of the main loop (kind None: a display timer expired)."""
+    if kind == EVENT_JOYSTICK:
+        handle_joystick_event(payload)
+    elif kind == EVENT_TRACK_ENDED:
+        # Auto-advance once VLC ran out of queued songs (ignoring a stale event for a list we already replaced)
+        if player_state == PLAYER_PLAYING and vlc_player.get_state() == vlc.State.Ended:
+            player_log.info("Current track ended. Playing next.")
+            play_next_song()
+    elif kind == EVENT_NEXT_ITEM:
+        handle_next_item()
+    elif kind is None and repeat_settle_at is not None and time.monotonic() >= repeat_settle_at:
+        settle_selection() # The joystick stopped repeating without a release
+    elif kind == EVENT_PLAYER_ERROR:
+        player_log.error("VLC could not play the current track. Skipping it.")
+        flash_message("ERROR!", C_RED, priority=DISPLAY_PRIORITY_ALERT)
+        play_next_song()
+    elif kind == EVENT_RESUME_POSITION:
+        resume_playback_position()
+    elif kind == EVENT_CONTROL:
+        run_control_command(payload)
+
+    # Handle mode-specific display updates (e.g., idle scrolling for Playing Now)
+    if current_mode == MODE_PLAYING_NOW:
+        handle_playing_now_display()
+    # Other modes (Char Select, Title Select) are event-driven for display updates
+    # so no continuous 'display_idle' needed here.
+    update_session()
+
+def is_held_event(kind, payload):
+    return kind == EVENT_JOYSTICK and payload.action == "held"
+
+def next_main_event(timeout):
+    """Waits for the next event; held joystick events that queued up in a row are merged into the last one."""
+    if deferred_main_events:
+        kind, payload = deferred_main_events.popleft()
+    else:
+        kind, payload = main_events.get(timeout=timeout)
+    while is_held_event(kind, payload) and not deferred_main_events:
+        try:
+            next_event = main_events.get_nowait()
+        except queue.Empty:
+            break
+        if is_held_event(*next_event) and next_event[1].direction == payload.direction:
+            kind, payload = next_event
+            stats_count("input.coalesced")
+        else:
+            deferred_main_events.append(next_event)
+    return kind, payload
+
+def main_loop_timeout():
+    """Seconds the main loop may sleep before a display update is due (None: until an event arrives)."""
+    timeouts = [settle_timeout(), session_timeout()]
+    if current_mode == MODE_PLAYING_NOW:
+        timeouts.append(playing_now_display_timeout())
+    timeouts = [timeout for timeout in timeouts if timeout is not None]
+    return min(timeouts) if timeouts else None
+
+def run_event_loop():
+    """Handles events as they arrive until interrupted."""
+    while True:
+        try:
+            kind, payload = next_main_event(main_loop_timeout())
+        except queue.Empty:
+            kind, payload = None, None # Timer expired
+        with stats_timer("loop.iteration"):
+            handle_main_event(kind, payload)
 
 # --- Main Program Logic ---
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="SHRIMP: a shuffling music player for the Sense HAT.")
+    parser.add_argument("--analyze", action="store_true",
+                        help="measure duration, bitrate and loudness of every song into the metadata cache, then exit")
+    parser.add_argument("--workers", type=int, default=SCAN_WORKERS, help="processes used by --analyze")
+    return parser.parse_args(argv)
+
+def analyze_main(workers=SCAN_WORKERS):
+    """Batch mode (--analyze): needs neither the Sense HAT nor VLC."""
+    setup_logging()
+    if not os.path.isdir(MUSIC_DIR):
+        log.error("Music directory '%s' does NOT exist!", MUSIC_DIR)
+        sys.exit(1)
+    analyze_library(MUSIC_DIR, workers)
+
 def main():
     global current_mode, player_state
 
-    # Startup Sequence
-    startup_animation()
-    print("MP3 Player Starting...")
+    setup_logging()
+    log.info("MP3 Player Starting...")
+    init_backends()
+    start_display_engine()
+    start_stats_reporting()
+
+    if not os.path.exists(MUSIC_DIR):
+        log.error("Music directory '%s' does NOT exist!", MUSIC_DIR)
+        scroll_text_blocking("NO DIR!", text_colour=C_RED, scroll_speed=0.05, priority=DISPLAY_PRIORITY_ALERT)
+        time.sleep(1)
+        sys.exit()
 
-    # Scan Music
-    scanned_music = scan_music_directory(MUSIC_DIR)
-    if not scanned_music:
-        print("No music found. Exiting.")
+    # Start from the library snapshot if there is one (checked against the disk in the background);
+    # otherwise scan Music in the background and start playing as soon as the first song turns up
+    if load_library_snapshot(MUSIC_DIR):
+        start_snapshot_validation(MUSIC_DIR)
+    else:
+        open_metadata_cache() # Cached tags, so unchanged files never have to be parsed again
+        start_library_scan(MUSIC_DIR)
+    start_library_watcher(MUSIC_DIR) # Picks up files added or removed while playing
+    library_first_track.wait()
+    if not all_music_files:
+        log.error("No supported audio files (.mp3, .flac, .wav, .ogg) found.")
+        scroll_text_blocking("NO MUSIC!", text_colour=C_RED, scroll_speed=0.05, priority=DISPLAY_PRIORITY_ALERT)
+        time.sleep(1)
         sys.exit()
 
-    scroll_text_blocking("READY!", text_colour=C_GREEN, scroll_speed=0.05)
+    # Initial Playback: carry on where the last session stopped, or start the shuffle
+    session = load_session_state()
+    start_event_sources()
+    start_session_writer()
+    start_control_socket()
+    if session is None or not resume_session(session):
+        play_next_song() # Start playing the first song of the shuffle
+    current_mode = MODE_PLAYING_NOW # Set initial mode
 
-    # Initial Playback
-    if current_playlist:
-        play_track(0) # Start playing the first song in the shuffled playlist
-        current_mode = MODE_PLAYING_NOW # Set initial mode
-        # Ensure initial track info is displayed after player starts
+    # Startup Sequence (the scan keeps going meanwhile)
+    startup_animation()
+    if session is None or not restore_session_mode(session):
         handle_playing_now_display()
-    else:
-        print("No music in playlist. Exiting.")
-        sys.exit()
 
     # Main Event Loop
     try:
-        while True:
-            # Handle joystick input based on current mode
-            for event in sense.stick.get_events():
-                # Wrap event handling in a try-except to catch and report errors
-                # that might cause silent exits.
-                try:
-                    if event.action == "pressed": # Only react to 'pressed' for main controls
-                        if current_mode == MODE_PLAYING_NOW:
-                            handle_playing_now_input(event)
-                        elif current_mode == MODE_SONG_SELECT_CHAR:
-                            handle_song_select_char_input(event)
-                        elif current_mode == MODE_SONG_SELECT_TITLE:
-                            handle_song_select_title_input(event)
-                except Exception as e:
-                    print(f"!!! ERROR during joystick event handling in {current_mode} mode: {e}")
-                    # Optionally flash an error message on Sense HAT
-                    flash_message("ERROR!", C_RED)
-                    # Decide if you want to exit or try to recover. For now, log and continue.
-                    time.sleep(2) # Pause to let message be seen
-
-            # Auto-advance track if current song finishes
-            if player_state == PLAYER_PLAYING and vlc_player.get_state() == vlc.State.Ended:
-                print("Current track ended. Playing next.")
-                play_next_song()
-
-            # Handle mode-specific display updates (e.g., idle scrolling for Playing Now)
-            if current_mode == MODE_PLAYING_NOW:
-                handle_playing_now_display()
-            # Other modes (Char Select, Title Select) are mostly event-driven for display updates
-            # so no continuous 'display_idle' needed here.
-
-            time.sleep(0.05) # Small delay to prevent burning CPU
+        run_event_loop()
 
     except KeyboardInterrupt:
-        print("\nExiting player due to KeyboardInterrupt.")
+        log.info("Exiting player due to KeyboardInterrupt.")
     except Exception as e:
-        print(f"\n!!! UNEXPECTED CRITICAL ERROR IN MAIN LOOP: {e}")
-        flash_message("FATAL ERROR!", C_RED)
+        log.exception("UNEXPECTED CRITICAL ERROR IN MAIN LOOP: %s", e)
+        scroll_text_blocking("FATAL ERROR!", C_RED, priority=DISPLAY_PRIORITY_ALERT)
         time.sleep(3)
     finally:
+        remove_control_socket()
+        save_session(wait=True)
         stop_player()
-        sense.clear()
-        print("Player gracefully shut down.")
+        save_library_snapshot_if_changed(MUSIC_DIR)
+        close_metadata_cache()
+        interrupt_display()
+        show_on_display([("clear",)], DISPLAY_PRIORITY_ALERT).wait(1)
+        log.info("Player gracefully shut down.")
         sys.exit(0) # Explicitly exit with 0 after graceful shutdown
 
 if __name__ == "__main__":
-    main()
+    arguments = parse_arguments()
+    if arguments.analyze:
+        analyze_main(arguments.workers)
+    else:
+        main()
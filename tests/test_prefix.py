@@ -0,0 +1,29 @@
+"""Regression tests for the second-character level of the title selection (python -m pytest tests)."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shrimp
+
+
+class PrefixRunsTest(unittest.TestCase):
+    def setUp(self):
+        shrimp.reset_library_state()
+        titles = sorted(["S x", "S1", "S!", "Sa", "Sz", "S", "Sb", "S~"])
+        for number, title in enumerate(titles):
+            track_id = shrimp.get_track_id(f"/music/{number}.mp3")
+            shrimp.track_sort_keys[track_id] = title.lower()
+            shrimp.char_buckets['S'].append(track_id)
+        shrimp.prefix_runs_cache.pop('S', None)
+
+    def test_each_second_character_is_one_run(self):
+        runs = shrimp.char_prefix_runs('S')
+        self.assertEqual(runs.chars, ['#', '1', 'A', 'B', 'Z'])
+        self.assertEqual(list(runs.starts), [0, 4, 5, 6, 7, 8])
+        titles = [shrimp.track_sort_keys[track_id] for track_id in runs.tracks]
+        self.assertEqual(titles, ["s", "s x", "s!", "s~", "s1", "sa", "sb", "sz"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+"""Regression tests for the gapless queue (python -m pytest tests)."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shrimp
+import bench_shrimp
+
+
+class GaplessQueueTest(unittest.TestCase):
+    def setUp(self):
+        shrimp.reset_library_state()
+        shrimp.init_backends(display=bench_shrimp.FakeDisplay(), player_instance=bench_shrimp.FakeVlcInstance())
+        for number in range(100):
+            shrimp.add_discovered_song(shrimp.get_track_id(f"/music/{number}.mp3"))
+
+    def test_media_list_is_never_rebuilt_or_run_out(self):
+        shrimp.play_next_song()
+        media_list = shrimp.queued_media_list
+        for _ in range(3 * shrimp.MEDIA_QUEUE_MAX):
+            # VLC moving on to the next song of the list by itself
+            playing = media_list.items.index(shrimp.vlc_player.get_media())
+            shrimp.vlc_player.set_media(media_list.items[playing + 1])
+            shrimp.handle_next_item()
+            self.assertIs(shrimp.queued_media_list, media_list)
+            self.assertLessEqual(media_list.count(), shrimp.MEDIA_QUEUE_MAX)
+            self.assertEqual(media_list.count(), len(shrimp.queued_tracks))
+            self.assertEqual(shrimp.queued_tracks[shrimp.queued_position], shrimp.current_song())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+"""Regression tests for saving and resuming the session (python -m pytest tests)."""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shrimp
+import bench_shrimp
+
+
+class ResumeSessionTest(unittest.TestCase):
+    def setUp(self):
+        shrimp.reset_library_state()
+        shrimp.init_backends(display=bench_shrimp.FakeDisplay(), player_instance=bench_shrimp.FakeVlcInstance())
+        music_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(music_dir.cleanup)
+        self.addCleanup(setattr, shrimp, "MUSIC_DIR", shrimp.MUSIC_DIR)
+        shrimp.MUSIC_DIR = music_dir.name
+        self.path = os.path.join(music_dir.name, "saved.mp3")
+        open(self.path, "wb").close()
+
+    def test_session_resumes_a_song_the_scan_has_not_reached(self):
+        shrimp.add_discovered_song(shrimp.get_track_id(os.path.join(shrimp.MUSIC_DIR, "scanned.mp3")))
+        session = shrimp.Session(library_id=-1, position_ms=0, volume=50, history_position=0, shuffle_drawn=0,
+                                 mode=shrimp.MODE_PLAYING_NOW, paused=False, by_artist=False, char_index=0,
+                                 history=[0], up_next=[], shuffle_ahead=[], shuffle_swaps=[], path=self.path)
+        self.assertTrue(shrimp.resume_session(session))
+        self.assertEqual(shrimp.track_path(shrimp.current_song()), self.path)
+        shrimp.add_discovered_song(shrimp.get_track_id(self.path)) # The scan reaching it
+        self.assertEqual(len(shrimp.all_music_files), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
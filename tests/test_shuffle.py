@@ -0,0 +1,38 @@
+"""Regression tests for the shuffle engine (python -m pytest tests)."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shrimp
+import bench_shrimp
+
+
+class HandPickedSongTest(unittest.TestCase):
+    def setUp(self):
+        shrimp.reset_library_state()
+        for number in range(6):
+            shrimp.add_discovered_song(shrimp.get_track_id(f"/music/{number}.mp3"))
+
+    def test_song_played_now_is_not_played_again_from_the_look_ahead(self):
+        first = shrimp.next_song()
+        shrimp.upcoming_songs(3)
+        picked = shrimp.shuffle_ahead[1]
+        shrimp.play_song_now(picked)
+        played = [first, picked] + [shrimp.next_song() for _ in range(4)]
+        self.assertEqual(sorted(played), list(range(6))) # One round: every song exactly once
+
+    def test_enqueued_song_from_the_look_ahead_is_queued_once(self):
+        shrimp.init_backends(display=bench_shrimp.FakeDisplay(), player_instance=bench_shrimp.FakeVlcInstance())
+        current = shrimp.next_song()
+        shrimp.play_track(current)
+        drawn = list(shrimp.shuffle_ahead)
+        shrimp.control_enqueue(drawn[1])
+        queued = shrimp.queued_tracks[shrimp.queued_position:]
+        self.assertEqual(queued, [current, drawn[1], drawn[0]])
+        self.assertEqual(shrimp.queued_media_list.count(), len(shrimp.queued_tracks))
+        self.assertEqual([shrimp.next_song() for _ in range(3)], [drawn[1], drawn[0], drawn[2]])
+
+
+if __name__ == "__main__":
+    unittest.main()